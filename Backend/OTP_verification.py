@@ -1,36 +1,226 @@
+import os
+import heapq
+import threading
+import time
+from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from sqlalchemy import delete, select
+from database import SessionLocal, OTPCode
 
-#Class to store the OTPs for the users.
-class OTPStore:
-    otps = {}  # static variable that binds users' email addresses to their OTPs and their expiration times.
+#Load the environment variables that store the settings of the OTP store
+load_dotenv()
 
-    @classmethod
-    #Sets the OTP for the user's email address with a default expiry time of 2 minutes.
-    def set_otp(cls, email, otp, expiry_minutes=2):
-        expiry_time = datetime.now() + timedelta(minutes=expiry_minutes)
-        cls.otps[email] = (otp, expiry_time)
+#Settings of the OTP store. They can be overridden in the .env file.
+OTP_STORE_BACKEND = os.getenv("OTP_STORE_BACKEND", "memory")  # "memory" for one server process, "database" to share the OTPs between several processes
+OTP_EXPIRY_MINUTES = float(os.getenv("OTP_EXPIRY_MINUTES", "2"))
+OTP_MAX_ENTRIES = int(os.getenv("OTP_MAX_ENTRIES", "10000"))  # OTPs kept at the same time. When the store is full, the OTPs closest to expiry are dropped.
+OTP_SWEEP_INTERVAL = float(os.getenv("OTP_SWEEP_INTERVAL", "30"))  # seconds between two removals of the expired OTPs
+
+#Results of the verification of an OTP
+OTP_NOT_FOUND = "OTP not found"
+OTP_EXPIRED = "OTP has expired!"
+OTP_VERIFIED = "OTP verified"
+OTP_INVALID = "Invalid OTP!"
+
+
+#Base class of the OTP stores. It binds users' email addresses to their OTPs and their expiration times.
+#Once start_sweeper() is called, a background thread removes the expired OTPs every sweep_interval seconds, so the OTPs of abandoned logins do not pile up.
+class OTPStore(ABC):
+    def __init__(self, expiry_minutes: float = OTP_EXPIRY_MINUTES, max_entries: int = OTP_MAX_ENTRIES, sweep_interval: float = OTP_SWEEP_INTERVAL):
+        self.expiry_minutes = expiry_minutes
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self.swept = 0
+        self.evicted = 0
+        self._sweeper = None
+
+    #Sets the OTP for the user's email address. It replaces the previous OTP of the user.
+    @abstractmethod
+    def set_otp(self, email: str, otp: str, expiry_minutes: float | None = None):
+        ...
 
-    @classmethod
     #Verifies the OTP for the user's email address.
     #Returns the status of the operation.
-    #If there is no corresponding entry in the otps dictionary, it returns "OTP not found".
+    #If there is no OTP for the email address, it returns "OTP not found".
     #If the OTP is expired, it clears the OTP and returns "OTP has expired!".
     #If the OTP is correct, it clears the OTP and returns "OTP verified".
     #If the OTP is incorrect, it returns "Invalid OTP!".
-    def verify_otp(cls, email, entered_otp):
-        data = cls.otps.get(email)
-        if not data:
-            return "OTP not found"
-        otp, expiry_time = data
-        if datetime.now() > expiry_time:
-            cls.clear(email)
-            return "OTP has expired!"
-        if otp == entered_otp:
-            cls.clear(email)
-            return "OTP verified"
-        return "Invalid OTP!"
-
-    @classmethod
+    @abstractmethod
+    def verify_otp(self, email: str, entered_otp: str) -> str:
+        ...
+
     #Clears the OTP for the user's email address.
-    def clear(cls, email):
-        cls.otps.pop(email, None)
+    @abstractmethod
+    def clear(self, email: str):
+        ...
+
+    #Removes the expired OTPs. Returns the number of OTPs removed.
+    @abstractmethod
+    def sweep(self) -> int:
+        ...
+
+    #Number of OTPs in the store
+    @abstractmethod
+    def __len__(self):
+        ...
+
+    #Starts the background thread that removes the expired OTPs. It is started once, by the store that is used.
+    def start_sweeper(self):
+        if self._sweeper is None:
+            self._sweeper = threading.Thread(target=self._sweep_forever, name="otp-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.swept += self.sweep()
+            except Exception as e:
+                print(f"Error removing the expired OTPs: {e}")
+
+    #Returns the number of OTPs in the store and how many were removed
+    def stats(self) -> dict:
+        return {
+            "backend": type(self).__name__,
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "swept": self.swept,
+            "evicted": self.evicted,
+        }
+
+
+#OTP store kept in the memory of the server process.
+#The expiration times are also kept in a min-heap, so the sweeper only looks at the OTPs that have expired.
+#A heap entry whose OTP was replaced or cleared is skipped when it is popped.
+class MemoryOTPStore(OTPStore):
+    def __init__(self, **kwargs):
+        self.otps = {}  # email -> (OTP, expiration time)
+        self._heap = []  # (expiration time, email)
+        self._lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def set_otp(self, email, otp, expiry_minutes=None):
+        expiry_time = datetime.now() + timedelta(minutes=expiry_minutes or self.expiry_minutes)
+        with self._lock:
+            if email not in self.otps and len(self.otps) >= self.max_entries:
+                self._pop_expired(datetime.now())
+                while len(self.otps) >= self.max_entries:
+                    self._pop_oldest()
+                    self.evicted += 1
+            self.otps[email] = (otp, expiry_time)
+            heapq.heappush(self._heap, (expiry_time, email))
+            #The heap keeps the entries of replaced OTPs until they expire, so it is rebuilt if they pile up
+            if len(self._heap) > 2 * len(self.otps) + 64:
+                self._heap = [(expiry, key) for key, (_, expiry) in self.otps.items()]
+                heapq.heapify(self._heap)
+
+    def verify_otp(self, email, entered_otp):
+        with self._lock:
+            data = self.otps.get(email)
+            if not data:
+                return OTP_NOT_FOUND
+            otp, expiry_time = data
+            if datetime.now() > expiry_time:
+                self.otps.pop(email, None)
+                return OTP_EXPIRED
+            if otp == entered_otp:
+                self.otps.pop(email, None)
+                return OTP_VERIFIED
+            return OTP_INVALID
+
+    def clear(self, email):
+        with self._lock:
+            self.otps.pop(email, None)
+
+    def sweep(self):
+        with self._lock:
+            return self._pop_expired(datetime.now())
+
+    def __len__(self):
+        return len(self.otps)
+
+    #Removes the OTPs that expired before now. The lock must be held.
+    def _pop_expired(self, now: datetime) -> int:
+        removed = 0
+        while self._heap and self._heap[0][0] <= now:
+            expiry_time, email = heapq.heappop(self._heap)
+            if email in self.otps and self.otps[email][1] == expiry_time:
+                del self.otps[email]
+                removed += 1
+        return removed
+
+    #Removes the OTP closest to expiry. The lock must be held.
+    def _pop_oldest(self):
+        while self._heap:
+            expiry_time, email = heapq.heappop(self._heap)
+            if email in self.otps and self.otps[email][1] == expiry_time:
+                del self.otps[email]
+                return
+
+
+#OTP store kept in the otp_codes table of the database, so that all the server processes see the same OTPs.
+class DatabaseOTPStore(OTPStore):
+    def set_otp(self, email, otp, expiry_minutes=None):
+        expiry_time = datetime.now() + timedelta(minutes=expiry_minutes or self.expiry_minutes)
+        with SessionLocal() as db:
+            if db.get(OTPCode, email) is None and self._count(db) >= self.max_entries:
+                db.execute(delete(OTPCode).where(OTPCode.expires_at <= datetime.now()))
+                overflow = self._count(db) - self.max_entries + 1
+                if overflow > 0:
+                    oldest = select(OTPCode.email).order_by(OTPCode.expires_at).limit(overflow)
+                    db.execute(delete(OTPCode).where(OTPCode.email.in_(oldest)))
+                    self.evicted += overflow
+            db.merge(OTPCode(email=email, otp=otp, expires_at=expiry_time))
+            db.commit()
+
+    def verify_otp(self, email, entered_otp):
+        with SessionLocal() as db:
+            code = db.get(OTPCode, email)
+            if code is None:
+                return OTP_NOT_FOUND
+            if datetime.now() > code.expires_at:
+                db.delete(code)
+                db.commit()
+                return OTP_EXPIRED
+            if code.otp == entered_otp:
+                #Only the process that deletes the OTP verifies it, so an OTP cannot be used twice
+                deleted = db.execute(delete(OTPCode).where(OTPCode.email == email, OTPCode.otp == entered_otp)).rowcount
+                db.commit()
+                return OTP_VERIFIED if deleted else OTP_NOT_FOUND
+            return OTP_INVALID
+
+    def clear(self, email):
+        with SessionLocal() as db:
+            db.execute(delete(OTPCode).where(OTPCode.email == email))
+            db.commit()
+
+    def sweep(self):
+        with SessionLocal() as db:
+            removed = db.execute(delete(OTPCode).where(OTPCode.expires_at <= datetime.now())).rowcount
+            db.commit()
+            return removed
+
+    def __len__(self):
+        with SessionLocal() as db:
+            return self._count(db)
+
+    @staticmethod
+    def _count(db) -> int:
+        return db.query(OTPCode).count()
+
+
+#This function creates the OTP store selected in the settings and starts its sweeper
+def create_otp_store(backend: str = OTP_STORE_BACKEND) -> OTPStore:
+    if backend == "memory":
+        store = MemoryOTPStore()
+    elif backend == "database":
+        store = DatabaseOTPStore()
+    else:
+        raise ValueError(f"Unknown OTP store: {backend}")
+    store.start_sweeper()
+    return store
+
+
+#The OTP store shared by the whole backend process
+otp_store = create_otp_store()
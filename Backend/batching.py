@@ -0,0 +1,122 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from dotenv import load_dotenv
+
+#Load the environment variables that store the settings of the batching
+load_dotenv()
+
+#Settings of the micro-batching of the model calls. They can be overridden in the .env file.
+BATCHING_ENABLED = os.getenv("BATCHING_ENABLED", "true").lower() == "true"
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "32"))  # texts embedded in one forward pass
+EMBEDDING_BATCH_MAX_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_MAX_WAIT_MS", "2"))  # milliseconds to wait for more texts
+RERANK_BATCH_MAX_SIZE = int(os.getenv("RERANK_BATCH_MAX_SIZE", "64"))  # (query, chunk) pairs scored in one forward pass
+RERANK_BATCH_MAX_WAIT_MS = float(os.getenv("RERANK_BATCH_MAX_WAIT_MS", "2"))  # milliseconds to wait for more pairs
+
+#Upper bounds of the buckets of the batch size and queue depth histograms
+HISTOGRAM_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+#Class that counts how many observed values fall in each bucket
+class Histogram:
+    def __init__(self, buckets: tuple = HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket counts the values above the largest bound
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        labels = [f"<={bound}" for bound in self.buckets] + [f">{self.buckets[-1]}"]
+        return {
+            "buckets": dict(zip(labels, self.counts)),
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+        }
+
+
+#Class that groups the items submitted by concurrent requests into batches and runs one model call per batch.
+#A background thread waits for the first item, then collects more items for at most max_wait_ms or until max_batch_size items are collected,
+#calls process_batch once with all the items and hands every result back to the request that submitted the item.
+#The requests call it from the threadpool, so they simply block until their results are ready.
+class MicroBatcher:
+    def __init__(self, name: str, process_batch, max_batch_size: int, max_wait_ms: float):
+        self.name = name
+        self.process_batch = process_batch  # function that takes a list of items and returns a list with one result per item
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self.batch_sizes = Histogram()
+        self.queue_depths = Histogram()
+        self._thread = threading.Thread(target=self._run, name=f"{name}-batcher", daemon=True)
+        self._thread.start()
+
+    #Adds the items to the queue and returns one future per item
+    def submit(self, items: list) -> list[Future]:
+        futures = []
+        for item in items:
+            future = Future()
+            self._queue.put((item, future))
+            futures.append(future)
+        return futures
+
+    #Adds the items to the queue and waits for their results
+    def run(self, items: list) -> list:
+        return [future.result() for future in self.submit(items)]
+
+    #Returns the number of items waiting to be processed
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    #Collects the next batch: blocks until the first item arrives, then waits at most max_wait for more items
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    #Runs in the background thread for the lifetime of the process
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            with self._stats_lock:
+                self.batch_sizes.observe(len(batch))
+                self.queue_depths.observe(self._queue.qsize())
+
+            items = [item for item, _ in batch]
+            try:
+                results = self.process_batch(items)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    #Returns the batch size and queue depth histograms
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "queue_depth": self.queue_depth(),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "batch_size": self.batch_sizes.snapshot(),
+                "queue_depth_at_dispatch": self.queue_depths.snapshot(),
+            }
@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+
+#Default tolerance of the comparison with a baseline: a benchmark regresses if its p95 latency is more than 20% higher or its throughput more than 20% lower
+DEFAULT_TOLERANCE = 0.2
+
+
+#This function returns the q-th percentile (0-100) of sorted values, interpolating between the two closest values
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+#This function summarizes the durations of a benchmark, in seconds, measured during `elapsed` seconds.
+#The latencies are given in milliseconds, the throughput in operations per second.
+def summarize(durations: list[float], elapsed: float, errors: int = 0) -> dict:
+    values = sorted(durations)
+    return {
+        "count": len(values),
+        "errors": errors,
+        "throughput_per_s": len(values) / elapsed if elapsed > 0 else 0.0,
+        "mean_ms": sum(values) / len(values) * 1000 if values else 0.0,
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+    }
+
+
+#Class that collects the durations and the errors of the operations of a benchmark, by operation name
+class Recorder:
+    def __init__(self):
+        self.durations = {}
+        self.errors = {}
+        self.started = time.perf_counter()
+        self.elapsed = None
+
+    def add(self, name: str, seconds: float):
+        self.durations.setdefault(name, []).append(seconds)
+
+    def error(self, name: str, detail: str = ""):
+        self.errors[name] = self.errors.get(name, 0) + 1
+        if detail:
+            print(f"{name} failed: {detail}")
+
+    #Measures the duration of an operation, for example: with recorder.measure("search"): ...
+    #An exception counts as an error of the operation and is not raised again.
+    def measure(self, name: str):
+        return Measure(self, name)
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.started
+
+    #Returns the summary of every operation. The throughput is the number of operations divided by the duration of the whole benchmark.
+    def summary(self) -> dict:
+        elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self.started
+        names = list(self.durations) + [name for name in self.errors if name not in self.durations]
+        return {name: summarize(self.durations.get(name, []), elapsed, self.errors.get(name, 0)) for name in names}
+
+
+#Context manager returned by Recorder.measure
+class Measure:
+    def __init__(self, recorder: Recorder, name: str):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc is None:
+            self.recorder.add(self.name, time.perf_counter() - self.started)
+            return False
+        self.recorder.error(self.name, repr(exc))
+        return True
+
+
+#This function measures a synchronous function `repeat` times and returns the summary of its durations
+def time_calls(function, repeat: int, *args) -> dict:
+    durations = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        call_started = time.perf_counter()
+        function(*args)
+        durations.append(time.perf_counter() - call_started)
+    return summarize(durations, time.perf_counter() - started)
+
+
+#This function returns the commit of the repository, to record which version of the code was measured
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+#This function compares the results with a baseline and returns the regressions found.
+#Only the benchmarks present in both are compared. Benchmarks with errors in the results are always reported.
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> list[str]:
+    regressions = []
+    for name, result in results["results"].items():
+        if result["errors"]:
+            regressions.append(f"{name}: {result['errors']} errors")
+        reference = baseline["results"].get(name)
+        if reference is None or not reference["count"]:
+            continue
+        if result["p95_ms"] > reference["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {result['p95_ms']:.1f}ms, baseline {reference['p95_ms']:.1f}ms")
+        if result["throughput_per_s"] < reference["throughput_per_s"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {result['throughput_per_s']:.1f}/s, baseline {reference['throughput_per_s']:.1f}/s")
+    return regressions
+
+
+#This function adds the arguments shared by the benchmarks: where to write the results and which baseline to compare them with
+def add_output_arguments(parser):
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="JSON results of an earlier run. The script exits with status 1 if a benchmark regressed.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="allowed regression of the p95 latency and of the throughput, as a fraction")
+
+
+#This function prints the results, writes them to --output and compares them with --baseline.
+#It exits with status 1 if a benchmark regressed, so that it can be used in CI.
+def finish(benchmark: str, settings: dict, results: dict, args):
+    report = {
+        "benchmark": benchmark,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()}, {os.cpu_count()} CPUs",
+        "settings": settings,
+        "results": results,
+    }
+
+    print(f"{'benchmark':<28} {'count':>7} {'errors':>6} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, result in results.items():
+        print(f"{name:<28} {result['count']:>7} {result['errors']:>6} {result['throughput_per_s']:>9.1f} "
+              f"{result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} {result['p99_ms']:>9.1f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(report, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions compared to {args.baseline} (commit {baseline.get('commit')}):")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"No regression compared to {args.baseline} (commit {baseline.get('commit')}).")
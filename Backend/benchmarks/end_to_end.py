@@ -0,0 +1,222 @@
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import httpx
+from smtp_stand_in import SMTPStandIn
+from bench_results import Recorder, add_output_arguments, finish
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+BACKEND_PATH = os.path.dirname(BENCHMARKS_PATH)
+
+#Questions sent by the simulated users, and the keyword they search for afterwards
+QUESTIONS = [
+    "What is the minimum IELTS score required for MSc application?",
+    "What are the tuition fees for international students?",
+    "Which professors work on reinforcement learning?",
+    "What documents do I need for the PhD application?",
+]
+SEARCH_KEYWORD = "tuition"
+
+
+#This function starts a process and returns it. Its output goes to the output of the benchmark, so that errors of the backend can be seen.
+def start_process(command: list[str], env: dict, cwd: str) -> subprocess.Popen:
+    return subprocess.Popen(command, env={**os.environ, **env}, cwd=cwd)
+
+
+#This function waits until a server answers, or raises a RuntimeError after timeout seconds
+async def wait_until_ready(url: str, process: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{url} exited with status {process.returncode}")
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.5)
+    raise RuntimeError(f"{url} did not start in {timeout} seconds")
+
+
+#Class for one run of the benchmark: the simulated users go through the flows of the app against a backend started for the run
+class EndToEndBenchmark:
+    def __init__(self, base_url: str, smtp: SMTPStandIn, recorder: Recorder, messages: int, stream: bool):
+        self.base_url = base_url
+        self.smtp = smtp
+        self.recorder = recorder
+        self.messages = messages
+        self.stream = stream
+        self.run_id = uuid.uuid4().hex[:8]
+
+    #Sends a request and records its duration under name. Returns the response, or None if it failed.
+    async def call(self, client: httpx.AsyncClient, name: str, method: str, url: str, **kwargs) -> httpx.Response | None:
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self.recorder.error(name, repr(e))
+            return None
+        if response.status_code >= 400:
+            self.recorder.error(name, f"HTTP {response.status_code}: {response.text[:200]}")
+            return None
+        self.recorder.add(name, time.perf_counter() - started)
+        return response
+
+    #Sends a message with /messages/send-stream and records the time to the first token and to the end of the answer
+    async def send_streamed(self, client: httpx.AsyncClient, conversation_id: int, question: str) -> bool:
+        started = time.perf_counter()
+        first_token = None
+        try:
+            async with client.stream("POST", "/messages/send-stream", json={"conversation_id": conversation_id, "sender": "user", "message": question}) as response:
+                if response.status_code >= 400:
+                    self.recorder.error("chat_stream", f"HTTP {response.status_code}")
+                    return False
+                async for line in response.aiter_lines():
+                    event = json.loads(line) if line else {}
+                    if event.get("type") == "token" and first_token is None:
+                        first_token = time.perf_counter() - started
+                    elif event.get("type") == "error":
+                        self.recorder.error("chat_stream", event.get("detail", ""))
+                        return False
+        except httpx.HTTPError as e:
+            self.recorder.error("chat_stream", repr(e))
+            return False
+        if first_token is not None:
+            self.recorder.add("chat_first_token", first_token)
+        self.recorder.add("chat_stream", time.perf_counter() - started)
+        return True
+
+    #Flow of one user: register, log in with an OTP, chat, list the conversations and messages, search, and export
+    async def user_flow(self, client: httpx.AsyncClient, idx: int):
+        email = f"bench-{self.run_id}-{idx}@example.com"
+        password = f"password-{idx}"
+        if not await self.call(client, "register", "POST", "/register", json={"first_name": "Bench", "last_name": str(idx), "email": email, "password": password}):
+            return
+
+        #The OTP email is expected before it is requested, so that it cannot arrive first
+        email_future = self.smtp.expect(email)
+        requested = time.perf_counter()
+        if not await self.call(client, "request_otp", "POST", "/request-otp", json={"email": email, "password": password}):
+            email_future.cancel()
+            return
+        try:
+            otp = await self.smtp.wait_for_otp(email_future)
+        except (asyncio.TimeoutError, ValueError) as e:
+            self.recorder.error("otp_delivery", repr(e))
+            return
+        self.recorder.add("otp_delivery", time.perf_counter() - requested)
+        if not await self.call(client, "verify_otp", "POST", "/verify-otp", json={"email": email, "otp": otp}):
+            return
+
+        response = await self.call(client, "create_conversation", "POST", "/conversations", params={"user_id": email})
+        if not response:
+            return
+        conversation_id = response.json()["conversation_id"]
+
+        for turn in range(self.messages):
+            question = QUESTIONS[(idx + turn) % len(QUESTIONS)]
+            if self.stream:
+                sent = await self.send_streamed(client, conversation_id, question)
+            else:
+                sent = await self.call(client, "chat_send", "POST", "/messages/send", json={"conversation_id": conversation_id, "sender": "user", "message": question})
+            if not sent:
+                return
+
+        await self.call(client, "list_conversations", "GET", f"/conversations/{email}", params={"limit": 20})
+        await self.call(client, "list_messages", "GET", f"/messages/{conversation_id}", params={"limit": 50})
+        await self.call(client, "search", "GET", f"/search-conversations/{email}", params={"q": SEARCH_KEYWORD})
+        await self.call(client, "export_conversation", "GET", f"/conversations/{conversation_id}/messages", params={"format": "txt"})
+        await self.call(client, "export_all", "GET", f"/export-conversations/{email}")
+
+    #Runs the flows of `users` users, with at most `concurrency` users at the same time
+    async def run(self, users: int, concurrency: int, timeout: float):
+        semaphore = asyncio.Semaphore(concurrency)
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=timeout, limits=limits) as client:
+            async def limited(idx):
+                async with semaphore:
+                    with self.recorder.measure("user_flow"):
+                        await self.user_flow(client, idx)
+
+            self.recorder.started = time.perf_counter()
+            await asyncio.gather(*(limited(idx) for idx in range(users)))
+            self.recorder.stop()
+
+
+#This script benchmarks the backend end to end, the way the app uses it.
+#It starts a stand-in for Ollama with a fixed generation speed, an SMTP stand-in that catches the OTP emails, and the backend itself with a fresh database,
+#then runs the flows of the simulated users: register, request and verify an OTP, chat, list, search and export.
+#The embedding model, the cross-encoder and the vector store are the real ones, so the retrieval is measured as well.
+#Example: python benchmarks/end_to_end.py --users 50 --concurrency 10 --stream --output results.json --baseline baseline.json
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the backend end to end with stand-ins for Ollama and the SMTP server.")
+    parser.add_argument("--users", type=int, default=20, help="number of simulated users")
+    parser.add_argument("--concurrency", type=int, default=5, help="users running at the same time")
+    parser.add_argument("--messages", type=int, default=3, help="messages sent by every user")
+    parser.add_argument("--stream", action="store_true", help="send the messages with /messages/send-stream instead of /messages/send")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="generation speed of the Ollama stand-in")
+    parser.add_argument("--answer-tokens", type=int, default=120, help="length of the answers of the Ollama stand-in")
+    parser.add_argument("--prompt-eval-ms", type=float, default=100, help="prompt evaluation time of the Ollama stand-in")
+    parser.add_argument("--replay", help="NDJSON file recorded from Ollama, replayed by the stand-in")
+    parser.add_argument("--port", type=int, default=8765, help="port of the backend")
+    parser.add_argument("--ollama-port", type=int, default=11435, help="port of the Ollama stand-in")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="setting passed to the backend, for example --env CHAT_WRITE_BEHIND=true")
+    parser.add_argument("--startup-timeout", type=float, default=300, help="seconds to wait for the backend to load its models")
+    parser.add_argument("--request-timeout", type=float, default=120)
+    add_output_arguments(parser)
+    args = parser.parse_args()
+
+    async def run():
+        smtp = SMTPStandIn()
+        await smtp.start()
+        data_dir = tempfile.mkdtemp(prefix="chatbot-bench-")
+        backend_env = {
+            "DATABASE_URL": f"sqlite:///{os.path.join(data_dir, 'bench.db')}",
+            "OLLAMA_BASE_URL": f"http://127.0.0.1:{args.ollama_port}",
+            "EMAIL_HOST": "127.0.0.1",
+            "EMAIL_PORT": str(smtp.port),
+            "EMAIL_START_TLS": "false",
+            "EMAIL_USER": "bench@example.com",
+            "EMAIL_PASSWORD": "bench",
+            "OTP_IP_LIMIT": str(10 ** 9),  # every simulated user comes from 127.0.0.1
+            "LLM_KEEP_WARM_HOURS": "",
+            "LLM_LOG_TIMINGS": "false",
+            #The simulated users ask the same few questions, so with the semantic cache most answers would skip the retrieval and Ollama.
+            #It is off unless --env SEMANTIC_CACHE_ENABLED=true is given, to measure the cache on purpose.
+            "SEMANTIC_CACHE_ENABLED": "false",
+            **dict(setting.split("=", 1) for setting in args.env),
+        }
+        ollama_command = [sys.executable, os.path.join(BENCHMARKS_PATH, "mock_ollama.py"), "--port", str(args.ollama_port),
+                          "--tokens-per-second", str(args.tokens_per_second), "--answer-tokens", str(args.answer_tokens), "--prompt-eval-ms", str(args.prompt_eval_ms)]
+        if args.replay:
+            ollama_command += ["--replay", os.path.abspath(args.replay)]
+        ollama = start_process(ollama_command, {}, BENCHMARKS_PATH)
+        backend = start_process([sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning"], backend_env, BACKEND_PATH)
+
+        try:
+            base_url = f"http://127.0.0.1:{args.port}"
+            await wait_until_ready(f"http://127.0.0.1:{args.ollama_port}/docs", ollama, 30)
+            await wait_until_ready(f"{base_url}/openapi.json", backend, args.startup_timeout)
+            recorder = Recorder()
+            await EndToEndBenchmark(base_url, smtp, recorder, args.messages, args.stream).run(args.users, args.concurrency, args.request_timeout)
+            return recorder.summary()
+        finally:
+            for process in (backend, ollama):
+                process.terminate()
+                process.wait()
+            await smtp.aclose()
+
+    results = asyncio.run(run())
+    settings = {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "tolerance")}
+    finish("end_to_end", settings, results, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import itertools
+from bench_results import Recorder, time_calls, add_output_arguments, finish
+from end_to_end import QUESTIONS, SEARCH_KEYWORD, BACKEND_PATH
+
+RAG_PATH = os.path.join(os.path.dirname(BACKEND_PATH), "RAG Implementation")
+
+#Groups of microbenchmarks that can be selected with --only
+BENCHMARK_GROUPS = ["sqlite", "retrieval", "chunking", "ingestion"]
+
+#Words of the synthetic messages. The search keyword is one of them, so the searches find conversations.
+WORDS = ["admission", "deadline", "scholarship", "course", "thesis", "professor", "visa", "campus", "credit", "exam", SEARCH_KEYWORD]
+
+
+#This function returns a synthetic text of n_words random words
+def synthetic_text(rng: random.Random, n_words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+
+#This function fills the database with synthetic users, conversations and messages, and returns the user ids and the conversations (id, title) of the first user
+def populate_database(users: int, conversations: int, messages: int, seed: int = 0):
+    from database import SessionLocal, User, Conversation, Message
+
+    rng = random.Random(seed)
+    with SessionLocal() as db:
+        user_ids = [f"bench-{idx}@example.com" for idx in range(users)]
+        db.add_all([User(first_name="Bench", last_name=str(idx), email=user_id, password="x") for idx, user_id in enumerate(user_ids)])
+        db.commit()
+        for user_id in user_ids:
+            convos = [Conversation(user_id=user_id, title=f"Conversation {idx}") for idx in range(conversations)]
+            db.add_all(convos)
+            db.flush()
+            db.add_all([
+                Message(conversation_id=convo.id, sender="user" if idx % 2 == 0 else "bot", message=synthetic_text(rng, 40))
+                for convo in convos for idx in range(messages)
+            ])
+            db.commit()
+        first_user = db.query(Conversation.id, Conversation.title).filter(Conversation.user_id == user_ids[0]).all()
+    return user_ids, first_user
+
+
+#This function measures the SQLite queries behind the conversation list, the chat, the search and the exports
+def bench_sqlite(args, results: dict):
+    from fastapi import Response
+    from sqlalchemy import func
+    import message_search
+    from database import SessionLocal, Conversation, Message
+    from pagination import keyset_page, NEXT_CURSOR_HEADER
+    from conversation_export import stream_conversation, stream_user_archive
+
+    user_ids, conversations = populate_database(args.users, args.conversations, args.messages)
+    user_id = user_ids[0]
+    conversation_id, title = conversations[0]
+    print(f"Database filled with {args.users} users, {args.users * args.conversations} conversations and {args.users * args.conversations * args.messages} messages.")
+
+    with SessionLocal() as db:
+        def conversations_page(cursor=None):
+            query = db.query(Conversation.id, Conversation.title, Conversation.created_at, Conversation.updated_at).filter(Conversation.user_id == user_id)
+            return keyset_page(query, Conversation.updated_at, Conversation.id, 20, cursor, Response())
+
+        def messages_page(cursor=None):
+            response = Response()
+            query = db.query(Message.id, Message.sender, Message.message, Message.timestamp).filter(Message.conversation_id == conversation_id)
+            keyset_page(query, Message.timestamp, Message.id, 10, cursor, response)
+            return response.headers.get(NEXT_CURSOR_HEADER)
+
+        results["sqlite_conversations_page"] = time_calls(conversations_page, args.repeat)
+        results["sqlite_messages_page"] = time_calls(messages_page, args.repeat)
+        results["sqlite_messages_older_page"] = time_calls(messages_page, args.repeat, messages_page())
+        results["sqlite_search_fts"] = time_calls(message_search.search_conversations, args.repeat, db, user_id, SEARCH_KEYWORD, 50, 0)
+        results["sqlite_search_scan"] = time_calls(message_search.scan_conversations, args.repeat, db, user_id, SEARCH_KEYWORD, 50, 0)
+        results["sqlite_count_messages"] = time_calls(lambda: db.query(func.count(Message.id)).filter(Message.conversation_id == conversation_id).scalar(), args.repeat)
+
+    results["sqlite_export_conversation"] = time_calls(lambda: sum(map(len, stream_conversation(SessionLocal, conversation_id, title, "txt"))), args.repeat)
+    results["sqlite_export_archive"] = time_calls(lambda: sum(map(len, stream_user_archive(SessionLocal, user_id, "txt"))), max(args.repeat // 10, 1))
+
+
+#This function measures the retrieval on the vector store of the Backend: the embedding of the query, the dense and BM25 search, and the re-ranking.
+#The caches are off unless --warm is given, so every call does the work.
+def bench_retrieval(args, results: dict):
+    from data_retrieval_from_RAG import RetrieverEngine, embed_query, query_collection, re_rank_cross_encoders, retrieve_relevant_chunks
+
+    RetrieverEngine.get_instance().warmup()
+    questions = itertools.cycle(QUESTIONS)
+    candidates = {question: query_collection(question) for question in QUESTIONS}
+
+    def re_rank():
+        question = next(questions)
+        documents, metadatas, ids, distances = candidates[question]
+        return re_rank_cross_encoders(documents, metadatas, question, ids, distances)
+
+    results["retrieval_embed_query"] = time_calls(lambda: embed_query(next(questions)), args.repeat)
+    results["retrieval_query_collection"] = time_calls(lambda: query_collection(next(questions)), args.repeat)
+    results["retrieval_re_rank"] = time_calls(re_rank, args.repeat)
+    results["retrieval_full"] = time_calls(lambda: retrieve_relevant_chunks(next(questions)), args.repeat)
+
+
+#This function returns the scraped pages to chunk: the pages of --pages if given, or synthetic pages otherwise
+def load_pages(args) -> dict:
+    if args.pages:
+        pages = {}
+        for file_name in sorted(os.listdir(args.pages)):
+            if file_name.endswith(".json") and file_name != "changes.json" and file_name != "fetch_cache.json":
+                with open(os.path.join(args.pages, file_name), "r", encoding="utf-8") as f:
+                    pages[file_name[:-5]] = json.load(f)
+        return pages
+    rng = random.Random(0)
+    return {
+        f"page_{idx}": {
+            "Headings": "\n".join(synthetic_text(rng, 5) for _ in range(10)),
+            "Paragraphs": "\n".join(synthetic_text(rng, 60) for _ in range(40)),
+            "Lists": "\n".join(synthetic_text(rng, 8) for _ in range(30)),
+            "Tables": "\n\n".join("\n".join(" | ".join(synthetic_text(rng, 1) for _ in range(4)) for _ in range(20)) for _ in range(3)),
+        }
+        for idx in range(args.synthetic_pages)
+    }
+
+
+#This function measures how fast the scraped pages are split into chunks, one page per operation
+def bench_chunking(args, results: dict):
+    from html_ingestion import chunk_sections
+
+    pages = load_pages(args)
+    recorder = Recorder()
+    chunks = 0
+    for _ in range(args.rounds):
+        for name, sections in pages.items():
+            with recorder.measure("chunking_page"):
+                chunks += sum(1 for _ in chunk_sections(name, sections))
+    recorder.stop()
+    results.update(recorder.summary())
+    print(f"{chunks / recorder.elapsed:.0f} chunks per second.")
+
+
+#This function measures the ingestion throughput: synthetic chunks are embedded and upserted into a temporary collection, one batch per operation
+def bench_ingestion(args, results: dict):
+    from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
+    from ingestion import embed_and_upsert
+    from vector_store import open_collection
+    from data_retrieval_from_RAG import EMBEDDING_MODEL_NAME
+
+    rng = random.Random(0)
+    chroma_path = tempfile.mkdtemp(prefix="chatbot-bench-chroma-")
+    try:
+        embedding_function = SentenceTransformerEmbeddingFunction(model_name=EMBEDDING_MODEL_NAME)
+        collection = open_collection(chroma_path, embedding_function)
+        recorder = Recorder()
+        for batch in range(args.ingest_batches):
+            ids = [f"bench_{batch}_{idx}" for idx in range(args.batch_size)]
+            documents = [synthetic_text(rng, 100) for _ in ids]
+            with recorder.measure("ingestion_batch"):
+                embed_and_upsert(collection, embedding_function, ids, documents, [{"source": "benchmark"}] * len(ids))
+        recorder.stop()
+        results.update(recorder.summary())
+        print(f"{args.ingest_batches * args.batch_size / recorder.elapsed:.0f} chunks ingested per second.")
+    finally:
+        shutil.rmtree(chroma_path, ignore_errors=True)
+
+
+#This script runs the microbenchmarks of the parts of the backend that the end-to-end benchmark only measures together:
+# - sqlite: the pages of conversations and messages, the full-text search and the scan it falls back to, and the exports, on a database of synthetic conversations
+# - retrieval: query_collection and re_rank_cross_encoders on the vector store of the Backend, with the caches off unless --warm is given
+# - chunking: the splitting of the scraped pages into chunks, on the pages of --pages or synthetic pages
+# - ingestion: the embedding and upsert of synthetic chunks into a temporary collection
+#The settings of the backend are read from the environment as usual, so a setting can be compared by running the script twice.
+#Example: python benchmarks/microbenchmarks.py --only sqlite chunking --output micro.json --baseline micro-baseline.json
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the SQLite queries, the retrieval and the ingestion.")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARK_GROUPS, default=BENCHMARK_GROUPS, help="groups of benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=200, help="calls measured per benchmark")
+    parser.add_argument("--warm", action="store_true", help="keep the retrieval caches on")
+    parser.add_argument("--users", type=int, default=20, help="synthetic users in the database")
+    parser.add_argument("--conversations", type=int, default=50, help="synthetic conversations per user")
+    parser.add_argument("--messages", type=int, default=40, help="synthetic messages per conversation")
+    parser.add_argument("--pages", help="folder of pages scraped by 'Dataset Extraction/scrap.py' to chunk")
+    parser.add_argument("--synthetic-pages", type=int, default=50, help="synthetic pages to chunk when --pages is not given")
+    parser.add_argument("--rounds", type=int, default=5, help="times every page is chunked")
+    parser.add_argument("--ingest-batches", type=int, default=10, help="batches of chunks ingested")
+    parser.add_argument("--batch-size", type=int, default=256, help="chunks per ingested batch")
+    add_output_arguments(parser)
+    args = parser.parse_args()
+    if args.pages:
+        args.pages = os.path.abspath(args.pages)
+
+    #The settings are read when the modules of the Backend are imported, so they are set first.
+    #The database is a fresh file, and the relative paths of the vector store are resolved from the Backend folder.
+    data_dir = tempfile.mkdtemp(prefix="chatbot-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(data_dir, 'bench.db')}"
+    if not args.warm:
+        for setting in ("EMBEDDING_CACHE_MAX_ENTRIES", "SEARCH_CACHE_MAX_ENTRIES", "SCORE_CACHE_MAX_ENTRIES"):
+            os.environ[setting] = "0"
+    os.chdir(BACKEND_PATH)
+    sys.path += [BACKEND_PATH, RAG_PATH]
+
+    benchmarks = {"sqlite": bench_sqlite, "retrieval": bench_retrieval, "chunking": bench_chunking, "ingestion": bench_ingestion}
+    results = {}
+    try:
+        for group in args.only:
+            print(f"Running the {group} benchmarks...")
+            benchmarks[group](args, results)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    settings = {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "tolerance")}
+    finish("microbenchmarks", settings, results, args)
+
+
+if __name__ == "__main__":
+    main()
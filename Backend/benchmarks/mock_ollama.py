@@ -0,0 +1,99 @@
+import json
+import time
+import asyncio
+import argparse
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+#Default settings of the stand-in
+TOKENS_PER_SECOND = 50.0
+ANSWER_TOKENS = 120
+PROMPT_EVAL_MS = 100.0  # time spent evaluating the prompt before the first token
+
+
+#Class for the answers of the stand-in. The tokens are either generated, or replayed from a file of NDJSON lines recorded from Ollama.
+class AnswerSource:
+    def __init__(self, replay_file: str | None = None, answer_tokens: int = ANSWER_TOKENS):
+        self.tokens = []
+        if replay_file:
+            with open(replay_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    data = json.loads(line) if line.strip() else {}
+                    if data.get("message", {}).get("content"):
+                        self.tokens.append(data["message"]["content"])
+        if not self.tokens:
+            self.tokens = [f"word{idx % 50} " for idx in range(answer_tokens)]
+
+
+#This function creates the FastAPI app of a stand-in for the chat API of Ollama.
+#It answers like Ollama: one JSON object per line when streaming, with the timings of the answer in the last line, and a single JSON object otherwise.
+#The first token comes after prompt_eval_ms, then tokens_per_second tokens are sent every second.
+#A request without messages only loads the model, as in Ollama.
+def create_app(source: AnswerSource, tokens_per_second: float = TOKENS_PER_SECOND, prompt_eval_ms: float = PROMPT_EVAL_MS) -> FastAPI:
+    app = FastAPI()
+    app.state.requests = 0
+
+    def final_line(model: str, prompt_tokens: int, started: float) -> dict:
+        return {
+            "model": model,
+            "message": {"role": "assistant", "content": ""},
+            "done": True,
+            "done_reason": "stop",
+            "total_duration": int((time.perf_counter() - started) * 1e9),
+            "load_duration": 0,
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prompt_eval_ms * 1e6),
+            "eval_count": len(source.tokens),
+            "eval_duration": int(len(source.tokens) / tokens_per_second * 1e9),
+        }
+
+    @app.post("/api/chat")
+    async def chat(request: Request):
+        payload = await request.json()
+        app.state.requests += 1
+        model = payload.get("model", "llama3.2")
+        started = time.perf_counter()
+        if not payload.get("messages"):
+            return JSONResponse({"model": model, "message": {"role": "assistant", "content": ""}, "done": True, "done_reason": "load"})
+
+        #The prompt size is estimated at 4 characters per token
+        prompt_tokens = sum(len(message.get("content", "")) for message in payload["messages"]) // 4
+        await asyncio.sleep(prompt_eval_ms / 1000)
+
+        if not payload.get("stream", True):
+            await asyncio.sleep(len(source.tokens) / tokens_per_second)
+            data = final_line(model, prompt_tokens, started)
+            data["message"]["content"] = "".join(source.tokens)
+            return JSONResponse(data)
+
+        async def lines():
+            for token in source.tokens:
+                yield json.dumps({"model": model, "message": {"role": "assistant", "content": token}, "done": False}) + "\n"
+                await asyncio.sleep(1 / tokens_per_second)
+            yield json.dumps(final_line(model, prompt_tokens, started)) + "\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    return app
+
+
+#This script runs the stand-in for Ollama, so that the backend can be benchmarked without a GPU and with a fixed generation speed.
+#Example: python benchmarks/mock_ollama.py --port 11435 --tokens-per-second 40
+#Then start the backend with OLLAMA_BASE_URL=http://127.0.0.1:11435
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in for the chat API of Ollama with a configurable generation speed.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--tokens-per-second", type=float, default=TOKENS_PER_SECOND)
+    parser.add_argument("--answer-tokens", type=int, default=ANSWER_TOKENS, help="length of the generated answers")
+    parser.add_argument("--prompt-eval-ms", type=float, default=PROMPT_EVAL_MS)
+    parser.add_argument("--replay", help="NDJSON file recorded from Ollama whose tokens are sent instead of generated ones")
+    args = parser.parse_args()
+
+    app = create_app(AnswerSource(args.replay, args.answer_tokens), args.tokens_per_second, args.prompt_eval_ms)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
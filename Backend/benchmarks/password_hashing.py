@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+#The benchmark imports the credential module of the Backend.
+#Importing it opens the database of the Backend, so the database is pointed at a temporary file first and chat.db is never touched.
+DATA_DIR = tempfile.mkdtemp(prefix="chatbot-bench-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(DATA_DIR, 'bench.db')}"
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from credentials import hash_password, verify_password, PASSWORD_HASH_BLOCK_SIZE, PASSWORD_HASH_PARALLELISM, PASSWORD_HASH_WORKERS
+
+
+#This function measures the login throughput for one cost: workers threads verify the same password for `seconds` seconds.
+#Returns the number of verifications per second and the average time of one verification in milliseconds.
+def measure(cost: int, workers: int, seconds: float) -> tuple[float, float]:
+    stored = hash_password("benchmark password", cost=cost)
+    #verify_password reads the settings from the stored value, so the settings of the .env file do not matter here
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        count, busy = 0, 0.0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            verify_password("benchmark password", stored)
+            busy += time.perf_counter() - start
+            count += 1
+        return count, busy
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda _: worker(), range(workers)))
+    elapsed = time.perf_counter() - start
+
+    count = sum(result[0] for result in results)
+    busy = sum(result[1] for result in results)
+    return count / elapsed, busy / max(count, 1) * 1000
+
+
+#This script prints how many logins per second each cost allows on this machine, to choose PASSWORD_HASH_COST.
+#Example: python benchmarks/password_hashing.py --costs 12 13 14 15 16 --workers 4
+def main():
+    parser = argparse.ArgumentParser(description="Measure the login throughput of the password hashing for several costs.")
+    parser.add_argument("--costs", type=int, nargs="+", default=[12, 13, 14, 15, 16], help="log2 of the scrypt N parameter")
+    parser.add_argument("--workers", type=int, default=PASSWORD_HASH_WORKERS, help="threads verifying passwords at the same time (PASSWORD_HASH_WORKERS)")
+    parser.add_argument("--seconds", type=float, default=3, help="duration of the measure of each cost")
+    args = parser.parse_args()
+
+    print(f"scrypt r={PASSWORD_HASH_BLOCK_SIZE} p={PASSWORD_HASH_PARALLELISM}, {args.workers} workers, {os.cpu_count()} CPUs")
+    print(f"{'cost':>4} {'N':>8} {'memory':>9} {'ms/login':>9} {'logins/s':>9}")
+    try:
+        for cost in args.costs:
+            throughput, latency_ms = measure(cost, args.workers, args.seconds)
+            memory_mb = 128 * 2 ** cost * PASSWORD_HASH_BLOCK_SIZE * PASSWORD_HASH_PARALLELISM / 2 ** 20
+            print(f"{cost:>4} {2 ** cost:>8} {memory_mb:>7.0f}MB {latency_ms:>9.1f} {throughput:>9.1f}")
+    finally:
+        shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
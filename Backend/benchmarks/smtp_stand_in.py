@@ -0,0 +1,137 @@
+import re
+import asyncio
+import argparse
+from email import message_from_bytes, policy
+
+#The OTP is the only 6-digit number of the OTP email
+OTP_PATTERN = re.compile(r"\b(\d{6})\b")
+
+
+#This function returns the OTP of an OTP email, or None if there is none
+def find_otp(message) -> str | None:
+    match = OTP_PATTERN.search(message.get_content())
+    return match.group(1) if match else None
+
+
+#Class for a minimal SMTP server that accepts every email and hands it to the code waiting for it.
+#It answers the commands the email queue of the backend sends (EHLO, AUTH, MAIL, RCPT, DATA, RSET, NOOP, QUIT), without TLS,
+#so the backend must run with EMAIL_START_TLS=false. Any user name and password are accepted.
+#on_email, if given, is called with the recipients and the message of every email.
+class SMTPStandIn:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, on_email=None):
+        self.host = host
+        self.port = port
+        self.on_email = on_email
+        self.received = 0
+        self.connections = 0
+        self._server = None
+        self._writers = set()  # open connections, closed by aclose
+        self._waiters = {}  # email address -> futures waiting for an email
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def aclose(self):
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+
+    #Returns a future that gets the next email sent to an address.
+    #It must be called before the email is requested, so that an email delivered at once is not missed.
+    def expect(self, address: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(address.lower(), []).append(future)
+        return future
+
+    #Waits for the email expected with expect() and returns the OTP it contains
+    async def wait_for_otp(self, future: asyncio.Future, timeout: float = 30) -> str:
+        message = await asyncio.wait_for(future, timeout)
+        otp = find_otp(message)
+        if otp is None:
+            raise ValueError(f"No OTP in the email sent to {message['To']}")
+        return otp
+
+    def _deliver(self, recipients: list[str], data: bytes):
+        message = message_from_bytes(data, policy=policy.default)
+        self.received += 1
+        if self.on_email is not None:
+            self.on_email(recipients, message)
+        for address in recipients:
+            for future in self._waiters.pop(address, []):
+                if not future.done():
+                    future.set_result(message)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self._writers.add(writer)
+
+        async def reply(line: str):
+            writer.write(f"{line}\r\n".encode())
+            await writer.drain()
+
+        await reply("220 smtp-stand-in ESMTP")
+        recipients = []
+        try:
+            while line := await reader.readline():
+                command = line.decode(errors="replace").strip()
+                verb = command.split(" ", 1)[0].upper()
+                if verb == "EHLO":
+                    writer.write(b"250-smtp-stand-in\r\n250-8BITMIME\r\n250-SMTPUTF8\r\n250 AUTH PLAIN LOGIN\r\n")
+                    await writer.drain()
+                elif verb == "HELO":
+                    await reply("250 smtp-stand-in")
+                elif verb == "AUTH":
+                    await reply("235 2.7.0 Authentication successful")
+                elif verb == "MAIL":
+                    recipients = []
+                    await reply("250 OK")
+                elif verb == "RCPT":
+                    match = re.search(r"<([^>]*)>", command)
+                    recipients.append((match.group(1) if match else command[8:]).lower())
+                    await reply("250 OK")
+                elif verb == "DATA":
+                    await reply("354 End data with <CR><LF>.<CR><LF>")
+                    lines = []
+                    while (data_line := await reader.readline()) not in (b".\r\n", b".\n", b""):
+                        lines.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                    self._deliver(recipients, b"".join(lines))
+                    await reply("250 OK queued")
+                elif verb == "QUIT":
+                    await reply("221 Bye")
+                    break
+                else:
+                    #RSET, NOOP and the other commands are accepted and ignored
+                    await reply("250 OK")
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+
+#This script runs the SMTP stand-in on its own and prints the OTP of every email it receives.
+#Example: python benchmarks/smtp_stand_in.py --port 2525
+#Then start the backend with EMAIL_HOST=127.0.0.1 EMAIL_PORT=2525 EMAIL_START_TLS=false
+def main():
+    parser = argparse.ArgumentParser(description="Minimal SMTP server that accepts every email, for benchmarks and local runs.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2525)
+    args = parser.parse_args()
+
+    def print_email(recipients, message):
+        print(f"Email to {', '.join(recipients)}: OTP {find_otp(message) or 'none'}")
+
+    async def run():
+        server = SMTPStandIn(args.host, args.port, on_email=print_email)
+        await server.start()
+        print(f"SMTP stand-in listening on {server.host}:{server.port}")
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import re
+import os
+import numpy as np
+
+#File name of the BM25 index. It is stored in the folder of the Chroma DB, next to the collection it was built from.
+BM25_INDEX_FILE = "bm25_index.npz"
+
+#Parameters of the BM25 ranking function
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+#Words and numbers. Numbers keep their thousands separators and decimals so that amounts like $11,500.00 stay one token.
+TOKEN_PATTERN = re.compile(r"\d+(?:[,.]\d+)*|[a-z0-9]+")
+
+
+#This function splits a text into lowercase tokens for the BM25 index
+#The thousands separators are removed from numbers so that "11,500" and "11500" match
+def tokenize(text: str) -> list[str]:
+    return [token.replace(",", "") for token in TOKEN_PATTERN.findall(text.lower())]
+
+
+#Class for a sparse BM25 index over the chunks of the vector collection.
+#The postings are stored in compressed sparse row form: the postings of term t are
+#doc_indices[indptr[t]:indptr[t + 1]] (positions in chunk_ids) and term_freqs[indptr[t]:indptr[t + 1]].
+#A query is scored with a few vectorized numpy operations per query term instead of a loop over the documents.
+class BM25Index:
+    def __init__(self, chunk_ids: np.ndarray, vocabulary: dict, indptr: np.ndarray, doc_indices: np.ndarray, term_freqs: np.ndarray, doc_lengths: np.ndarray):
+        self.chunk_ids = chunk_ids
+        self.vocabulary = vocabulary  # term -> row of the postings
+        self.indptr = indptr
+        self.doc_indices = doc_indices
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.average_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+        #Inverse document frequency of every term
+        doc_freqs = np.diff(indptr).astype(np.float32)
+        self.idf = np.log(1 + (len(chunk_ids) - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+        #Length normalization of every document, computed once
+        self.length_norm = (BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths / max(self.average_length, 1.0))).astype(np.float32)
+
+    @classmethod
+    #Builds the index from the ids and the texts of the chunks
+    def build(cls, chunk_ids: list[str], documents: list[str]):
+        vocabulary = {}
+        postings = []  # one {document position: term frequency} per term
+        doc_lengths = np.zeros(len(documents), dtype=np.int32)
+
+        for position, document in enumerate(documents):
+            tokens = tokenize(document)
+            doc_lengths[position] = len(tokens)
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                term = vocabulary.setdefault(token, len(vocabulary))
+                if term == len(postings):
+                    postings.append({})
+                postings[term][position] = count
+
+        indptr = np.zeros(len(postings) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(posting) for posting in postings])
+        doc_indices = np.fromiter((position for posting in postings for position in posting), dtype=np.int32, count=int(indptr[-1]))
+        term_freqs = np.fromiter((count for posting in postings for count in posting.values()), dtype=np.float32, count=int(indptr[-1]))
+        return cls(np.array(chunk_ids, dtype=str), vocabulary, indptr, doc_indices, term_freqs, doc_lengths)
+
+    @classmethod
+    #Builds the index from all the chunks stored in a Chroma collection
+    def build_from_collection(cls, collection):
+        stored = collection.get(include=["documents"])
+        return cls.build(stored["ids"], stored["documents"])
+
+    @classmethod
+    #Loads the index saved in the folder of the Chroma DB. Returns None if there is no saved index.
+    def load(cls, directory: str):
+        path = os.path.join(directory, BM25_INDEX_FILE)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            terms = data["terms"]
+            vocabulary = {str(term): row for row, term in enumerate(terms)}
+            return cls(data["chunk_ids"], vocabulary, data["indptr"], data["doc_indices"], data["term_freqs"], data["doc_lengths"])
+
+    #Saves the index in the folder of the Chroma DB
+    def save(self, directory: str):
+        terms = np.empty(len(self.vocabulary), dtype=object)
+        for term, row in self.vocabulary.items():
+            terms[row] = term
+        np.savez_compressed(
+            os.path.join(directory, BM25_INDEX_FILE),
+            chunk_ids=self.chunk_ids,
+            terms=terms.astype(str),
+            indptr=self.indptr,
+            doc_indices=self.doc_indices,
+            term_freqs=self.term_freqs,
+            doc_lengths=self.doc_lengths,
+        )
+
+    #Number of chunks in the index
+    def __len__(self):
+        return len(self.chunk_ids)
+
+    #Returns the ids of the n_results chunks with the highest BM25 score for the query, best first
+    def search(self, query: str, n_results: int) -> list[str]:
+        scores = np.zeros(len(self.chunk_ids), dtype=np.float32)
+        for token in set(tokenize(query)):
+            term = self.vocabulary.get(token)
+            if term is None:
+                continue
+            start, end = self.indptr[term], self.indptr[term + 1]
+            documents = self.doc_indices[start:end]
+            freqs = self.term_freqs[start:end]
+            #A term appears at most once in the postings of a document, so the scores can be added with fancy indexing
+            scores[documents] += self.idf[term] * freqs * (BM25_K1 + 1) / (freqs + self.length_norm[documents])
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > n_results:
+            matched = matched[np.argpartition(-scores[matched], n_results)[:n_results]]
+        best = matched[np.argsort(-scores[matched], kind="stable")]
+        return [str(chunk_id) for chunk_id in self.chunk_ids[best]]
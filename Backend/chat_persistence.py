@@ -0,0 +1,150 @@
+import os
+import asyncio
+from dotenv import load_dotenv
+from sqlalchemy import update, delete
+from database import AsyncSessionLocal, Conversation, Message, utc_now
+from batching import Histogram, HISTOGRAM_BUCKETS
+
+#Load the environment variables that store the settings of the chat persistence
+load_dotenv()
+
+#Settings of the write-behind queue. They can be overridden in the .env file.
+#When it is enabled, the replies of concurrent chat turns are written together in one transaction, so they share one commit.
+CHAT_WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "false").lower() == "true"
+CHAT_WRITE_BATCH_MAX_SIZE = int(os.getenv("CHAT_WRITE_BATCH_MAX_SIZE", "64"))
+CHAT_WRITE_BATCH_MAX_WAIT_MS = float(os.getenv("CHAT_WRITE_BATCH_MAX_WAIT_MS", "5"))
+
+
+#Class that stores the messages of a chat turn.
+#A chat turn is written in two steps:
+# 1. The user's message is committed as soon as it is received, so that it is never lost.
+# 2. The bot's reply and the new updated_at of the conversation are committed together in one transaction.
+#If the reply cannot be generated, for whatever reason, the user's message is deleted, so the conversation never ends with a question that has no answer.
+#The ids and timestamps are set by the insert itself, so no object is read back from the database after a commit.
+class ChatPersistence:
+    def __init__(self, write_behind: bool = CHAT_WRITE_BEHIND, max_batch_size: int = CHAT_WRITE_BATCH_MAX_SIZE, max_wait_ms: float = CHAT_WRITE_BATCH_MAX_WAIT_MS):
+        self.write_behind = write_behind
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batch_sizes = Histogram(HISTOGRAM_BUCKETS)
+        self.commits = 0
+        self.discarded = 0
+        self._queue = None
+        self._worker = None
+
+    #Stores the user's message and returns it with its id and timestamp
+    async def save_user_message(self, conversation_id: int, sender: str, message: str) -> Message:
+        user_msg = Message(conversation_id=conversation_id, sender=sender, message=message)
+        async with AsyncSessionLocal() as db:
+            db.add(user_msg)
+            await db.commit()
+        self.commits += 1
+        return user_msg
+
+    #Stores the bot's reply and updates the updated_at field of the conversation in one transaction.
+    #With the write-behind queue, the reply is written together with the replies of the other chat turns. The call still returns once the reply is committed.
+    #The write is shielded: once a complete reply is being stored, it is stored even if the request is cancelled meanwhile.
+    async def save_bot_reply(self, conversation_id: int, reply: str) -> Message:
+        bot_msg = Message(conversation_id=conversation_id, sender="bot", message=reply)
+        if not self.write_behind:
+            await asyncio.shield(self._write_replies([bot_msg]))
+            return bot_msg
+
+        future = asyncio.get_running_loop().create_future()
+        self._get_queue().put_nowait((bot_msg, future))
+        await asyncio.shield(future)
+        return bot_msg
+
+    #Deletes the user's message of a chat turn whose reply could not be generated.
+    #The delete is shielded, so it completes even when it is called because the request was cancelled.
+    async def discard_user_message(self, message_id: int):
+        await asyncio.shield(self._delete_message(message_id))
+
+    async def _delete_message(self, message_id: int):
+        async with AsyncSessionLocal() as db:
+            await db.execute(delete(Message).where(Message.id == message_id))
+            await db.commit()
+        self.commits += 1
+        self.discarded += 1
+
+    #Writes a list of replies and updates their conversations in one transaction
+    async def _write_replies(self, bot_msgs: list[Message]):
+        async with AsyncSessionLocal() as db:
+            db.add_all(bot_msgs)
+            await db.execute(
+                update(Conversation)
+                .where(Conversation.id.in_({bot_msg.conversation_id for bot_msg in bot_msgs}))
+                .values(updated_at=utc_now())
+            )
+            await db.commit()
+        self.commits += 1
+        self.batch_sizes.observe(len(bot_msgs))
+
+    #The queue and its worker are created on first use so that they belong to the running event loop
+    def _get_queue(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        return self._queue
+
+    #Collects the next batch: waits for the first reply, then at most max_wait for more replies.
+    #Returns the batch and whether the queue was closed.
+    async def _next_batch(self) -> tuple[list, bool]:
+        batch = []
+        item = await self._queue.get()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while item is not None:
+            batch.append(item)
+            remaining = deadline - loop.time()
+            if len(batch) >= self.max_batch_size or remaining <= 0:
+                return batch, False
+            try:
+                item = await asyncio.wait_for(self._queue.get(), remaining)
+            except asyncio.TimeoutError:
+                return batch, False
+        return batch, True
+
+    #Worker of the write-behind queue. A failed transaction is reported to every chat turn of the batch.
+    async def _run(self):
+        closed = False
+        while not closed:
+            batch, closed = await self._next_batch()
+            if not batch:
+                continue
+            try:
+                await self._write_replies([bot_msg for bot_msg, _ in batch])
+            except Exception as e:
+                print(f"Error storing {len(batch)} replies: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    #Writes the replies still in the queue and stops the worker
+    async def aclose(self):
+        if self._worker is None:
+            return
+        self._queue.put_nowait(None)
+        await self._worker
+        self._worker = None
+        self._queue = None
+
+    #Returns the number of commits and the sizes of the batches of replies
+    def stats(self) -> dict:
+        return {
+            "write_behind": self.write_behind,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "commits": self.commits,
+            "discarded_user_messages": self.discarded,
+            "batch_size": self.batch_sizes.snapshot(),
+        }
+
+
+#The persistence shared by the whole backend process
+chat_persistence = ChatPersistence()
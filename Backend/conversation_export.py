@@ -0,0 +1,124 @@
+import io
+import re
+import json
+import zipfile
+from sqlalchemy.orm import Session
+from database import Conversation, Message
+
+#Formats a conversation can be exported in: media type and file extension of each format
+EXPORT_FORMATS = {
+    "txt": ("text/plain; charset=utf-8", "txt"),
+    "jsonl": ("application/x-ndjson", "jsonl"),
+    "md": ("text/markdown; charset=utf-8", "md"),
+}
+
+#Number of messages read from the database at a time. Only one batch of messages is in memory during an export.
+EXPORT_BATCH_SIZE = 500
+
+#Size of the pieces of the zip archive sent to the client
+ZIP_CHUNK_SIZE = 64 * 1024
+
+
+#This function reads the messages of a conversation in batches with a server-side cursor, in the order they were stored.
+#Only the columns written in the export are read.
+def iter_messages(db: Session, conversation_id: int):
+    return (
+        db.query(Message.sender, Message.message, Message.timestamp)
+        .filter(Message.conversation_id == conversation_id)
+        .order_by(Message.timestamp, Message.id)
+        .yield_per(EXPORT_BATCH_SIZE)
+    )
+
+
+#This function formats the timestamp of a message. Messages stored before the timestamp column had a default may have none, they get an empty string.
+def format_timestamp(timestamp) -> str:
+    return timestamp.strftime("%Y-%m-%d %H:%M:%S") if timestamp else ""
+
+
+#This function formats the messages as plain text, the format the export has always used
+def format_txt(messages, title: str):
+    yield "========= Conversation Start =========\n"
+    for msg in messages:
+        timestamp = format_timestamp(msg.timestamp)
+        role = "User" if msg.sender == "user" else "Bot "
+        yield f"\n[{timestamp}] {role:4}: {msg.message}\n"
+    yield "\n\n========= Conversation End ========="
+
+
+#This function formats the messages as JSON Lines: one JSON object per message
+def format_jsonl(messages, title: str):
+    for msg in messages:
+        yield json.dumps({"sender": msg.sender, "message": msg.message, "timestamp": msg.timestamp.isoformat() if msg.timestamp else ""}) + "\n"
+
+
+#This function formats the messages as Markdown, with the title of the conversation as the heading
+def format_md(messages, title: str):
+    yield f"# {title}\n"
+    for msg in messages:
+        timestamp = format_timestamp(msg.timestamp)
+        role = "User" if msg.sender == "user" else "Bot"
+        yield f"\n**{role}** ({timestamp}):\n\n{msg.message}\n"
+
+
+FORMATTERS = {"txt": format_txt, "jsonl": format_jsonl, "md": format_md}
+
+
+#This function returns a file name made of the id and the title of a conversation.
+#Only ASCII letters, digits, spaces and dashes are kept because the name is sent in a HTTP header.
+def export_file_name(conversation_id: int, title: str | None, export_format: str) -> str:
+    name = " ".join(re.sub(r"[^A-Za-z0-9_\- ]+", " ", title or "").split()) or "Untitled"
+    return f"{conversation_id}_{name}.{EXPORT_FORMATS[export_format][1]}"
+
+
+#This function streams the export of one conversation.
+#It opens its own session because the response is streamed after the session of the request is closed.
+def stream_conversation(session_factory, conversation_id: int, title: str | None, export_format: str):
+    with session_factory() as db:
+        for piece in FORMATTERS[export_format](iter_messages(db, conversation_id), title or "Untitled"):
+            yield piece.encode("utf-8")
+
+
+#File-like object the zip archive is written to. The bytes written are taken out and sent to the client, so the archive is never kept in memory.
+class ZipStream(io.RawIOBase):
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        return len(data)
+
+    #Returns the bytes written since the last call
+    def take(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+    def size(self) -> int:
+        return len(self._buffer)
+
+
+#This function streams a zip archive with one file per conversation of a user, most recently updated first.
+#The archive is written while the messages are read, and sent in pieces of ZIP_CHUNK_SIZE bytes.
+def stream_user_archive(session_factory, user_id: str, export_format: str):
+    with session_factory() as db:
+        conversations = (
+            db.query(Conversation.id, Conversation.title)
+            .filter(Conversation.user_id == user_id)
+            .order_by(Conversation.updated_at.desc(), Conversation.id.desc())
+            .all()
+        )
+        stream = ZipStream()
+        with zipfile.ZipFile(stream, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+            for conversation_id, title in conversations:
+                with archive.open(export_file_name(conversation_id, title, export_format), mode="w", force_zip64=True) as entry:
+                    for piece in FORMATTERS[export_format](iter_messages(db, conversation_id), title or "Untitled"):
+                        entry.write(piece.encode("utf-8"))
+                        if stream.size() >= ZIP_CHUNK_SIZE:
+                            yield stream.take()
+                if stream.size():
+                    yield stream.take()
+        #The central directory is written when the archive is closed
+        yield stream.take()
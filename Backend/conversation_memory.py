@@ -0,0 +1,250 @@
+import os
+import re
+import asyncio
+from dataclasses import dataclass, field
+from dotenv import load_dotenv
+from sqlalchemy import select
+from database import AsyncSessionLocal, Message, ConversationSummaryRecord
+from llm_client import llm_client, LLMError
+from prompt_builder import build_payload
+
+#Load the environment variables that store the settings of the conversation memory
+load_dotenv()
+
+#Settings of the conversation memory. They can be overridden in the .env file.
+MEMORY_ENABLED = os.getenv("MEMORY_ENABLED", "true").lower() == "true"
+MEMORY_RECENT_MESSAGES = int(os.getenv("MEMORY_RECENT_MESSAGES", "6"))  # latest messages sent to the model as they are
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "1024"))  # tokens of the summary and the latest messages together
+MEMORY_SUMMARIZE_AFTER = int(os.getenv("MEMORY_SUMMARIZE_AFTER", "4"))  # messages older than the latest ones that are folded into the summary at once
+MEMORY_SUMMARY_BATCH = int(os.getenv("MEMORY_SUMMARY_BATCH", "20"))  # most messages folded into the summary by one model call
+MEMORY_SUMMARY_MAX_TOKENS = int(os.getenv("MEMORY_SUMMARY_MAX_TOKENS", "200"))
+QUERY_REWRITE_ENABLED = os.getenv("QUERY_REWRITE_ENABLED", "true").lower() == "true"
+QUERY_REWRITE_MAX_TOKENS = int(os.getenv("QUERY_REWRITE_MAX_TOKENS", "64"))
+
+#The tokens are estimated from the length of the text. Llama's tokenizer averages about 4 characters per token on English text.
+CHARS_PER_TOKEN = 4
+
+#Words that make a question depend on the previous messages, such as "what about for PhD?" or "is it the same for them?"
+FOLLOW_UP_WORDS = {"it", "its", "this", "that", "these", "those", "they", "them", "their", "there", "same", "also", "else", "instead", "about", "one", "ones"}
+#Questions with this many words or fewer are always rewritten, because they rarely stand on their own
+FOLLOW_UP_MAX_WORDS = 5
+
+#This prompt asks Llama 3.2 to rewrite a follow-up question into a question that can be understood without the conversation
+rewrite_prompt = """
+Rewrite the user's last question so that it can be understood without the conversation.
+Replace the pronouns and the missing parts with what they refer to in the conversation. Keep the meaning of the question.
+If the question already stands on its own, repeat it unchanged.
+Reply with the rewritten question only, on one line.
+"""
+
+#This prompt asks Llama 3.2 to fold messages into the running summary of the conversation
+summary_prompt = """
+You maintain a short summary of a conversation between a user and the U of A Graduate Application Assistant.
+Update the summary with the new messages. Keep the facts the user gave about themselves (program, degree, country, scores),
+the questions they asked and the key facts of the answers. Drop greetings and repetitions.
+Reply with the updated summary only.
+"""
+
+
+#This function estimates the number of tokens of a text
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+#This function cuts a text to about max_tokens tokens
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    return text if len(text) <= max_chars else text[:max_chars] + "..."
+
+
+#This function returns the chat role of the sender of a message
+def chat_role(sender: str) -> str:
+    return "user" if sender == "user" else "assistant"
+
+
+#This function checks whether a question probably depends on the previous messages
+def is_follow_up(question: str) -> bool:
+    words = re.findall(r"[a-z']+", question.lower())
+    return len(words) <= FOLLOW_UP_MAX_WORDS or any(word in FOLLOW_UP_WORDS for word in words)
+
+
+#Class for the part of a conversation that is sent to the model with a new question:
+#the summary of the older messages, and the latest messages that fit in the token budget, oldest first.
+@dataclass
+class ChatHistory:
+    summary: str | None = None
+    turns: list[dict] = field(default_factory=list)
+
+    def is_empty(self) -> bool:
+        return not self.summary and not self.turns
+
+    #Returns the history as chat messages for Ollama. The summary is sent as a system message before the latest messages.
+    def to_messages(self) -> list[dict]:
+        messages = []
+        if self.summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{self.summary}"})
+        return messages + self.turns
+
+    #Returns the history as plain text, for the prompts that rewrite questions
+    def to_text(self) -> str:
+        lines = [f"Summary: {self.summary}"] if self.summary else []
+        lines += [f"{turn['role'].capitalize()}: {turn['content']}" for turn in self.turns]
+        return "\n".join(lines)
+
+
+#Class that gives the model the memory of a conversation, with a bounded prompt however long the conversation is:
+# 1. The latest messages are sent as they are, as long as they fit in the token budget.
+# 2. The older messages are folded into a rolling summary stored in the conversation_summaries table.
+#    The summary is updated in the background after a reply, only when enough messages have left the latest ones, so a long conversation is not summarized again on every turn.
+# 3. A follow-up question is rewritten into a standalone question before the retrieval, so that the retrieval finds the chunks it is about.
+class ConversationMemory:
+    def __init__(
+        self,
+        recent_messages: int = MEMORY_RECENT_MESSAGES,
+        token_budget: int = MEMORY_TOKEN_BUDGET,
+        summarize_after: int = MEMORY_SUMMARIZE_AFTER,
+        summary_batch: int = MEMORY_SUMMARY_BATCH,
+    ):
+        self.recent_messages = recent_messages
+        self.token_budget = token_budget
+        self.summarize_after = summarize_after
+        self.summary_batch = summary_batch
+        self._refreshing = {}  # conversation ID -> task updating its summary
+        self.rewrites = 0
+        self.rewrite_errors = 0
+        self.summaries = 0
+        self.summary_errors = 0
+
+    #Loads the history of a conversation before one of its messages
+    #Only the messages that are not in the summary are read, and at most recent_messages of them, newest first.
+    async def load(self, conversation_id: int, before_message_id: int) -> ChatHistory:
+        async with AsyncSessionLocal() as db:
+            record = await db.get(ConversationSummaryRecord, conversation_id)
+            covered = record.last_message_id if record else 0
+            rows = (await db.execute(
+                select(Message.sender, Message.message)
+                .where(Message.conversation_id == conversation_id, Message.id > covered, Message.id < before_message_id)
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(self.recent_messages)
+            )).all()
+
+        #The summary comes first, then the latest messages are added from the newest until the budget is used
+        #A single message may use at most half of the budget, so that a long answer does not push out the rest of the history
+        summary = truncate_to_tokens(record.summary, MEMORY_SUMMARY_MAX_TOKENS) if record and record.summary else None
+        remaining = self.token_budget - (estimate_tokens(summary) if summary else 0)
+        turns = []
+        for sender, message in rows:
+            content = truncate_to_tokens(message or "", max(remaining // 2, 1))
+            tokens = estimate_tokens(content)
+            if tokens > remaining:
+                break
+            turns.append({"role": chat_role(sender), "content": content})
+            remaining -= tokens
+        turns.reverse()
+        return ChatHistory(summary=summary, turns=turns)
+
+    #Returns the question rewritten so that it can be understood without the conversation.
+    #The question is returned as it is when there is no history, when it does not look like a follow-up, or when the model fails.
+    async def rewrite_query(self, history: ChatHistory, question: str) -> str:
+        if not QUERY_REWRITE_ENABLED or history.is_empty() or not is_follow_up(question):
+            return question
+
+        payload = build_payload(
+            [
+                {"role": "system", "content": rewrite_prompt},
+                {"role": "user", "content": f"Conversation:\n{history.to_text()}\n\nLast question: {question}"},
+            ],
+            temperature=0,
+            num_predict=QUERY_REWRITE_MAX_TOKENS,
+        )
+        try:
+            data = await llm_client.chat(payload)
+        except LLMError as e:
+            self.rewrite_errors += 1
+            print(f"Error rewriting the question: {e}")
+            return question
+
+        lines = data.get("message", {}).get("content", "").strip().splitlines()
+        rewritten = lines[0].strip().strip('"') if lines else ""
+        if not rewritten:
+            return question
+        self.rewrites += 1
+        return rewritten
+
+    #Starts updating the summary of a conversation in the background, unless it is already being updated
+    def schedule_refresh(self, conversation_id: int):
+        if not MEMORY_ENABLED or conversation_id in self._refreshing:
+            return
+        task = asyncio.create_task(self.refresh_summary(conversation_id))
+        self._refreshing[conversation_id] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(conversation_id, None))
+
+    #Folds the messages that left the latest messages into the summary of the conversation.
+    #Nothing is done until at least summarize_after such messages are waiting, so the model is not called on every turn.
+    async def refresh_summary(self, conversation_id: int):
+        async with AsyncSessionLocal() as db:
+            record = await db.get(ConversationSummaryRecord, conversation_id)
+            covered = record.last_message_id if record else 0
+            rows = (await db.execute(
+                select(Message.id, Message.sender, Message.message)
+                .where(Message.conversation_id == conversation_id, Message.id > covered)
+                .order_by(Message.timestamp, Message.id)
+                .limit(self.summary_batch + self.recent_messages)
+            )).all()
+
+        older = rows[:-self.recent_messages] if len(rows) > self.recent_messages else []
+        if len(older) < self.summarize_after:
+            return
+
+        transcript = "\n".join(f"{chat_role(sender).capitalize()}: {truncate_to_tokens(message or '', 300)}" for _, sender, message in older)
+        payload = build_payload(
+            [
+                {"role": "system", "content": summary_prompt},
+                {"role": "user", "content": f"Current summary:\n{record.summary if record else '(none)'}\n\nNew messages:\n{transcript}"},
+            ],
+            temperature=0,
+            num_predict=MEMORY_SUMMARY_MAX_TOKENS,
+        )
+        try:
+            data = await llm_client.chat(payload)
+        except LLMError as e:
+            self.summary_errors += 1
+            print(f"Error summarizing conversation {conversation_id}: {e}")
+            return
+
+        summary = data.get("message", {}).get("content", "").strip()
+        if not summary:
+            return
+        async with AsyncSessionLocal() as db:
+            record = await db.get(ConversationSummaryRecord, conversation_id)
+            if record is None:
+                record = ConversationSummaryRecord(conversation_id=conversation_id)
+                db.add(record)
+            record.summary = summary
+            record.last_message_id = older[-1][0]
+            await db.commit()
+        self.summaries += 1
+
+    #Stops the summaries being updated when the server shuts down. They are updated again after the next reply.
+    async def aclose(self):
+        tasks = list(self._refreshing.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    #Returns the settings and the number of rewrites and summaries
+    def stats(self) -> dict:
+        return {
+            "enabled": MEMORY_ENABLED,
+            "recent_messages": self.recent_messages,
+            "token_budget": self.token_budget,
+            "rewrites": self.rewrites,
+            "rewrite_errors": self.rewrite_errors,
+            "summaries": self.summaries,
+            "summary_errors": self.summary_errors,
+            "refreshing": len(self._refreshing),
+        }
+
+
+#The conversation memory shared by the whole backend process
+conversation_memory = ConversationMemory()
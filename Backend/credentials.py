@@ -0,0 +1,102 @@
+import os
+import hmac
+import base64
+import asyncio
+import hashlib
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from sqlalchemy import select
+from database import AsyncSessionLocal, User
+
+#Load the environment variables that store the settings of the password hashing
+load_dotenv()
+
+#Settings of the scrypt key derivation. They can be overridden in the .env file.
+#The cost is log2 of the scrypt N parameter: every step up doubles the time and the memory needed to hash a password.
+#Use benchmarks/password_hashing.py to see how many logins per second each cost allows on a machine.
+PASSWORD_HASH_COST = int(os.getenv("PASSWORD_HASH_COST", "14"))
+PASSWORD_HASH_BLOCK_SIZE = int(os.getenv("PASSWORD_HASH_BLOCK_SIZE", "8"))  # scrypt r
+PASSWORD_HASH_PARALLELISM = int(os.getenv("PASSWORD_HASH_PARALLELISM", "1"))  # scrypt p
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))  # threads that verify passwords at the same time
+
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+#Prefix of the stored password hashes. Passwords stored without it were saved in plain text before the passwords were hashed.
+HASH_SCHEME = "scrypt"
+
+#Threads that hash and verify the passwords. hashlib releases the GIL while it hashes, so the logins are verified in parallel,
+#and the async routes never block the event loop. A pool of its own keeps the logins from using up the threadpool of the routes.
+hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+
+
+#This function derives the key of a password with scrypt
+def derive_key(password: str, salt: bytes, cost: int, block_size: int, parallelism: int) -> bytes:
+    n = 2 ** cost
+    return hashlib.scrypt(
+        password.encode("utf-8"),
+        salt=salt,
+        n=n,
+        r=block_size,
+        p=parallelism,
+        maxmem=256 * n * block_size * parallelism,  # scrypt needs 128 * n * r * p bytes, the default limit is too low for the higher costs
+        dklen=KEY_BYTES,
+    )
+
+
+#This function hashes a password with the current settings.
+#The stored value contains the settings and the salt: scrypt$cost$block_size$parallelism$salt$key
+def hash_password(password: str, cost: int = PASSWORD_HASH_COST, block_size: int = PASSWORD_HASH_BLOCK_SIZE, parallelism: int = PASSWORD_HASH_PARALLELISM) -> str:
+    salt = os.urandom(SALT_BYTES)
+    key = derive_key(password, salt, cost, block_size, parallelism)
+    return "$".join([
+        HASH_SCHEME, str(cost), str(block_size), str(parallelism),
+        base64.b64encode(salt).decode(), base64.b64encode(key).decode(),
+    ])
+
+
+#This function verifies a password against a stored value.
+#Returns whether the password is correct, and whether the stored value should be replaced by a hash with the current settings,
+#either because it was hashed with other settings, or because it is a plain text password stored before the passwords were hashed.
+def verify_password(password: str, stored: str) -> tuple[bool, bool]:
+    parts = stored.split("$")
+    if len(parts) != 6 or parts[0] != HASH_SCHEME:
+        return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8")), True
+
+    _, cost, block_size, parallelism, salt, key = parts
+    cost, block_size, parallelism = int(cost), int(block_size), int(parallelism)
+    derived = derive_key(password, base64.b64decode(salt), cost, block_size, parallelism)
+    correct = hmac.compare_digest(derived, base64.b64decode(key))
+    needs_rehash = (cost, block_size, parallelism) != (PASSWORD_HASH_COST, PASSWORD_HASH_BLOCK_SIZE, PASSWORD_HASH_PARALLELISM)
+    return correct, needs_rehash
+
+
+#This function returns the hash compared when the email address is unknown, so that a login takes as long whether the user exists or not.
+#It is computed on the first login with an unknown email address rather than at import, so importing the module stays fast.
+@lru_cache(maxsize=1)
+def dummy_hash() -> str:
+    return hash_password("dummy password")
+
+
+#This function checks the email address and the password of a login.
+#The user is looked up by email address with the async session, then the password is verified in the threads of hash_executor.
+#If the password is correct and its stored value is out of date, it is hashed again with the current settings and saved.
+#Neither the database nor the hashing runs on the event loop.
+#Returns the user, or None if the email address or the password is wrong.
+async def authenticate(email: str, password: str) -> User | None:
+    loop = asyncio.get_running_loop()
+    async with AsyncSessionLocal() as db:
+        user = (await db.execute(select(User).filter_by(email=email))).scalars().first()
+        if user is not None and user.password:
+            stored = user.password
+        else:
+            stored = await loop.run_in_executor(hash_executor, dummy_hash)
+        correct, needs_rehash = await loop.run_in_executor(hash_executor, verify_password, password, stored)
+        if user is None or not correct:
+            return None
+
+        if needs_rehash:
+            user.password = await loop.run_in_executor(hash_executor, hash_password, password)
+            await db.commit()
+    return user
@@ -1,46 +1,286 @@
 
+import os
+import time
+import threading
 import chromadb
 from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
 from sentence_transformers import CrossEncoder
+from dotenv import load_dotenv
+from bm25_index import BM25Index
+from vector_store import VectorStore, resolve_active_store
+from rerank_policy import rerank_policy
+from metrics import span, count
+from retrieval_cache import embedding_cache, search_cache, score_cache
+from batching import (
+    MicroBatcher,
+    BATCHING_ENABLED,
+    EMBEDDING_BATCH_MAX_SIZE,
+    EMBEDDING_BATCH_MAX_WAIT_MS,
+    RERANK_BATCH_MAX_SIZE,
+    RERANK_BATCH_MAX_WAIT_MS,
+)
+
+#Names of the models and the path of the vector database used by the RAG pipeline
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+CROSS_ENCODER_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+CHROMA_PATH = "./chroma_db"  # served until the first version is published in the versioned vector store
+
+#Load the environment variables that store the settings of the retrieval
+load_dotenv()
+
+#Settings of the retrieval. They can be overridden in the .env file.
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")  # "hybrid" fuses the dense and the BM25 rankings, "dense" only uses the dense ranking
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "10"))  # chunks passed to the cross-encoder
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))  # chunks taken from each ranking before the fusion
+RRF_K = int(os.getenv("RRF_K", "60"))  # constant of the reciprocal rank fusion, a larger value gives more weight to lower ranks
+CONTEXT_ORDER = os.getenv("CONTEXT_ORDER", "stable")  # "stable" sends the chosen chunks ordered by ID, so the same chunks always give the same prompt, "rank" keeps the re-ranked order
+VECTOR_STORE_ROOT = os.getenv("VECTOR_STORE_ROOT", "./vector_store")  # folder of the versioned vector store written by the ingestion command
+VECTOR_STORE_RELOAD_INTERVAL = float(os.getenv("VECTOR_STORE_RELOAD_INTERVAL", "5"))  # seconds between two checks for a newly published version
+
+
+#Class that holds the embedding model, the vector store and the cross-encoder model.
+#Loading these from disk takes seconds, so we create a single instance per process and share it between all the requests.
+#The HuggingFace tokenizers are not safe to call from several threads at the same time, so each model call is guarded by its own lock.
+#When the ingestion command publishes a new version of the vector store, it is loaded and warmed up in the background
+#and then swapped in, so the Backend picks up new documents without a restart and without serving a half-built collection.
+class RetrieverEngine:
+    _instance = None  # static variable that stores the process-wide instance
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.embedding_function = SentenceTransformerEmbeddingFunction(model_name=EMBEDDING_MODEL_NAME)
+        self.store = VectorStore(*resolve_active_store(VECTOR_STORE_ROOT, CHROMA_PATH), self.embedding_function)
+        self._store_checked_at = time.monotonic()
+        self._store_lock = threading.Lock()
+        self._loading_store = False
+        self.cross_encoder = CrossEncoder(CROSS_ENCODER_MODEL_NAME)
+        self._embedding_lock = threading.Lock()
+        self._cross_encoder_lock = threading.Lock()
+        #Concurrent requests are grouped into one forward pass per model
+        self.embedding_batcher = MicroBatcher("embedding", self._embed_batch, EMBEDDING_BATCH_MAX_SIZE, EMBEDDING_BATCH_MAX_WAIT_MS)
+        self.cross_encoder_batcher = MicroBatcher("cross-encoder", self._score_batch, RERANK_BATCH_MAX_SIZE, RERANK_BATCH_MAX_WAIT_MS)
+
+    @classmethod
+    #Returns the process-wide instance and creates it on the first call.
+    def get_instance(cls):
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    #Embeds a batch of texts in one forward pass of the embedding model
+    def _embed_batch(self, texts: list[str]) -> list:
+        with self._embedding_lock:
+            return self.embedding_function(texts)
+
+    #Scores a batch of (query, document) pairs in one forward pass of the cross-encoder model
+    def _score_batch(self, pairs: list[tuple[str, str]]) -> list[float]:
+        with self._cross_encoder_lock:
+            return self.cross_encoder.predict(pairs).tolist()
+
+    #Embeds a list of texts with the embedding model of the collection
+    #If batching is enabled, the texts are embedded together with the texts of the other requests
+    def embed(self, texts: list[str]) -> list:
+        if BATCHING_ENABLED:
+            return self.embedding_batcher.run(texts)
+        return self._embed_batch(texts)
+
+    #Scores every document for the query with the cross-encoder model. A higher score means a more relevant document.
+    #If batching is enabled, the pairs are scored together with the pairs of the other requests
+    def score(self, query: str, documents: list[str]) -> list[float]:
+        pairs = [(query, document) for document in documents]
+        if BATCHING_ENABLED:
+            return self.cross_encoder_batcher.run(pairs)
+        return self._score_batch(pairs)
+
+    #Returns the version of the vector store to use for a request.
+    #Every VECTOR_STORE_RELOAD_INTERVAL seconds it checks whether another version has been published.
+    #A new version is loaded in a background thread while the requests keep using the current one.
+    def current_store(self) -> VectorStore:
+        now = time.monotonic()
+        if now - self._store_checked_at >= VECTOR_STORE_RELOAD_INTERVAL:
+            with self._store_lock:
+                if now - self._store_checked_at >= VECTOR_STORE_RELOAD_INTERVAL and not self._loading_store:
+                    self._store_checked_at = now
+                    name, path = resolve_active_store(VECTOR_STORE_ROOT, CHROMA_PATH)
+                    if name != self.store.name:
+                        self._loading_store = True
+                        threading.Thread(target=self._load_store, args=(name, path), name="vector-store-loader", daemon=True).start()
+        return self.store
+
+    #Loads and warms up a newly published version of the vector store, then swaps it in.
+    #If the version cannot be loaded, the error is counted like the other errors of the backend and the current version keeps being served.
+    def _load_store(self, name: str, path: str):
+        try:
+            store = VectorStore(name, path, self.embedding_function)
+            self._warmup_store(store)
+            self.store = store
+            print(f"Serving version '{name}' of the vector store.")
+        except Exception as e:
+            count("errors", "Errors by stage.", stage="vector_store")
+            print(f"Error loading version '{name}' of the vector store: {e}")
+        finally:
+            with self._store_lock:
+                self._loading_store = False
+
+    #The Chroma collection of the current version of the vector store
+    @property
+    def collection(self) -> chromadb.Collection:
+        return self.current_store().collection
+
+    #Returns a stamp that changes whenever the documents in the vector store change, including when another version is swapped in
+    def collection_version(self) -> str:
+        return self.current_store().version()
+
+    #Returns the BM25 index of the current version of the vector store
+    def get_sparse_index(self) -> BM25Index:
+        return self.current_store().get_sparse_index()
+
+    #Runs a query against a version of the vector store so that its HNSW index and its BM25 index are loaded before requests use it
+    def _warmup_store(self, store: VectorStore):
+        query = "What is the minimum IELTS score required for MSc application?"
+        store.collection.query(query_embeddings=self.embed([query]), n_results=1)
+        if RETRIEVAL_MODE == "hybrid":
+            store.get_sparse_index()
+
+    #Runs every model once so that the first user after a deploy does not pay for the lazy initialization of the models and the HNSW index
+    def warmup(self):
+        query = "What is the minimum IELTS score required for MSc application?"
+        embedding = self.embed([query])
+        results = self.store.collection.query(query_embeddings=embedding, n_results=1)
+        documents = results.get("documents")[0] or [query]
+        self.score(query, documents)
+        if RETRIEVAL_MODE == "hybrid":
+            self.store.get_sparse_index()
 
 
 #This function is used to get the vector collection- Chroma DB. This function is called when the user sends a query to the RAG pipeline.
 #We also set the embedding mode = "all-MiniLM-L6-v2" to be used for the vector collection
 #The collection name is "document_qa" that stores the embedded documents
-#For similarity search, we use the "cosine" distance metric
+#The collection is opened once per process by the RetrieverEngine and reused until a new version of the vector store is published
 def get_vector_collection() -> chromadb.Collection:
-    embedding_function = SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
-    chroma_client = chromadb.PersistentClient(path="./chroma_db")
-    return chroma_client.get_or_create_collection(
-        name="document_qa",
-        embedding_function=embedding_function,
-        metadata={"hnsw:space": "cosine"},
-    )
+    return RetrieverEngine.get_instance().collection
+
+
+#This function embeds the user's query with the embedding model of the vector collection
+#Embeddings of queries that were asked before are taken from the embedding cache
+def embed_query(prompt: str):
+    embedding = embedding_cache.get(prompt)
+    if embedding is None:
+        embedding = RetrieverEngine.get_instance().embed([prompt])[0]
+        embedding_cache.put(prompt, embedding)
+    return embedding
+
+
+#This function fuses several rankings of chunk ids with reciprocal rank fusion and returns the fused ranking
+#A chunk gets 1 / (RRF_K + rank) from every ranking it appears in, so chunks ranked high by both the dense and the BM25 search come first
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = RRF_K) -> list[str]:
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
 
+#This function receives a query from the user and returns the top 10 most relevant chunks from the vector collection together with their metadata, ids and cosine distances
+#Chunks that were only found by the BM25 search have no distance (None)
+#In hybrid mode the dense ranking is fused with the BM25 ranking, so that exact tokens like course codes, names and amounts are not missed
+#If the query has already been embedded, the embedding can be passed to avoid embedding it again
+#Results of queries that were asked before are taken from the search cache as long as the vector collection has not changed
+#The version of the vector store can be passed so that the whole retrieval of a query uses the same version
+def query_collection(prompt: str, n_results: int = RERANK_CANDIDATES, query_embedding=None, store: VectorStore = None):
+    #The same version of the vector store is used for all the lookups of the query
+    if store is None:
+        store = RetrieverEngine.get_instance().current_store()
+    version = store.version()
+    cached = search_cache.get((prompt, n_results), version)
+    if cached is not None:
+        return cached
 
-#This function receives a query from the user and returns the top 10 most relevant chunks from the vector collection
-def query_collection(prompt: str, n_results: int = 10):
-    collection = get_vector_collection()
-    results = collection.query(query_texts=[prompt], n_results=n_results)
-    return results.get("documents")[0], results.get("metadatas")[0]
+    if query_embedding is None:
+        query_embedding = embed_query(prompt)
+    hybrid = RETRIEVAL_MODE == "hybrid"
+    results = store.collection.query(query_embeddings=[query_embedding], n_results=max(n_results, HYBRID_CANDIDATES) if hybrid else n_results)
+    documents, metadatas, ids = results.get("documents")[0], results.get("metadatas")[0], results.get("ids")[0]
+    distances = results.get("distances")[0]
+
+    if hybrid:
+        sparse_ids = store.get_sparse_index().search(prompt, HYBRID_CANDIDATES)
+        fused_ids = reciprocal_rank_fusion([ids, sparse_ids])[:n_results]
+        chunks = dict(zip(ids, zip(documents, metadatas)))
+        dense_distances = dict(zip(ids, distances))
+        #Chunks found only by the BM25 search are fetched from the collection
+        missing = [chunk_id for chunk_id in fused_ids if chunk_id not in chunks]
+        if missing:
+            fetched = store.collection.get(ids=missing, include=["documents", "metadatas"])
+            chunks.update(zip(fetched["ids"], zip(fetched["documents"], fetched["metadatas"])))
+        ids = [chunk_id for chunk_id in fused_ids if chunk_id in chunks]
+        documents = [chunks[chunk_id][0] for chunk_id in ids]
+        metadatas = [chunks[chunk_id][1] for chunk_id in ids]
+        distances = [dense_distances.get(chunk_id) for chunk_id in ids]
+
+    found = (documents, metadatas, ids, distances)
+    search_cache.put((prompt, n_results), found, version)
+    return found
+
+
+#This function returns the key that orders the chunk IDs written by the ingestion ("<page>_<index>") by page, then by their index in the page
+def chunk_order_key(chunk_id: str) -> tuple[str, int]:
+    page, _, index = chunk_id.rpartition("_")
+    return (page, int(index)) if index.isdigit() else (chunk_id, -1)
 
 
 #This function re-ranks the top 10 most relevant chunks from the vector collection using the cross-encoder model and returns the top 5 most relevant chunks to Llama 3.2
-#It also adds the source of the document to the relevant chunks
-def re_rank_cross_encoders(documents: list[str], metadata: list[dict], prompt: str) -> tuple[str, list[int]]:
+#It also adds the source of the document to the relevant chunks and returns the list of the sources that were used
+#The re-ranking policy decides whether all, some or none of the chunks are re-ranked. The path it took is returned as well.
+#If the ids of the chunks are given, the scores of (query, chunk) pairs that were scored before are taken from the score cache
+#under the version of the vector store the chunks were found in. Without a version, the version currently served is used.
+def re_rank_cross_encoders(documents: list[str], metadata: list[dict], prompt: str, ids: list[str] = None, distances: list = None, version: str = None) -> tuple[str, list[str], str]:
     relevant_text = ""
+    sources = []
+
+    engine = RetrieverEngine.get_instance()
+    path, n_rerank = rerank_policy.decide(distances, len(documents), engine.cross_encoder_batcher.queue_depth())
+
+    scores = [None] * n_rerank
+    if ids is not None:
+        if version is None:
+            version = engine.collection_version()
+        scores = [score_cache.get((prompt, chunk_id), version) for chunk_id in ids[:n_rerank]]
+
+    #Only the pairs that are not in the cache are sent to the cross-encoder, in one batch
+    missing = [idx for idx, score in enumerate(scores) if score is None]
+    if missing:
+        started = time.perf_counter()
+        new_scores = engine.score(prompt, [documents[idx] for idx in missing])
+        rerank_policy.record_latency(len(missing), time.perf_counter() - started)
+        for idx, score in zip(missing, new_scores):
+            scores[idx] = score
+            if ids is not None:
+                score_cache.put((prompt, ids[idx]), score, version)
 
-    encoder_model = CrossEncoder("cross-encoder/ms-marco-MiniLM-L-6-v2")
-    ranks = encoder_model.rank(prompt, documents, top_k=5)
-    for rank in ranks:
-        idx = rank["corpus_id"]
+    #The re-ranked chunks come first, followed by the rest of the chunks in their original order
+    ranking = sorted(range(n_rerank), key=lambda idx: scores[idx], reverse=True) + list(range(n_rerank, len(documents)))
+    chosen = ranking[:5]
+    #The chunks of the same page then also come in the order of the page, and Ollama can reuse the evaluation of a context it has seen before
+    if CONTEXT_ORDER == "stable" and ids is not None:
+        chosen.sort(key=lambda idx: chunk_order_key(ids[idx]))
+    for idx in chosen:
         source = metadata[idx].get("source", "unknown") #Get the source of the document from the metadata
         relevant_text += f"{documents[idx]}\n[Source: {source}]\n\n" #Add the source to the relevant chunks/texts
+        if source not in sources:
+            sources.append(source)
 
-    return relevant_text
+    return relevant_text, sources, path
 
 #This function combines the above functions to retrieve the top 5 most relevant chunks from the vector collection and returns them to Llama 3.2
-def retrieve_relevant_chunks(query: str) -> list[str]:
-    top_10_context, corresponding_metadata = query_collection(query)
-    top_3_documents = re_rank_cross_encoders(top_10_context, corresponding_metadata, query)
-    return top_3_documents
+#together with their sources and the path the request took through the re-ranking step
+#The version of the vector store is resolved once, so the search and the score cache use the same version even if another one is swapped in meanwhile
+def retrieve_relevant_chunks(query: str, query_embedding=None) -> tuple[str, list[str], str]:
+    store = RetrieverEngine.get_instance().current_store()
+    with span("query_collection"):
+        top_10_context, corresponding_metadata, ids, distances = query_collection(query, query_embedding=query_embedding, store=store)
+    with span("rerank"):
+        top_3_documents, sources, rerank_path = re_rank_cross_encoders(top_10_context, corresponding_metadata, query, ids, distances, store.version())
+    return top_3_documents, sources, rerank_path
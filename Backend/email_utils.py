@@ -1,16 +1,43 @@
 import os
+import time
+import asyncio
 import aiosmtplib
 from email.message import EmailMessage
 from dotenv import load_dotenv
+from batching import Histogram
+from metrics import count
 
 #Load the environment variables that store the email credentials
 load_dotenv()
 
+#Settings of the SMTP server. They are read from the .env file.
+#Without a user name, the emails are sent without logging in, and STARTTLS can be turned off, for example to send to a local test server.
+EMAIL_USER = os.getenv("EMAIL_USER")
+EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
+EMAIL_HOST = os.getenv("EMAIL_HOST")
+EMAIL_PORT = int(os.getenv("EMAIL_PORT", "587"))
+EMAIL_START_TLS = os.getenv("EMAIL_START_TLS", "true").lower() == "true"
 
-#The function takes in the user's email address and the OTP code and sends the OTP email to the user's email address
-async def send_otp_email(to_email: str, otp: str):
+#Settings of the email queue. They can be overridden in the .env file.
+EMAIL_QUEUE_MAX_SIZE = int(os.getenv("EMAIL_QUEUE_MAX_SIZE", "1000"))  # emails waiting to be sent. When the queue is full, new emails are refused.
+EMAIL_MAX_RETRIES = int(os.getenv("EMAIL_MAX_RETRIES", "3"))
+EMAIL_RETRY_BACKOFF = float(os.getenv("EMAIL_RETRY_BACKOFF", "1"))  # seconds before the first retry, doubled for every retry
+EMAIL_TIMEOUT = float(os.getenv("EMAIL_TIMEOUT", "30"))  # seconds to wait for the SMTP server
+EMAIL_IDLE_TIMEOUT = float(os.getenv("EMAIL_IDLE_TIMEOUT", "60"))  # the connection is closed after this many seconds without emails
+
+#Upper bounds of the buckets of the delivery latency histogram, in milliseconds
+DELIVERY_LATENCY_BUCKETS_MS = (100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+
+#Raised when an email cannot be queued because the queue is full
+class EmailQueueFull(Exception):
+    pass
+
+
+#The function takes in the user's email address and the OTP code and returns the OTP email for the user
+def build_otp_email(to_email: str, otp: str) -> EmailMessage:
     message = EmailMessage()
-    message["From"] = os.getenv("EMAIL_USER") #The email address from which the email is sent
+    message["From"] = EMAIL_USER #The email address from which the email is sent
     message["To"] = to_email #The email address to which the email is sent
     message["Subject"] = "OTP Code to login to U of A Graduate Application Assistant App" #The subject of the email
     message.set_content(f"""
@@ -30,13 +57,167 @@ Thank you,
 U of A Graduate Application Assistant Team
 """
 ) #The content of the email
+    return message
+
+
+#Class for the queue of outgoing emails.
+#A request only puts its email in the queue, so it never waits for the SMTP server.
+#A worker task sends the emails one after the other over one SMTP connection, which is kept open between emails and closed after EMAIL_IDLE_TIMEOUT seconds without emails.
+#If sending fails, the connection is opened again and the email is retried with an exponential backoff.
+class EmailQueue:
+    def __init__(
+        self,
+        hostname: str | None = EMAIL_HOST,
+        port: int = EMAIL_PORT,
+        username: str | None = EMAIL_USER,
+        password: str | None = EMAIL_PASSWORD,
+        start_tls: bool = EMAIL_START_TLS,
+        max_size: int = EMAIL_QUEUE_MAX_SIZE,
+        max_retries: int = EMAIL_MAX_RETRIES,
+        retry_backoff: float = EMAIL_RETRY_BACKOFF,
+        timeout: float = EMAIL_TIMEOUT,
+        idle_timeout: float = EMAIL_IDLE_TIMEOUT,
+    ):
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.start_tls = start_tls
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._queue = None
+        self._worker = None
+        self._smtp = None
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.connections = 0
+        self.delivery_latency_ms = Histogram(DELIVERY_LATENCY_BUCKETS_MS)
+
+    #Starts the worker. It is called when the server starts, so that the queue belongs to the running event loop.
+    def start(self):
+        if self._worker is None:
+            self._queue = asyncio.Queue(maxsize=self.max_size)
+            self._worker = asyncio.create_task(self._run())
+
+    #Puts an email in the queue and returns at once. Raises EmailQueueFull if the queue is full.
+    def enqueue(self, message: EmailMessage):
+        self.start()
+        try:
+            self._queue.put_nowait((message, time.monotonic()))
+        except asyncio.QueueFull:
+            raise EmailQueueFull("Too many emails are waiting to be sent")
+
+    #Number of emails waiting to be sent
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    #Opens the SMTP connection if it is not open. With a user name, it also logs in.
+    async def _connect(self) -> aiosmtplib.SMTP:
+        if self._smtp is None or not self._smtp.is_connected:
+            self._smtp = aiosmtplib.SMTP(
+                hostname=self.hostname,
+                port=self.port,
+                username=self.username or None,
+                password=self.password or None,
+                start_tls=self.start_tls,
+                timeout=self.timeout,
+            )
+            await self._smtp.connect()
+            self.connections += 1
+        return self._smtp
+
+    #Closes the SMTP connection. A connection that is already broken is just dropped.
+    async def _disconnect(self):
+        if self._smtp is None:
+            return
+        try:
+            if self._smtp.is_connected:
+                await self._smtp.quit()
+        except (aiosmtplib.SMTPException, OSError):
+            self._smtp.close()
+        self._smtp = None
+
+    #Sends one email. If it fails, the connection is dropped, and the email is sent again on a new connection after a backoff.
+    async def _send(self, message: EmailMessage) -> bool:
+        for attempt in range(self.max_retries + 1):
+            try:
+                smtp = await self._connect()
+                await smtp.send_message(message)
+                return True
+            except (aiosmtplib.SMTPException, OSError, asyncio.TimeoutError) as e:
+                await self._disconnect()
+                if attempt == self.max_retries:
+                    count("errors", "Errors by stage.", stage="email")
+                    print(f"Error sending email to {message['To']}: {e}")
+                    return False
+                self.retries += 1
+                await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+
+    #Worker of the queue. The connection is closed when the queue stays empty for idle_timeout seconds.
+    #An unexpected error while sending an email counts the email as failed and the worker goes on with the next one, so one bad email never stops the queue.
+    async def _run(self):
+        while True:
+            try:
+                message, queued_at = await asyncio.wait_for(self._queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                await self._disconnect()
+                continue
+            try:
+                if await self._send(message):
+                    self.sent += 1
+                    self.delivery_latency_ms.observe((time.monotonic() - queued_at) * 1000)
+                else:
+                    self.failed += 1
+            except Exception as e:
+                self.failed += 1
+                count("errors", "Errors by stage.", stage="email")
+                print(f"Error sending email to {message['To']}: {e}")
+                #The state of the connection is unknown, so it is dropped and the next email opens a new one
+                if self._smtp is not None:
+                    self._smtp.close()
+                    self._smtp = None
+            finally:
+                self._queue.task_done()
+
+    #Sends the emails still in the queue, at most for `timeout` seconds, then stops the worker and closes the connection
+    async def aclose(self, timeout: float = 10):
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"{self.queue_depth()} emails were not sent before shutdown")
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        await self._disconnect()
+        self._worker = None
+        self._queue = None
+
+    #Returns the queue depth, the delivery counters and the delivery latency histogram
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth(),
+            "max_size": self.max_size,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "connections": self.connections,
+            "delivery_latency_ms": self.delivery_latency_ms.snapshot(),
+        }
+
+
+#The email queue shared by the whole backend process
+email_queue = EmailQueue()
+
 
-    #Send the email
-    await aiosmtplib.send(
-        message,
-        hostname=os.getenv("EMAIL_HOST"),
-        port=int(os.getenv("EMAIL_PORT")),
-        username=os.getenv("EMAIL_USER"),
-        password=os.getenv("EMAIL_PASSWORD"),
-        start_tls=True,
-    )
+#The function takes in the user's email address and the OTP code and queues the OTP email for the user.
+#It returns as soon as the email is queued. The email is sent by the worker of the email queue.
+def send_otp_email(to_email: str, otp: str):
+    email_queue.enqueue(build_otp_email(to_email, otp))
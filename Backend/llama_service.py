@@ -1,25 +1,12 @@
-import requests
-import json
-from data_retrieval_from_RAG import retrieve_relevant_chunks
-
-
-#This system prompt is sent to Llama 3.2 to answer the user's question only based on the context provided.
-system_prompt = """
-You are an AI assistant designed to answer user questions using only the information explicitly provided in the context below. You must not use any external knowledge, assumptions, or generalizations.
-
-- The context will appear after "Context:"
-- The question will appear after "Question:"
-
-Your task is to:
-1. Carefully read and extract only relevant information from the context. Always attach the source information provided in the context with your answer.
-2. Directly answer the question based solely on the extracted information.
-3. You MUST provide the source of the information with your answer.
-4. If the context does not contain enough information to answer the question, clearly state: "The context does not provide enough information to answer this question.". In that case, do not provide any information about the source and context.
-
-
-Important:
-Your entire response must be grounded only in the provided context and the question. Avoid assumptions or filler statements.
-"""
+from contextlib import aclosing
+from dataclasses import dataclass, field
+from fastapi.concurrency import run_in_threadpool
+from data_retrieval_from_RAG import RetrieverEngine, embed_query, retrieve_relevant_chunks
+from semantic_cache import semantic_cache, SEMANTIC_CACHE_ENABLED
+from llm_client import llm_client
+from metrics import span, count
+from prompt_builder import build_payload, build_rag_messages
+from conversation_memory import conversation_memory, ChatHistory, MEMORY_ENABLED
 
 
 #This function checks whether  the user's message is  a greetings message.
@@ -33,56 +20,119 @@ def classify_message(text):
         return "greeting"
 
 
+#Class that holds what is needed to answer the user's message.
+#If a similar question was answered before, cached_answer holds the answer from the semantic cache and no payload is built.
+#Otherwise payload is sent to Llama 3.2, and the query embedding, the sources and the collection version are kept to store the answer in the semantic cache.
+#rerank_path records which path the request took through the re-ranking step.
+@dataclass
+class LlamaRequest:
+    payload: dict | None = None
+    cached_answer: str | None = None
+    sources: list[str] = field(default_factory=list)
+    query_embedding: object = None
+    collection_version: str | None = None
+    rerank_path: str | None = None
+
+
+#This function prepares the request that is sent to Llama 3.2 for the user's message
+# If the user's message is not a greeting, it first looks for a similar question in the semantic cache.
+# If there is none, it sends the user's message to the RAG pipeline to retrieve the top 5 most relevant chunks
+# and puts the user's message and the relevant chunks in the payload together with the system prompt
+# search_query is the question used for the semantic cache and the retrieval, when the user's message was rewritten into a standalone question.
+# history holds the summary and the latest messages of the conversation, which are sent between the system prompt and the question.
+def prepare_llama_request(user_message: str, search_query: str | None = None, history: ChatHistory | None = None) -> LlamaRequest:
+    #If the user's message is a greeting, it is sent to Llama 3.2 as is
+    if classify_message(user_message) == "greeting":
+        prompt = f"{user_message}"
+
+        payload = build_payload([{"role": "user", "content": prompt}])
+        return LlamaRequest(payload=payload)
+
+    #The embedding of the question is used both for the semantic cache and for the similarity search
+    search_query = search_query or user_message
+    with span("embed"):
+        query_embedding = embed_query(search_query)
+    collection_version = RetrieverEngine.get_instance().collection_version()
+    if SEMANTIC_CACHE_ENABLED:
+        with span("semantic_cache"):
+            cached = semantic_cache.lookup(query_embedding, collection_version)
+        count("semantic_cache_lookups", "Lookups in the semantic cache by result.", result="hit" if cached else "miss")
+        if cached:
+            answer, sources = cached
+            return LlamaRequest(cached_answer=answer, sources=sources)
+
+    # Retrieve relevant chunks from RAG
+    relevant_chunks, sources, rerank_path = retrieve_relevant_chunks(search_query, query_embedding=query_embedding)
+
+    #The payload is the prompt that is sent to Llama 3.2. The system prompt is the instructions for the model, the history of the conversation follows,
+    #and the user prompt with the relevant chunks and the question comes last, so that the prompt starts with the parts that change the least.
+    #The question is the user's own message: the rewritten question only serves the search, and the history already gives the model the context of a follow-up.
+    with span("prompt_build"):
+        messages = build_rag_messages(relevant_chunks, user_message, history.to_messages() if history else None)
+        payload = build_payload(messages)
+
+    return LlamaRequest(
+        payload=payload,
+        sources=sources,
+        query_embedding=query_embedding,
+        collection_version=collection_version,
+        rerank_path=rerank_path,
+    )
+
+
+#This function prepares the request that is sent to Llama 3.2 for a message saved in a conversation.
+#It loads the history of the conversation before the message, and rewrites a follow-up question into a standalone question,
+#so that the semantic cache and the retrieval look for what the user is asking about, then calls prepare_llama_request.
+async def prepare_conversation_request(user_msg) -> LlamaRequest:
+    if not MEMORY_ENABLED or classify_message(user_msg.message) == "greeting":
+        return await run_in_threadpool(prepare_llama_request, user_msg.message)
+
+    with span("memory_load"):
+        history = await conversation_memory.load(user_msg.conversation_id, user_msg.id)
+    with span("query_rewrite"):
+        search_query = await conversation_memory.rewrite_query(history, user_msg.message)
+    #Embedding, retrieval and re-ranking are CPU bound, so they run in the threadpool instead of the event loop
+    return await run_in_threadpool(prepare_llama_request, user_msg.message, search_query, history)
+
+
+#This function stores the answer of Llama 3.2 in the semantic cache so that similar questions can reuse it
+def remember_answer(request: LlamaRequest, answer: str):
+    if SEMANTIC_CACHE_ENABLED and request.query_embedding is not None and answer:
+        semantic_cache.store(request.query_embedding, answer, request.sources, request.collection_version)
+
+
 #This function gets the response from Llama 3.2 based on the user's message
 # It takes the user's message and sends it to the RAG pipeline to retrieve the top 5 most relevant chunks
 # After retrieving the relevant chunks, it sends the user's message and the relevant chunks to Llama 3.2 to get the response and returns the response
-def get_llama_response(current_user_message: str) -> str:
-    #The URL of the Llama 3.2 API endpoint in Ollama if we are running it locally
-    url = "http://localhost:11434/api/chat"
+# If a similar question is in the semantic cache, the cached answer is returned without calling Llama 3.2
+async def get_llama_response(current_user_message) -> str:
+    request = await prepare_conversation_request(current_user_message)
+    if request.cached_answer is not None:
+        return request.cached_answer
 
-
-
-    #If the user's message is a greeting, it is sent to Llama 3.2 as is
-    if classify_message(current_user_message.message) == "greeting":
-        prompt = f"{current_user_message.message}"
-
-        payload = {
-            "model": "llama3.2",
-            "messages": [
-                {"role": "user", "content": prompt},
-            ]
-        }
-
-        #This receives the response from Llama 3.2
-    else:
-        # Retrieve relevant chunks from RAG
-        relevant_chunks = retrieve_relevant_chunks(current_user_message.message)
-
-        # We need to send the user's message and the relevant chunks to Llama 3.2 in a certain format. We are structuring the prompt to be sent to Llama 3.2.
-        prompt = f"""
-        Context:
-        {relevant_chunks}
-
-        Question:
-        {current_user_message.message}
-        """
-
-        #The payload is the prompt that is sent to Llama 3.2. The system prompt is the instructions for the model. The user prompt is the user's message and the relevant chunks.
-        payload = {
-            "model": "llama3.2",
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt},
-            ]
-        }
-
-    response = requests.post(url, json=payload, stream=False)
     #We send the full response from Llama 3.2 to the user at once, not streaming it.
-    full_response = ""
-    for line in response.iter_lines():
-        if line:
-            data = json.loads(line.decode('utf-8'))
-            if "message" in data and "content" in data["message"]:
-                full_response += data["message"]["content"]
-    print(full_response)
-    return full_response
\ No newline at end of file
+    with span("llm"):
+        data = await llm_client.chat(request.payload)
+    full_response = data.get("message", {}).get("content", "")
+    remember_answer(request, full_response)
+    return full_response
+
+
+#This function streams the response from Llama 3.2 for the request prepared by prepare_conversation_request.
+#It yields the tokens as Ollama produces them. Ollama sends one JSON object per line and the last line has "done" set to true.
+#A cached answer is yielded at once. A complete answer is stored in the semantic cache.
+#Closing the generator closes the connection to Ollama, which makes Ollama stop generating the answer.
+async def stream_llama_response(request: LlamaRequest):
+    if request.cached_answer is not None:
+        yield request.cached_answer
+        return
+
+    tokens = []
+    async with aclosing(llm_client.stream_chat(request.payload)) as lines:
+        async for data in lines:
+            if "message" in data and data["message"].get("content"):
+                tokens.append(data["message"]["content"])
+                yield data["message"]["content"]
+            if data.get("done"):
+                remember_answer(request, "".join(tokens))
+                break
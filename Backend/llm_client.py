@@ -0,0 +1,269 @@
+import os
+import json
+import time
+import asyncio
+import httpx
+from datetime import datetime
+from dotenv import load_dotenv
+from batching import Histogram
+from metrics import METRICS_ENABLED, record_stage
+
+#Load the environment variables that store the settings of the connection to Ollama
+load_dotenv()
+
+#Settings of the connection to Ollama. They can be overridden in the .env file.
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))  # seconds to open a connection to Ollama
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "120"))  # seconds to wait for the next chunk of the response
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))  # generations sent to Ollama at the same time, the rest wait in line
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", "0.5"))  # seconds before the first retry, doubled for every retry
+LLM_LOG_TIMINGS = os.getenv("LLM_LOG_TIMINGS", "true").lower() == "true"  # print the prompt evaluation and generation timings of every answer
+
+#Settings of the model. Every request must use the same num_ctx: Ollama loads the model again when it changes, which also drops the cached prompt.
+LLM_MODEL = os.getenv("LLM_MODEL", "llama3.2")
+LLM_KEEP_ALIVE = os.getenv("LLM_KEEP_ALIVE", "30m")  # how long Ollama keeps the model loaded after a request
+LLM_NUM_CTX = int(os.getenv("LLM_NUM_CTX", "8192"))  # context window, in tokens
+
+#Settings of the keep-warm pings, which keep the model loaded during the hours the app is used, even without requests
+LLM_KEEP_WARM_HOURS = os.getenv("LLM_KEEP_WARM_HOURS", "8-23")  # local hours, start included and end excluded, for example "8-23" or "22-6". Empty to turn the pings off.
+LLM_KEEP_WARM_INTERVAL = float(os.getenv("LLM_KEEP_WARM_INTERVAL", "240"))  # seconds between two pings. Must be shorter than LLM_KEEP_ALIVE.
+
+#Upper bounds of the buckets of the prompt token histograms
+PROMPT_TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192)
+
+#Errors that happen before Ollama starts working on the request, so the request can safely be sent again
+TRANSIENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.RemoteProtocolError)
+#Status codes Ollama returns when it is busy or restarting
+TRANSIENT_STATUS_CODES = {429, 502, 503, 504}
+
+
+#Raised when Ollama cannot be reached or does not answer in time
+class LLMError(Exception):
+    pass
+
+
+#Class to send chat requests to Ollama.
+#It keeps a pool of keep-alive connections so that a request does not open a new TCP connection to Ollama,
+#puts a timeout on connecting and on every read so that a hung model cannot stall the server,
+#limits how many generations are sent to Ollama at the same time, and retries the request if the error is transient.
+class LLMClient:
+    def __init__(
+        self,
+        base_url: str = OLLAMA_BASE_URL,
+        connect_timeout: float = LLM_CONNECT_TIMEOUT,
+        read_timeout: float = LLM_READ_TIMEOUT,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        max_retries: int = LLM_MAX_RETRIES,
+        retry_backoff: float = LLM_RETRY_BACKOFF,
+    ):
+        self.base_url = base_url
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._client = None
+        self._semaphore = None
+        self.last_request = 0.0
+        self.answers = 0
+        self.prompt_eval_tokens = Histogram(PROMPT_TOKEN_BUCKETS)
+        self.prompt_eval_ms = 0.0
+        self.eval_tokens = 0
+        self.eval_ms = 0.0
+        self.load_ms = 0.0
+
+    #The HTTP client and the semaphore are created on first use so that they belong to the running event loop
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    #Waits before the next retry. The wait is doubled for every retry.
+    async def _backoff(self, attempt: int):
+        await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+
+    #Records the timings Ollama returns with the end of an answer, and prints them if LLM_LOG_TIMINGS is set.
+    #prompt_eval_count only counts the prompt tokens Ollama had to evaluate: the tokens of a prefix that is still in its cache are not counted,
+    #so a low prompt_eval_count on a long prompt shows that the prefix was reused. The durations are in nanoseconds.
+    def record_timings(self, data: dict):
+        if "eval_count" not in data and "prompt_eval_count" not in data:
+            return
+        prompt_tokens = data.get("prompt_eval_count", 0)
+        prompt_ms = data.get("prompt_eval_duration", 0) / 1e6
+        eval_tokens = data.get("eval_count", 0)
+        eval_ms = data.get("eval_duration", 0) / 1e6
+        load_ms = data.get("load_duration", 0) / 1e6
+        self.answers += 1
+        self.prompt_eval_tokens.observe(prompt_tokens)
+        self.prompt_eval_ms += prompt_ms
+        self.eval_tokens += eval_tokens
+        self.eval_ms += eval_ms
+        self.load_ms += load_ms
+        #The stages Ollama measured are added to the stages of the request, so the prompt evaluation and the generation show up separately
+        if METRICS_ENABLED:
+            record_stage("ollama_load", load_ms / 1000)
+            record_stage("ollama_prompt_eval", prompt_ms / 1000)
+            record_stage("ollama_eval", eval_ms / 1000)
+        if LLM_LOG_TIMINGS:
+            print(
+                f"Ollama timings: load {load_ms:.0f}ms, prompt {prompt_tokens} tokens in {prompt_ms:.0f}ms, "
+                f"answer {eval_tokens} tokens in {eval_ms:.0f}ms ({eval_tokens / max(eval_ms / 1000, 1e-9):.1f} tokens/s)"
+            )
+
+    #Sends the payload to the chat API of Ollama and returns the full answer at once
+    async def chat(self, payload: dict) -> dict:
+        client = self._get_client()
+        self.last_request = time.monotonic()
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await client.post("/api/chat", json={**payload, "stream": False})
+                    if response.status_code in TRANSIENT_STATUS_CODES and attempt < self.max_retries:
+                        await self._backoff(attempt)
+                        continue
+                    response.raise_for_status()
+                    data = response.json()
+                    self.record_timings(data)
+                    return data
+                except TRANSIENT_ERRORS as e:
+                    if attempt == self.max_retries:
+                        raise LLMError(f"Could not reach Ollama: {e}") from e
+                    await self._backoff(attempt)
+                except httpx.HTTPError as e:
+                    raise LLMError(f"Ollama request failed: {e}") from e
+
+    #Sends the payload to the chat API of Ollama and yields every JSON line of the answer as Ollama produces it.
+    #The request is only retried if nothing has been received yet.
+    #Closing the generator closes the connection to Ollama, which makes Ollama stop generating the answer.
+    async def stream_chat(self, payload: dict):
+        client = self._get_client()
+        self.last_request = time.monotonic()
+        async with self._semaphore:
+            received = False
+            for attempt in range(self.max_retries + 1):
+                try:
+                    async with client.stream("POST", "/api/chat", json={**payload, "stream": True}) as response:
+                        if response.status_code in TRANSIENT_STATUS_CODES and attempt < self.max_retries:
+                            await self._backoff(attempt)
+                            continue
+                        response.raise_for_status()
+                        async for line in response.aiter_lines():
+                            if line:
+                                received = True
+                                data = json.loads(line)
+                                if data.get("done"):
+                                    self.record_timings(data)
+                                yield data
+                    return
+                except TRANSIENT_ERRORS as e:
+                    if received or attempt == self.max_retries:
+                        raise LLMError(f"Could not reach Ollama: {e}") from e
+                    await self._backoff(attempt)
+                except httpx.HTTPError as e:
+                    raise LLMError(f"Ollama request failed: {e}") from e
+
+    #Loads the model in Ollama, or keeps it loaded for keep_alive more, without generating anything
+    async def load_model(self, model: str = LLM_MODEL, keep_alive: str = LLM_KEEP_ALIVE):
+        await self.chat({"model": model, "messages": [], "keep_alive": keep_alive, "options": {"num_ctx": LLM_NUM_CTX}})
+
+    #Closes the pooled connections. Called when the server shuts down.
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    #Returns the number of answers and the time Ollama spent loading the model, evaluating the prompts and generating the answers
+    def stats(self) -> dict:
+        return {
+            "model": LLM_MODEL,
+            "num_ctx": LLM_NUM_CTX,
+            "keep_alive": LLM_KEEP_ALIVE,
+            "answers": self.answers,
+            "prompt_eval_tokens": self.prompt_eval_tokens.snapshot(),
+            "prompt_eval_ms": round(self.prompt_eval_ms),
+            "eval_tokens": self.eval_tokens,
+            "eval_ms": round(self.eval_ms),
+            "load_ms": round(self.load_ms),
+        }
+
+
+#The client shared by the whole backend process
+llm_client = LLMClient()
+
+
+#This function parses the keep-warm hours, for example "8-23" into (8, 23). Returns None if the pings are turned off.
+def parse_hours(hours: str) -> tuple[int, int] | None:
+    if not hours.strip():
+        return None
+    start, end = hours.split("-")
+    return int(start), int(end)
+
+
+#Class for the task that keeps the model loaded in Ollama during the configured hours.
+#Every interval seconds, if no request was sent to Ollama during the interval, it asks Ollama to load the model, which restarts the keep_alive timer.
+#Outside of the hours, nothing is sent and Ollama unloads the model keep_alive after the last request, which frees its memory.
+class KeepWarm:
+    def __init__(self, client: LLMClient, hours: str = LLM_KEEP_WARM_HOURS, interval: float = LLM_KEEP_WARM_INTERVAL):
+        self.client = client
+        self.hours_setting = hours
+        self.hours = parse_hours(hours)
+        self.interval = interval
+        self._task = None
+        self.pings = 0
+        self.errors = 0
+
+    #Checks whether the pings should be sent at this time. The hours may wrap around midnight, for example 22-6.
+    def in_hours(self, now: datetime | None = None) -> bool:
+        if self.hours is None:
+            return False
+        hour = (now or datetime.now()).hour
+        start, end = self.hours
+        return start <= hour < end if start <= end else hour >= start or hour < end
+
+    #Starts the task. It is called when the server starts, so that the task belongs to the running event loop.
+    def start(self):
+        if self.hours is not None and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            if self.in_hours() and time.monotonic() - self.client.last_request >= self.interval:
+                try:
+                    await self.client.load_model()
+                    self.pings += 1
+                except LLMError as e:
+                    self.errors += 1
+                    print(f"Error keeping the model warm: {e}")
+            await asyncio.sleep(self.interval)
+
+    #Stops the task. Called when the server shuts down.
+    async def aclose(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {"hours": self.hours_setting, "interval": self.interval, "active": self.in_hours(), "pings": self.pings, "errors": self.errors}
+
+
+#The keep-warm task of the shared client
+keep_warm = KeepWarm(llm_client)
+
+
+#This function sends a payload to Ollama from synchronous code, for example from the scripts of the RAG implementation.
+#A new client is created for the call because the shared client belongs to the event loop of the server.
+def chat_sync(payload: dict) -> dict:
+    async def run():
+        client = LLMClient()
+        try:
+            return await client.chat(payload)
+        finally:
+            await client.aclose()
+
+    return asyncio.run(run())
@@ -1,17 +1,55 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
 from sqlalchemy.orm import Session
-from database import SessionLocal, User, Conversation, Message, Feedback
-from schemas import UserInfo, TitleUpdate, FeedbackRequest
-from llama_service import get_llama_response
+from database import SessionLocal, async_engine, User, Conversation, Message, Feedback
+from schemas import UserInfo, TitleUpdate, FeedbackRequest, ConversationSummary, MessageItem
+from llama_service import get_llama_response, prepare_conversation_request, stream_llama_response
+from llm_client import llm_client, keep_warm, LLMError
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import datetime, UTC
-from email_utils import send_otp_email
+from email_utils import send_otp_email, email_queue, EmailQueueFull
 import random
-from OTP_verification import OTPStore
-from fastapi.responses import PlainTextResponse
+import json
+from OTP_verification import otp_store
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager, aclosing
+from data_retrieval_from_RAG import RetrieverEngine
+from semantic_cache import semantic_cache
+from retrieval_cache import embedding_cache, search_cache, score_cache
+from rerank_policy import rerank_policy
+import message_search
+from chat_persistence import chat_persistence
+from conversation_memory import conversation_memory
+from credentials import hash_password, authenticate
+from rate_limit import RateLimiter, otp_email_limiter, otp_ip_limiter
+from conversation_export import EXPORT_FORMATS, export_file_name, stream_conversation, stream_user_archive
+from pagination import keyset_page, NEXT_CURSOR_HEADER
+from metrics import METRICS_ENABLED, MetricsMiddleware, metrics, span, count, stats_to_gauges
+
+
+#Runs once when the server starts.
+#Loads the embedding model, the vector collection and the cross-encoder and warms them up before the server accepts requests,
+#so that no chat request has to load the models from disk.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    engine = await run_in_threadpool(RetrieverEngine.get_instance)
+    await run_in_threadpool(engine.warmup)
+    #Start the worker that sends the queued emails, and the pings that keep the model loaded in Ollama during the configured hours
+    email_queue.start()
+    keep_warm.start()
+    yield
+    await keep_warm.aclose()
+    #The queued emails are sent before the server stops
+    await email_queue.aclose()
+    #The replies waiting in the write-behind queue are written first
+    await chat_persistence.aclose()
+    await conversation_memory.aclose()
+    #Close the pooled connections to Ollama and to the database when the server shuts down
+    await llm_client.aclose()
+    await async_engine.dispose()
 
 #Initialize the FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 #Allow requests from Flutter app
 app.add_middleware(
@@ -20,8 +58,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, "Server-Timing"],
 )
 
+#Measure the duration of every request, and add the Server-Timing header if it is turned on
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
 #Get the database session
 def get_db():
     db = SessionLocal()
@@ -30,9 +73,21 @@ def get_db():
     finally:
         db.close()
 
+#Records a request in a rate limiter and raises a HTTP exception if the client is over the limit
+#The hit runs in the threadpool, because the database rate limiter writes to the database
+async def check_rate_limit(limiter: RateLimiter, key: str):
+    retry_after = await run_in_threadpool(limiter.hit, key)
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests. Please try again later.",
+            headers={"Retry-After": str(int(retry_after) + 1)},
+        )
+
 #API to register a new user.
 #Receives the user's information as UserInfo schema and adds it to the Users table in the database.
 #If the user's email address already exists in the database, it raises a HTTP exception. So two users cannot have the same email address.
+#The password is stored as a salted scrypt hash, never in plain text. The route runs in the threadpool, so hashing does not block the event loop.
 @app.post("/register")
 def register_user(user: UserInfo, db: Session = Depends(get_db)):
     existing_user = db.query(User).filter(User.email == user.email).first()
@@ -43,7 +98,7 @@ def register_user(user: UserInfo, db: Session = Depends(get_db)):
         first_name=user.first_name,
         last_name=user.last_name,
         email=user.email,
-        password=user.password 
+        password=hash_password(user.password)
     )
     db.add(new_user)
     db.commit()
@@ -62,20 +117,31 @@ def start_conversation(user_id: str, db: Session = Depends(get_db)):
     return {"conversation_id": convo.id}
 
 
-#API to get all the conversations for a user.
-#Receives the user's ID and returns all the conversations for the user in the database.
+#API to get the conversations for a user.
+#Receives the user's ID and returns the conversations for the user in the database.
 #The conversations are ordered by the date and time they were last updated.
-@app.get("/conversations/{user_id}")
-def get_user_conversations(user_id: str, db: Session = Depends(get_db)):
-    return db.query(Conversation).filter_by(user_id=user_id).order_by(Conversation.updated_at.desc()).all()
-
-
-#API to get all the messages for a conversation.
-#Receives the conversation ID and returns all the messages for the conversation in the database.
+#Without a limit, all the conversations are returned. With a limit, one page is returned and the cursor of the next page is set in the X-Next-Cursor header.
+#Only the columns shown in the conversation list are read.
+@app.get("/conversations/{user_id}", response_model=list[ConversationSummary])
+def get_user_conversations(user_id: str, response: Response, limit: int | None = Query(None, ge=1, le=200), cursor: str | None = None, db: Session = Depends(get_db)):
+    query = db.query(Conversation.id, Conversation.title, Conversation.created_at, Conversation.updated_at).filter(Conversation.user_id == user_id)
+    if limit is None:
+        return query.order_by(Conversation.updated_at.desc(), Conversation.id.desc()).all()
+    return keyset_page(query, Conversation.updated_at, Conversation.id, limit, cursor, response)
+
+
+#API to get the messages for a conversation.
+#Receives the conversation ID and returns the messages for the conversation in the database.
 #The messages are ordered by the date and time they were stored in the database.
-@app.get("/messages/{conversation_id}")
-def get_messages(conversation_id: int, db: Session = Depends(get_db)):
-    return db.query(Message).filter_by(conversation_id=conversation_id).order_by(Message.timestamp).all()
+#Without a limit, all the messages are returned. With a limit, the most recent messages before the cursor are returned, still in chronological order,
+#and the cursor of the previous (older) page is set in the X-Next-Cursor header.
+#Only the columns shown in the chat are read.
+@app.get("/messages/{conversation_id}", response_model=list[MessageItem])
+def get_messages(conversation_id: int, response: Response, limit: int | None = Query(None, ge=1, le=500), cursor: str | None = None, db: Session = Depends(get_db)):
+    query = db.query(Message.id, Message.sender, Message.message, Message.timestamp).filter(Message.conversation_id == conversation_id)
+    if limit is None:
+        return query.order_by(Message.timestamp, Message.id).all()
+    return keyset_page(query, Message.timestamp, Message.id, limit, cursor, response)[::-1]
 
 
 #API to update the title of a conversation.
@@ -95,12 +161,12 @@ def update_conversation_title(update: TitleUpdate, db: Session = Depends(get_db)
 #API to send a message to a conversation.
 #Receives the conversation ID, the sender (user or bot), and the message. The sender is usually always the user.
 #At first, We receive the the user's message and store it in the Messages table in the database.
-#Second, we send the user's message to the RAG pipeline to get the llama 3.2 response.
-#Third, we store the llama 3.2 response in the Messages table in the database.
-#Fourth, we update the updated_at field of the conversation in the database.
+#Second, we send the user's message to the RAG pipeline to get the llama 3.2 response. If it fails for any reason, the user's message is deleted again.
+#Third, we store the llama 3.2 response in the Messages table and update the updated_at field of the conversation, in one transaction. If that fails, the user's message is deleted too.
 #Finally, we return the user's message and the llama 3.2 response. User's message is kind of optional here. We had different plans for the user's message.
+#The database is only used in short sessions before and after the LLM call, so that no connection stays checked out while the model answers.
 @app.post("/messages/send")
-def send_message_to_conversation(data: dict, db: Session = Depends(get_db)):
+async def send_message_to_conversation(data: dict):
     
     #Deconstruct the data
     conversation_id = data["conversation_id"]
@@ -108,34 +174,31 @@ def send_message_to_conversation(data: dict, db: Session = Depends(get_db)):
     message = data["message"]
 
     #Store the user's message in the Messages table
-    user_msg = Message(
-        conversation_id=conversation_id,
-        sender=sender,
-        message=message,
-    )
-    db.add(user_msg)
-    db.commit()
-    db.refresh(user_msg)
-
-
-    bot_reply = get_llama_response(current_user_message=user_msg)
-
-
-    # Store the bot's reply in the Messages table
-    bot_msg = Message(
-        conversation_id=conversation_id,
-        sender="bot",
-        message=bot_reply,
-    )
-    db.add(bot_msg)
-    db.commit()
-    db.refresh(bot_msg)
+    with span("db_user_message"):
+        user_msg = await chat_persistence.save_user_message(conversation_id, sender, message)
 
-    #Update the updated_at field of the conversation in the database
-    conversation = db.query(Conversation).filter_by(id=conversation_id).first()
-    if conversation:
-        conversation.updated_at = datetime.now(UTC)
-        db.commit()
+    try:
+        bot_reply = await get_llama_response(current_user_message=user_msg)
+    except LLMError as e:
+        count("errors", "Errors by stage.", stage="llm")
+        await chat_persistence.discard_user_message(user_msg.id)
+        raise HTTPException(status_code=503, detail=str(e))
+    except BaseException:
+        #Any other error, or the cancellation of the request, also leaves the user's message without a reply
+        count("errors", "Errors by stage.", stage="chat")
+        await chat_persistence.discard_user_message(user_msg.id)
+        raise
+
+    # Store the bot's reply in the Messages table and update the updated_at field of the conversation
+    #If the reply cannot be stored, the user's message is deleted as well. A cancellation does not delete it, because the write of the reply is completed anyway.
+    try:
+        with span("db_bot_message"):
+            bot_msg = await chat_persistence.save_bot_reply(conversation_id, bot_reply)
+    except Exception:
+        count("errors", "Errors by stage.", stage="chat")
+        await chat_persistence.discard_user_message(user_msg.id)
+        raise
+    conversation_memory.schedule_refresh(conversation_id)
 
     #Return the user's message and the llama 3.2 response
     return {
@@ -153,6 +216,88 @@ def send_message_to_conversation(data: dict, db: Session = Depends(get_db)):
     }
 
 
+#API to send a message to a conversation and stream the llama 3.2 response back token by token.
+#Receives the same data as /messages/send.
+#The response is newline-delimited JSON (one JSON object per line):
+# 1. {"type": "user_message", ...} once the user's message is stored in the Messages table.
+# 2. {"type": "token", "content": ...} for every token as soon as Ollama produces it.
+# 3. {"type": "bot_message", ...} once the answer is complete and stored in the Messages table, or {"type": "error", ...} if Ollama or the backend fails.
+#    If the answer fails, the user's message is deleted again.
+#If the client disconnects before the answer is complete, the connection to Ollama is closed so that the model stops generating,
+#and the whole turn is dropped: the partial answer is not stored and the user's message is deleted, so the conversation never keeps a question without an answer.
+#Once the answer is complete, it is stored even if the client disconnects while it is written, so the turn is kept whole.
+@app.post("/messages/send-stream")
+async def send_message_to_conversation_stream(data: dict):
+
+    #Deconstruct the data
+    conversation_id = data["conversation_id"]
+    sender = data["sender"]
+    message = data["message"]
+
+    #Store the user's message in the Messages table
+    with span("db_user_message"):
+        user_msg = await chat_persistence.save_user_message(conversation_id, sender, message)
+    user_message_event = {
+        "type": "user_message",
+        "id": user_msg.id,
+        "message": user_msg.message,
+        "timestamp": user_msg.timestamp.isoformat(),
+    }
+
+    #The history of the conversation is loaded and a follow-up question is rewritten before the retrieval
+    try:
+        llama_request = await prepare_conversation_request(user_msg)
+    except BaseException:
+        count("errors", "Errors by stage.", stage="chat")
+        await chat_persistence.discard_user_message(user_msg.id)
+        raise
+
+    async def stream_reply():
+        #The user's message is deleted on every path that does not store a reply: an error of Ollama or of the backend,
+        #a client that disconnects (the generator is closed or cancelled), or a reply that could not be stored.
+        #Once the reply is being stored, the write completes even if the generator is cancelled, so the user's message is kept.
+        replied = False
+        saving = False
+        try:
+            yield json.dumps(user_message_event) + "\n"
+
+            #Closing the token stream when the client disconnects closes the connection to Ollama, which stops the generation
+            tokens = []
+            async with aclosing(stream_llama_response(llama_request)) as token_stream:
+                with span("llm"):
+                    async for token in token_stream:
+                        tokens.append(token)
+                        yield json.dumps({"type": "token", "content": token}) + "\n"
+
+            # Store the bot's reply in the Messages table and update the updated_at field of the conversation
+            saving = True
+            with span("db_bot_message"):
+                bot_msg = await chat_persistence.save_bot_reply(conversation_id, "".join(tokens))
+            replied = True
+            conversation_memory.schedule_refresh(conversation_id)
+            bot_message_event = {
+                "type": "bot_message",
+                "id": bot_msg.id,
+                "message": bot_msg.message,
+                "timestamp": bot_msg.timestamp.isoformat(),
+            }
+
+            yield json.dumps(bot_message_event) + "\n"
+        except LLMError as e:
+            count("errors", "Errors by stage.", stage="llm")
+            yield json.dumps({"type": "error", "detail": str(e)}) + "\n"
+        except Exception as e:
+            saving = False  # the reply was not stored
+            count("errors", "Errors by stage.", stage="chat")
+            print(f"Error answering message {user_msg.id}: {e}")
+            yield json.dumps({"type": "error", "detail": "Failed to generate the answer."}) + "\n"
+        finally:
+            if not replied and not saving:
+                await chat_persistence.discard_user_message(user_msg.id)
+
+    return StreamingResponse(stream_reply(), media_type="application/x-ndjson")
+
+
 #API to delete a conversation.
 #Receives the conversation ID and deletes the conversation from the Conversations table in the database.
 #When a conversation is deleted, all the messages in the conversation are also deleted.
@@ -167,46 +312,45 @@ def delete_conversation(conversation_id: int, db: Session = Depends(get_db)):
     db.commit()
     return {"status": "deleted"}
 
-@app.get("/search-conversations/{user_id}")
-
-
 #API to search for conversations based on the search keyword.
-#Receives the user's ID and the search keyword and returns all the conversations which have messages that match the search keyword.
-#The conversations are ordered by the date and time they were last updated.
+#Receives the user's ID and the search keyword and returns the conversations which have messages that match the search keyword.
+#The search uses the full-text index of the messages: the conversations are ordered by how well their best message matches,
+#and every conversation comes with a snippet of that message where the matched words are highlighted.
+#The results are paginated with limit and offset.
 @app.get("/search-conversations/{user_id}")
-def search_conversations(user_id: str, q: str, db: Session = Depends(get_db)):
-    conversations = (
-        db.query(Conversation)
-        .join(Message)
-        .filter(
-            Conversation.user_id == user_id,
-            Message.message.ilike(f"%{q}%")
-        )
-        .distinct()
-        .order_by(Conversation.updated_at.desc())
-        .all()
-    )
-    return conversations
+def search_conversations(user_id: str, q: str, limit: int = Query(50, ge=1, le=200), offset: int = Query(0, ge=0), db: Session = Depends(get_db)):
+    return message_search.search_conversations(db, user_id, q, limit, offset)
 
 
 #API to request a OTP to verify the user's email address.
 #Receives the user's email address and password and verifies if the user exists in the database.
+#The user is looked up with the async session and the password is verified against its hash in a pool of threads, so the event loop keeps serving other requests meanwhile.
 #If the user exists, it generates a random 6-digit OTP , binds it to the user's email address and sends it to the user's email address.
 #If the user does not exist, it raises a HTTP exception.
+#The requests are rate limited per IP address and, once the password is verified, per email address. Over the limit, it raises a HTTP exception with the time to wait.
+#The rate limiters and the OTP store may use the database, so they are called in the threadpool as well.
 #Returns the status of the operation.
 @app.post("/request-otp")
-async def request_otp(data: dict, db: Session = Depends(get_db)):
+async def request_otp(data: dict, request: Request):
     email = data["email"]
     password = data["password"]
 
-    user = db.query(User).filter_by(email=email, password=password).first()
+    await check_rate_limit(otp_ip_limiter, request.client.host if request.client else "unknown")
+
+    user = await authenticate(email, password)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid email or password")
 
+    await check_rate_limit(otp_email_limiter, email)
+
     otp = str(random.randint(100000, 999999))
-    OTPStore.set_otp(email, otp)
+    await run_in_threadpool(otp_store.set_otp, email, otp)
 
-    await send_otp_email(email, otp)  # ✅ Send email in background
+    #The email is queued and sent by the worker of the email queue, so the request does not wait for the SMTP server
+    try:
+        send_otp_email(email, otp)
+    except EmailQueueFull:
+        raise HTTPException(status_code=503, detail="Failed to send OTP. Please try again later.")
 
     return {"message": "OTP sent to your email"}
 
@@ -220,42 +364,47 @@ def verify_otp(data: dict, db: Session = Depends(get_db)):
     email = data["email"]
     otp = data["otp"]
 
-    verification_result = OTPStore.verify_otp(email, otp)
+    verification_result = otp_store.verify_otp(email, otp)
 
     if verification_result != "OTP verified":
         raise HTTPException(status_code=401, detail=verification_result)
 
     user = db.query(User).filter_by(email=email).first()
-    OTPStore.clear(email)
+    otp_store.clear(email)
     
     return {"user_id": user.email}
 
 
 #API to export a conversation messages.
-#Receives the conversation ID and retrieves all of the messages for that conversation from the database.
-#Then, it formats the messages returns them as a single string.
-@app.get("/conversations/{conversation_id}/messages", response_class=PlainTextResponse)
-def export_conversation(conversation_id: int, db: Session = Depends(get_db)):
-    messages = (
-        db.query(Message)
-        .filter_by(conversation_id=conversation_id)
-        .order_by(Message.timestamp)
-        .all()
-    )
-
-    if not messages:
+#Receives the conversation ID and the format of the export: plain text (txt, the default), JSON Lines (jsonl) or Markdown (md).
+#The messages are read from the database in batches and streamed to the client as they are formatted, so a long conversation is never held in memory.
+@app.get("/conversations/{conversation_id}/messages")
+def export_conversation(conversation_id: int, format: str = Query("txt", pattern="^(txt|jsonl|md)$"), db: Session = Depends(get_db)):
+    convo = db.query(Conversation.title).filter(Conversation.id == conversation_id).first()
+    has_messages = db.query(Message.id).filter(Message.conversation_id == conversation_id).first()
+    if not has_messages:
         raise HTTPException(status_code=404, detail="No messages found")
 
-    lines = []
-    lines.append("========= Conversation Start =========\n")
+    title = convo.title if convo else None
+    media_type, _ = EXPORT_FORMATS[format]
+    file_name = export_file_name(conversation_id, title, format)
+    return StreamingResponse(
+        stream_conversation(SessionLocal, conversation_id, title, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{file_name}"'},
+    )
 
-    for msg in messages:
-        timestamp = msg.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        role = "User" if msg.sender == "user" else "Bot "
-        lines.append(f"[{timestamp}] {role:4}: {msg.message}\n")
 
-    lines.append("\n========= Conversation End =========")
-    return "\n".join(lines)
+#API to export all the conversations of a user.
+#Receives the user's ID and the format of the export, and streams a zip archive with one file per conversation.
+#The archive is written while it is sent, so it is never stored in memory or on disk.
+@app.get("/export-conversations/{user_id}")
+def export_all_conversations(user_id: str, format: str = Query("txt", pattern="^(txt|jsonl|md)$")):
+    return StreamingResponse(
+        stream_user_archive(SessionLocal, user_id, format),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="conversations.zip"'},
+    )
 
 
 #API to submit a feedback.
@@ -310,4 +459,43 @@ def get_feedback(user_id: str, db: Session = Depends(get_db)):
             "design": feedback.design,
             "comments": feedback.comments,
         }
-    raise HTTPException(status_code=404, detail="Feedback not found")
\ No newline at end of file
+    raise HTTPException(status_code=404, detail="Feedback not found")
+
+
+#API to get the statistics of the caches and the batchers used in the chat pipeline.
+#Returns the number of entries and the hit/miss counters of each cache, the batch size and queue depth histograms of each batcher,
+#how many requests took each path through the re-ranking step, the prompt evaluation and generation timings of Ollama and its keep-warm pings, how many commits the chat turns made, how many questions and summaries the conversation memory wrote, the state of the OTP store and rate limits, and the depth and delivery latency of the email queue.
+@app.get("/stats")
+def get_stats():
+    return collect_stats()
+
+
+#API to get the metrics in the Prometheus text format, for a Prometheus server to scrape.
+#It returns the histograms of the duration of every stage of the chat requests and of every HTTP request, the counters of the requests and errors,
+#and the numbers of /stats as gauges, for example chatbot_semantic_cache_hits.
+@app.get("/metrics")
+def get_metrics():
+    lines = metrics.render() + stats_to_gauges(collect_stats())
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+#This function collects the statistics returned by /stats and /metrics
+def collect_stats() -> dict:
+    engine = RetrieverEngine.get_instance()
+    return {
+        "semantic_cache": semantic_cache.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "search_cache": search_cache.stats(),
+        "score_cache": score_cache.stats(),
+        "embedding_batcher": engine.embedding_batcher.stats(),
+        "cross_encoder_batcher": engine.cross_encoder_batcher.stats(),
+        "rerank_policy": rerank_policy.stats(),
+        "llm": llm_client.stats(),
+        "keep_warm": keep_warm.stats(),
+        "chat_persistence": chat_persistence.stats(),
+        "conversation_memory": conversation_memory.stats(),
+        "otp_store": otp_store.stats(),
+        "email_queue": email_queue.stats(),
+        "otp_email_limiter": otp_email_limiter.stats(),
+        "otp_ip_limiter": otp_ip_limiter.stats(),
+    }
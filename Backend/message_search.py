@@ -0,0 +1,122 @@
+import re
+import html
+from sqlalchemy import text, bindparam, DateTime
+from sqlalchemy.orm import Session
+from database import Conversation, Message, MESSAGE_SEARCH_ENABLED
+
+#Markers placed around the matched words in the snippets, and the number of words in a snippet
+SNIPPET_START = "<b>"
+SNIPPET_END = "</b>"
+SNIPPET_ELLIPSIS = "..."
+SNIPPET_WORDS = 12
+
+#Control characters that SQLite places around the matched words instead of the markers.
+#They cannot be typed in a message, so the text of the message can be HTML-escaped before they are turned into the markers.
+SNIPPET_START_SENTINEL = "\x02"
+SNIPPET_END_SENTINEL = "\x03"
+
+#Words of a search keyword. Everything else (quotes, operators, punctuation) is dropped so that the keyword typed by the user is never parsed as FTS5 syntax.
+SEARCH_TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+#Best matching message of every conversation of the user, best conversation first.
+#The rank of FTS5 is the BM25 score, where a lower value is a better match.
+#SQLite returns the row of the minimum for the bare columns of a MIN() aggregate, so message_id is the best matching message.
+SEARCH_QUERY = text("""
+    SELECT c.id AS id, c.title AS title, c.created_at AS created_at, c.updated_at AS updated_at,
+           MIN(f.rank) AS score, f.rowid AS message_id
+    FROM messages_fts AS f
+    JOIN messages AS m ON m.id = f.rowid
+    JOIN conversations AS c ON c.id = m.conversation_id
+    WHERE messages_fts MATCH :query AND c.user_id = :user_id
+    GROUP BY c.id
+    ORDER BY score, c.updated_at DESC
+    LIMIT :limit OFFSET :offset
+""").columns(created_at=DateTime, updated_at=DateTime)
+
+#Snippets of the messages returned on one page. They are computed after the pagination so that only the messages shown get a snippet.
+SNIPPET_QUERY = text(f"""
+    SELECT rowid AS message_id, snippet(messages_fts, 0, :start, :end, :ellipsis, {SNIPPET_WORDS}) AS snippet
+    FROM messages_fts
+    WHERE messages_fts MATCH :query AND rowid IN :ids
+""").bindparams(bindparam("ids", expanding=True))
+
+
+#This function turns the keyword typed by the user into an FTS5 query.
+#Every word must appear in the message, and the last word is matched as a prefix so that results appear while the user is still typing.
+#Returns None if the keyword has no words.
+def build_match_query(keyword: str) -> str | None:
+    tokens = SEARCH_TOKEN_PATTERN.findall(keyword)
+    if not tokens:
+        return None
+    terms = [f'"{token}"' for token in tokens]
+    terms[-1] += "*"
+    return " AND ".join(terms)
+
+
+#This function turns a snippet returned by SQLite into HTML: the text of the message is escaped, so that a message containing HTML is shown as text,
+#and only the matched words are wrapped in the markers
+def render_snippet(snippet: str | None) -> str | None:
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(SNIPPET_START_SENTINEL, SNIPPET_START).replace(SNIPPET_END_SENTINEL, SNIPPET_END)
+
+
+#This function searches the conversations of a user with the full-text index of the messages.
+#Returns one page of conversations ordered by the relevance of their best matching message, with a highlighted snippet of that message.
+def search_conversations(db: Session, user_id: str, keyword: str, limit: int, offset: int) -> list[dict]:
+    if not MESSAGE_SEARCH_ENABLED:
+        return scan_conversations(db, user_id, keyword, limit, offset)
+
+    query = build_match_query(keyword)
+    if query is None:
+        return []
+
+    hits = db.execute(SEARCH_QUERY, {"query": query, "user_id": user_id, "limit": limit, "offset": offset}).mappings().all()
+    if not hits:
+        return []
+
+    snippets = dict(db.execute(
+        SNIPPET_QUERY,
+        {"query": query, "ids": [hit["message_id"] for hit in hits], "start": SNIPPET_START_SENTINEL, "end": SNIPPET_END_SENTINEL, "ellipsis": SNIPPET_ELLIPSIS},
+    ).all())
+
+    return [
+        {
+            "id": hit["id"],
+            "title": hit["title"],
+            "created_at": hit["created_at"],
+            "updated_at": hit["updated_at"],
+            "snippet": render_snippet(snippets.get(hit["message_id"])),
+            "score": -hit["score"],
+        }
+        for hit in hits
+    ]
+
+
+#This function searches the conversations of a user by scanning the messages.
+#It is only used when the SQLite library has no FTS5 support. The conversations are ordered by the date and time they were last updated.
+def scan_conversations(db: Session, user_id: str, keyword: str, limit: int, offset: int) -> list[dict]:
+    conversations = (
+        db.query(Conversation)
+        .join(Message)
+        .filter(
+            Conversation.user_id == user_id,
+            Message.message.ilike(f"%{keyword}%")
+        )
+        .distinct()
+        .order_by(Conversation.updated_at.desc())
+        .limit(limit)
+        .offset(offset)
+        .all()
+    )
+    return [
+        {
+            "id": convo.id,
+            "title": convo.title,
+            "created_at": convo.created_at,
+            "updated_at": convo.updated_at,
+            "snippet": None,
+            "score": None,
+        }
+        for convo in conversations
+    ]
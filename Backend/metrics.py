@@ -0,0 +1,182 @@
+import os
+import re
+import time
+import threading
+from contextlib import nullcontext
+from contextvars import ContextVar
+from dotenv import load_dotenv
+from batching import Histogram
+
+#Load the environment variables that store the settings of the metrics
+load_dotenv()
+
+#Settings of the metrics. They can be overridden in the .env file.
+#When the metrics are turned off, span() returns a shared no-op context manager and the middleware is not installed, so nothing is measured.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "false").lower() == "true"  # add a Server-Timing header with the duration of every stage to the responses
+
+#Prefix of the names of the metrics
+METRIC_PREFIX = "chatbot"
+
+#Upper bounds of the buckets of the duration histograms, in seconds
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+#Durations of the stages of the request being handled, in the order they ended. It is None outside of a request or when the metrics are off.
+#The list is shared with the threadpool, so the stages that run there are recorded as well.
+request_timings = ContextVar("request_timings", default=None)
+
+#Shared no-op span, returned when the metrics are off
+NO_SPAN = nullcontext()
+
+
+#This function formats the labels of a metric, for example {stage="embed"}
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+#Class for the metrics measured by the backend: histograms of durations and counters of events, each with labels.
+#The values can be updated from the event loop and from the threadpool at the same time.
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # name -> {labels: Histogram}
+        self._counters = {}  # name -> {labels: value}
+        self._help = {}
+
+    #Adds a duration, in seconds, to the histogram of a metric
+    def observe(self, name: str, seconds: float, help_text: str = "", **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._help.setdefault(name, help_text)
+            histogram = self._histograms.setdefault(name, {}).get(key)
+            if histogram is None:
+                histogram = self._histograms[name][key] = Histogram(DURATION_BUCKETS)
+            histogram.observe(seconds)
+
+    #Adds amount to the counter of a metric
+    def increment(self, name: str, amount: float = 1, help_text: str = "", **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._help.setdefault(name, help_text)
+            counters = self._counters.setdefault(name, {})
+            counters[key] = counters.get(key, 0) + amount
+
+    #Returns the histograms and the counters in the Prometheus text format
+    def render(self) -> list[str]:
+        lines = []
+        with self._lock:
+            for name, series in self._histograms.items():
+                metric = f"{METRIC_PREFIX}_{name}"
+                lines += [f"# HELP {metric} {self._help[name]}", f"# TYPE {metric} histogram"]
+                for labels, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{metric}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{metric}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{metric}_sum{format_labels(labels)} {histogram.total}")
+                    lines.append(f"{metric}_count{format_labels(labels)} {histogram.count}")
+            for name, series in self._counters.items():
+                metric = f"{METRIC_PREFIX}_{name}_total"
+                lines += [f"# HELP {metric} {self._help[name]}", f"# TYPE {metric} counter"]
+                lines += [f"{metric}{format_labels(labels)} {value}" for labels, value in series.items()]
+        return lines
+
+
+#The metrics of the whole backend process
+metrics = MetricsRegistry()
+
+
+#Records the duration of a stage: in the stage histogram, and in the timings of the current request for the Server-Timing header
+def record_stage(stage: str, seconds: float):
+    metrics.observe("stage_duration_seconds", seconds, "Duration of the stages of the requests.", stage=stage)
+    timings = request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+#Class for a span: a context manager that measures the duration of a stage of a request
+class Span:
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record_stage(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+#This function returns a span that measures a stage, for example: with span("embed"): ...
+#When the metrics are off, it returns a shared no-op context manager.
+def span(stage: str):
+    return Span(stage) if METRICS_ENABLED else NO_SPAN
+
+
+#This function counts an event, for example a cache hit or an error. It does nothing when the metrics are off.
+def count(name: str, help_text: str = "", **labels):
+    if METRICS_ENABLED:
+        metrics.increment(name, 1, help_text, **labels)
+
+
+#This function turns the dictionaries returned by the stats() methods of the caches, batchers and queues into Prometheus gauges.
+#Nested dictionaries give longer names, for example email_queue.delivery_latency_ms.mean becomes chatbot_email_queue_delivery_latency_ms_mean.
+#The buckets of the histograms of the stats and the values that are not numbers are left out. They stay available in /stats.
+def stats_to_gauges(stats: dict, prefix: str = METRIC_PREFIX) -> list[str]:
+    lines = []
+    for key, value in stats.items():
+        name = re.sub(r"[^a-zA-Z0-9_]", "_", f"{prefix}_{key}")
+        if isinstance(value, dict):
+            if key != "buckets":
+                lines += stats_to_gauges(value, name)
+        elif isinstance(value, bool):
+            lines += [f"# TYPE {name} gauge", f"{name} {int(value)}"]
+        elif isinstance(value, (int, float)):
+            lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+    return lines
+
+
+#ASGI middleware that measures every HTTP request: a histogram of the durations and a counter of the requests by route, method and status code.
+#The routes are labelled with their path template (for example /messages/{conversation_id}), so the number of series stays bounded.
+#With SERVER_TIMING_ENABLED, a Server-Timing header gives the duration of every stage that ended before the response started.
+#For a streamed response, the stages that run while the answer is streamed are not in the header, but they are in the histograms.
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = []
+        token = request_timings.set(timings)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_timings(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if SERVER_TIMING_ENABLED:
+                    entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings]
+                    entries.append(f"total;dur={(time.perf_counter() - started) * 1000:.1f}")
+                    message.setdefault("headers", [])
+                    message["headers"] = list(message["headers"]) + [(b"server-timing", ", ".join(entries).encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            request_timings.reset(token)
+            route = scope.get("route")
+            labels = {"route": route.path if route is not None else "unmatched", "method": scope["method"]}
+            metrics.observe("http_request_duration_seconds", time.perf_counter() - started, "Duration of the HTTP requests, until the end of the response body.", **labels)
+            metrics.increment("http_requests", 1, "HTTP requests by route, method and status code.", status=str(status), **labels)
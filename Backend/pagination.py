@@ -0,0 +1,45 @@
+import base64
+from datetime import datetime
+from fastapi import HTTPException, Response
+from sqlalchemy import tuple_, or_, and_
+
+#Response header that carries the cursor of the next page. It is absent on the last page.
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+#This function encodes the position of a row in a keyset ordering (its timestamp and its id) as an opaque cursor.
+#Rows stored before the timestamp columns had a default may have no timestamp. Their cursor has an empty timestamp.
+def encode_cursor(timestamp: datetime | None, row_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat() if timestamp else ''},{row_id}".encode()).decode()
+
+
+#This function decodes a cursor made by encode_cursor. Raises a HTTP exception if the cursor is not valid.
+def decode_cursor(cursor: str) -> tuple[datetime | None, int]:
+    try:
+        timestamp, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(",")
+        return (datetime.fromisoformat(timestamp) if timestamp else None), int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+#This function returns the filter of the rows that come after the row of a cursor in the (timestamp, id) ordering, newest first.
+#SQLite sorts the rows without a timestamp last in this ordering, so they come after every row that has one, ordered by id.
+def after_cursor(timestamp_column, id_column, timestamp: datetime | None, row_id: int):
+    if timestamp is None:
+        return and_(timestamp_column.is_(None), id_column < row_id)
+    return or_(tuple_(timestamp_column, id_column) < tuple_(timestamp, row_id), timestamp_column.is_(None))
+
+
+#This function returns one page of a query ordered by (timestamp, id), newest first.
+#Instead of an offset, the page starts right after the row of the cursor. With an index on the filtered column and the timestamp,
+#the database reads only the rows of the page, however deep the page is.
+#One extra row is read to know if there is a next page. If there is, its cursor is set in the response header.
+def keyset_page(query, timestamp_column, id_column, limit: int, cursor: str | None, response: Response) -> list:
+    if cursor is not None:
+        query = query.filter(after_cursor(timestamp_column, id_column, *decode_cursor(cursor)))
+    rows = query.order_by(timestamp_column.desc(), id_column.desc()).limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(getattr(last, timestamp_column.key), getattr(last, id_column.key))
+    return rows
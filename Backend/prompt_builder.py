@@ -0,0 +1,47 @@
+from llm_client import LLM_MODEL, LLM_KEEP_ALIVE, LLM_NUM_CTX
+
+
+#This system prompt is sent to Llama 3.2 to answer the user's question only based on the context provided.
+system_prompt = """
+You are an AI assistant designed to answer user questions using only the information explicitly provided in the context below. You must not use any external knowledge, assumptions, or generalizations.
+
+- The context will appear after "Context:"
+- The question will appear after "Question:"
+
+Your task is to:
+1. Carefully read and extract only relevant information from the context. Always attach the source information provided in the context with your answer.
+2. Directly answer the question based solely on the extracted information.
+3. You MUST provide the source of the information with your answer.
+4. If the context does not contain enough information to answer the question, clearly state: "The context does not provide enough information to answer this question.". In that case, do not provide any information about the source and context.
+
+
+Important:
+Your entire response must be grounded only in the provided context and the question. Avoid assumptions or filler statements.
+"""
+
+
+#This function builds the payload of a chat request to Ollama.
+#Every request goes through it, so that all of them use the same model, keep_alive and num_ctx:
+#a request with another num_ctx would make Ollama load the model again and drop the prompt it has cached.
+#options are the other model options of the request, for example temperature or num_predict.
+def build_payload(messages: list[dict], **options) -> dict:
+    return {
+        "model": LLM_MODEL,
+        "messages": messages,
+        "keep_alive": LLM_KEEP_ALIVE,
+        "options": {"num_ctx": LLM_NUM_CTX, **options},
+    }
+
+
+#This function builds the messages of a question answered from the retrieved context.
+#Ollama reuses the evaluation of the longest prefix a prompt shares with the previous one, so the messages go from the most stable to the least stable:
+# 1. the system prompt, which is the same for every request
+# 2. the history of the conversation, which only grows at its end from one turn to the next
+# 3. the retrieved context and the question, which change with every question
+#The chunks of the context are in a stable order (see CONTEXT_ORDER in data_retrieval_from_RAG.py), so the same chunks always give the same text.
+def build_rag_messages(context: str, question: str, history: list[dict] | None = None) -> list[dict]:
+    return [
+        {"role": "system", "content": system_prompt},
+        *(history or []),
+        {"role": "user", "content": f"Context:\n{context}\nQuestion:\n{question}"},
+    ]
@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from database import SessionLocal, RateLimitWindow
+
+#Load the environment variables that store the settings of the rate limits
+load_dotenv()
+
+#Settings of the rate limits of the OTP requests. They can be overridden in the .env file.
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # "memory" for one server process, "database" to share the counters between several processes
+OTP_EMAIL_LIMIT = int(os.getenv("OTP_EMAIL_LIMIT", "3"))  # OTPs sent to one email address per window
+OTP_EMAIL_WINDOW = float(os.getenv("OTP_EMAIL_WINDOW", "600"))  # seconds
+OTP_IP_LIMIT = int(os.getenv("OTP_IP_LIMIT", "10"))  # OTP requests from one IP address per window
+OTP_IP_WINDOW = float(os.getenv("OTP_IP_WINDOW", "600"))  # seconds
+
+
+#Base class of the rate limiters. A rate limiter allows at most `limit` hits per key in `window` seconds.
+class RateLimiter(ABC):
+    def __init__(self, name: str, limit: int, window: float):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.rejected = 0
+
+    #Records a hit for the key.
+    #Returns 0 if the hit is allowed, or the number of seconds to wait before the next hit is allowed.
+    @abstractmethod
+    def hit(self, key: str) -> float:
+        ...
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "window": self.window, "rejected": self.rejected}
+
+
+#Rate limiter kept in the memory of the server process.
+#It keeps the times of the last hits of every key (a sliding window), and forgets the keys that were not hit during a whole window.
+class MemoryRateLimiter(RateLimiter):
+    def __init__(self, name: str, limit: int, window: float):
+        super().__init__(name, limit, window)
+        self._hits = {}  # key -> times of the hits in the window, oldest first
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def hit(self, key):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep > self.window:
+                self._sweep(now)
+            hits = self._hits.setdefault(key, deque())
+            while hits and hits[0] <= now - self.window:
+                hits.popleft()
+            if len(hits) >= self.limit:
+                self.rejected += 1
+                return hits[0] + self.window - now
+            hits.append(now)
+            return 0
+
+    #Forgets the keys whose last hit is older than the window. The lock must be held.
+    def _sweep(self, now: float):
+        self._hits = {key: hits for key, hits in self._hits.items() if hits and hits[-1] > now - self.window}
+        self._last_sweep = now
+
+    def stats(self):
+        return {**super().stats(), "keys": len(self._hits)}
+
+
+#Rate limiter kept in the rate_limit_windows table of the database, so that all the server processes share the same counters.
+#The hits are counted in fixed windows, with one row per key. The rows of the windows that are over are deleted once per window.
+class DatabaseRateLimiter(RateLimiter):
+    def __init__(self, name: str, limit: int, window: float):
+        super().__init__(name, limit, window)
+        self._last_sweep = time.monotonic()
+
+    def hit(self, key):
+        if time.monotonic() - self._last_sweep > self.window:
+            self._last_sweep = time.monotonic()
+            self.sweep()
+
+        key = f"{self.name}:{key}"
+        now = datetime.now()
+        window_start = now - timedelta(seconds=self.window)
+        with SessionLocal() as db:
+            #Start a new window if the row of the key is missing or its window is over
+            row = db.get(RateLimitWindow, key)
+            if row is None:
+                db.add(RateLimitWindow(key=key, window_start=now, count=1))
+                try:
+                    db.commit()
+                    return 0
+                except IntegrityError:
+                    #Another process created the row at the same time
+                    db.rollback()
+                    row = db.get(RateLimitWindow, key)
+            if row.window_start <= window_start:
+                db.execute(update(RateLimitWindow).where(RateLimitWindow.key == key).values(window_start=now, count=1))
+                db.commit()
+                return 0
+
+            #The count is only increased if it is below the limit, in one statement, so that concurrent hits cannot exceed the limit
+            allowed = db.execute(
+                update(RateLimitWindow)
+                .where(RateLimitWindow.key == key, RateLimitWindow.count < self.limit)
+                .values(count=RateLimitWindow.count + 1)
+            ).rowcount
+            db.commit()
+            if allowed:
+                return 0
+            self.rejected += 1
+            return max((row.window_start - window_start).total_seconds(), 1)
+
+    #Deletes the rows of the windows that are over
+    def sweep(self):
+        with SessionLocal() as db:
+            db.execute(delete(RateLimitWindow).where(
+                RateLimitWindow.key.startswith(f"{self.name}:"),
+                RateLimitWindow.window_start <= datetime.now() - timedelta(seconds=self.window),
+            ))
+            db.commit()
+
+
+#This function creates a rate limiter of the backend selected in the settings
+def create_rate_limiter(name: str, limit: int, window: float, backend: str = RATE_LIMIT_BACKEND) -> RateLimiter:
+    if backend == "memory":
+        return MemoryRateLimiter(name, limit, window)
+    if backend == "database":
+        return DatabaseRateLimiter(name, limit, window)
+    raise ValueError(f"Unknown rate limit backend: {backend}")
+
+
+#The rate limits of the OTP requests: per email address, so that a user's mailbox and the SMTP relay cannot be flooded,
+#and per IP address, so that one client cannot try many accounts
+otp_email_limiter = create_rate_limiter("otp-email", OTP_EMAIL_LIMIT, OTP_EMAIL_WINDOW)
+otp_ip_limiter = create_rate_limiter("otp-ip", OTP_IP_LIMIT, OTP_IP_WINDOW)
@@ -0,0 +1,104 @@
+import os
+import threading
+from dotenv import load_dotenv
+from batching import Histogram
+
+#Load the environment variables that store the settings of the re-ranking
+load_dotenv()
+
+#Settings of the re-ranking policy. They can be overridden in the .env file.
+RERANK_MODE = os.getenv("RERANK_MODE", "always")  # "always", "never", "margin" or "top_m"
+RERANK_MARGIN = float(os.getenv("RERANK_MARGIN", "0.1"))  # in "margin" mode, the cross-encoder is skipped if the best chunk is closer than the second best by this cosine distance
+RERANK_TOP_M = int(os.getenv("RERANK_TOP_M", "5"))  # in "top_m" mode, only the first m candidates are re-ranked
+RERANK_LATENCY_BUDGET_MS = float(os.getenv("RERANK_LATENCY_BUDGET_MS", "0"))  # if the expected re-ranking time is above the budget, the dense order is used. 0 disables the budget.
+
+#Upper bounds of the buckets of the margin histogram
+MARGIN_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.15, 0.2, 0.3, 0.5)
+
+#Paths a request can take through the re-ranking step
+PATH_RERANK = "rerank"  # all the candidates were re-ranked
+PATH_RERANK_TOP_M = "rerank_top_m"  # only the first m candidates were re-ranked
+PATH_SKIP_NEVER = "skip_never"  # re-ranking is disabled
+PATH_SKIP_MARGIN = "skip_margin"  # the dense ranking was confident enough
+PATH_SKIP_OVERLOADED = "skip_overloaded"  # re-ranking would have exceeded the latency budget
+
+
+#Class that decides, for every request, whether the cross-encoder re-ranks the candidates and how many of them.
+#The cross-encoder is the most expensive CPU step of a query, so it is skipped when it would not change the outcome,
+#and when the process is so busy that re-ranking would exceed the latency budget.
+#It counts the path taken by every request and keeps a histogram of the margins of the dense ranking, which are used to tune the threshold.
+class RerankPolicy:
+    def __init__(self, mode: str = RERANK_MODE, margin: float = RERANK_MARGIN, top_m: int = RERANK_TOP_M, latency_budget_ms: float = RERANK_LATENCY_BUDGET_MS):
+        if mode not in ("always", "never", "margin", "top_m"):
+            raise ValueError(f"Unknown re-ranking mode: {mode}")
+        self.mode = mode
+        self.margin = margin
+        self.top_m = top_m
+        self.latency_budget_ms = latency_budget_ms
+        self._lock = threading.Lock()
+        self._ms_per_pair = None  # moving average of the time the cross-encoder takes per (query, chunk) pair
+        self.path_counts = {path: 0 for path in (PATH_RERANK, PATH_RERANK_TOP_M, PATH_SKIP_NEVER, PATH_SKIP_MARGIN, PATH_SKIP_OVERLOADED)}
+        self.margins = Histogram(MARGIN_BUCKETS)
+
+    #Returns the margin between the best and the second best dense distance, or None if it cannot be computed.
+    #The margin is only meaningful if the first candidate is the best dense hit, which is not always the case after the hybrid fusion.
+    @staticmethod
+    def dense_margin(distances: list) -> float | None:
+        known = sorted(distance for distance in distances if distance is not None)
+        if len(known) < 2 or distances[0] != known[0]:
+            return None
+        return known[1] - known[0]
+
+    #Decides how the candidates are re-ranked.
+    #Returns the path and the number of leading candidates to re-rank (0 means the candidates are used in their current order).
+    def decide(self, distances: list, n_candidates: int, queue_depth: int) -> tuple[str, int]:
+        margin = self.dense_margin(distances) if distances else None
+        with self._lock:
+            if margin is not None:
+                self.margins.observe(margin)
+
+            if self.mode == "never":
+                path, n_rerank = PATH_SKIP_NEVER, 0
+            elif self.mode == "margin" and margin is not None and margin >= self.margin:
+                path, n_rerank = PATH_SKIP_MARGIN, 0
+            elif self.mode == "top_m":
+                path, n_rerank = PATH_RERANK_TOP_M, min(self.top_m, n_candidates)
+            else:
+                path, n_rerank = PATH_RERANK, n_candidates
+
+            #The pairs waiting in the cross-encoder queue have to be scored before ours
+            if n_rerank and self.latency_budget_ms and self._ms_per_pair is not None:
+                expected_ms = self._ms_per_pair * (queue_depth + n_rerank)
+                if expected_ms > self.latency_budget_ms:
+                    path, n_rerank = PATH_SKIP_OVERLOADED, 0
+
+            self.path_counts[path] += 1
+            return path, n_rerank
+
+    #Records how long the cross-encoder took for a number of pairs
+    def record_latency(self, pairs: int, seconds: float):
+        if pairs == 0:
+            return
+        ms_per_pair = seconds * 1000 / pairs
+        with self._lock:
+            if self._ms_per_pair is None:
+                self._ms_per_pair = ms_per_pair
+            else:
+                self._ms_per_pair = 0.9 * self._ms_per_pair + 0.1 * ms_per_pair
+
+    #Returns the settings, the path counters and the margin histogram
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "margin_threshold": self.margin,
+                "top_m": self.top_m,
+                "latency_budget_ms": self.latency_budget_ms,
+                "ms_per_pair": self._ms_per_pair,
+                "paths": dict(self.path_counts),
+                "dense_margin": self.margins.snapshot(),
+            }
+
+
+#The policy shared by the whole backend process
+rerank_policy = RerankPolicy()
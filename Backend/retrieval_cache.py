@@ -0,0 +1,79 @@
+import os
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+#Load the environment variables that store the sizes of the caches
+load_dotenv()
+
+#Sizes of the retrieval caches. They can be overridden in the .env file.
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "10000"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "5000"))
+SCORE_CACHE_MAX_ENTRIES = int(os.getenv("SCORE_CACHE_MAX_ENTRIES", "50000"))
+
+
+#Class for a bounded, thread-safe least recently used cache.
+#If a version is given, the cache remembers the version of its entries and drops all of them when it is asked for another version.
+#We use the version of the vector collection so that results of an old index are never returned after a re-ingestion.
+class LRUCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    #Drops all the entries if they belong to another version
+    def _check_version(self, version):
+        if version != self._version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._version = version
+
+    #Returns the value stored for the key, or None if there is none
+    def get(self, key, version=None):
+        with self._lock:
+            self._check_version(version)
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    #Stores the value for the key and evicts the least recently used entry if the cache is full
+    def put(self, key, value, version=None):
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    #Returns the hit/miss counters of the cache
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+#Query text -> embedding. The embedding does not depend on the documents, so this cache is not versioned.
+embedding_cache = LRUCache(EMBEDDING_CACHE_MAX_ENTRIES)
+#(query text, number of results) -> (documents, metadatas, ids, distances) of the similarity search, the distances being None for the chunks found only by BM25
+search_cache = LRUCache(SEARCH_CACHE_MAX_ENTRIES)
+#(query text, chunk id) -> cross-encoder score
+score_cache = LRUCache(SCORE_CACHE_MAX_ENTRIES)
@@ -1,5 +1,6 @@
 from pydantic import BaseModel, Field
 from typing import Optional
+from datetime import datetime
 
 #Schema to store the user's information.
 #This is used in the parameters of the API to register a new user.
@@ -26,3 +27,19 @@ class FeedbackRequest(BaseModel):
     performance: int = Field(ge=1, le=5)
     design: int = Field(ge=1, le=5)
     comments: Optional[str] = None
+
+#Schema of a conversation in the conversation list.
+#Only the columns shown in the list are read from the database.
+class ConversationSummary(BaseModel):
+    id: int
+    title: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+
+#Schema of a message in a conversation.
+#Only the columns shown in the chat are read from the database.
+class MessageItem(BaseModel):
+    id: int
+    sender: str
+    message: str
+    timestamp: datetime
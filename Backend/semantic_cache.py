@@ -0,0 +1,132 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from dotenv import load_dotenv
+
+#Load the environment variables that store the settings of the cache
+load_dotenv()
+
+#Settings of the semantic cache. They can be overridden in the .env file.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))  # minimum cosine similarity between two questions to reuse the answer
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "86400"))  # seconds an answer stays in the cache
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+
+
+#Class that stores the answers of Llama 3.2 keyed on the embedding of the question.
+#A new question whose embedding has a cosine similarity above the threshold with a stored question gets the stored answer and sources,
+#so that repeated questions skip the retrieval, the re-ranking and the generation.
+#The embeddings are kept in one matrix, so a lookup is a single matrix-vector product.
+#Entries are evicted when they are older than the TTL or, if the cache is full, least recently used first.
+#All the entries are dropped when the version of the vector collection changes, i.e. when the documents are re-ingested.
+class SemanticCache:
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, ttl: float = SEMANTIC_CACHE_TTL, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._matrix = None  # one normalized embedding per row, created when the first answer is stored
+        self._valid = np.zeros(max_entries, dtype=bool)  # rows of the matrix that hold an entry
+        self._stored_at = np.zeros(max_entries, dtype=np.float64)  # time.monotonic() when the entry of each row was stored
+        self._entries = OrderedDict()  # row -> (answer, sources), ordered from least to most recently used
+        self._free_rows = list(range(max_entries - 1, -1, -1))
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    #Drops all the entries if the vector collection has changed since they were stored
+    def _check_version(self, version):
+        if version != self._version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._valid[:] = False
+            self._free_rows = list(range(self.max_entries - 1, -1, -1))
+            self._version = version
+
+    #Frees a row of the matrix
+    def _remove(self, row: int):
+        self._entries.pop(row, None)
+        self._valid[row] = False
+        self._free_rows.append(row)
+
+    #Frees the rows whose entry is older than the TTL, so that an expired question can never shadow a fresh one that is slightly less similar
+    def _expire(self):
+        expired = np.flatnonzero(self._valid & (time.monotonic() - self._stored_at > self.ttl))
+        for row in expired:
+            self._remove(int(row))
+        self.expirations += len(expired)
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    #Returns (answer, sources) of the most similar stored question, or None if no stored question is similar enough
+    def lookup(self, embedding, version):
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._check_version(version)
+            self._expire()
+            if not self._entries:
+                self.misses += 1
+                return None
+
+            similarities = self._matrix @ vector
+            similarities[~self._valid] = -1.0
+            row = int(np.argmax(similarities))
+            if similarities[row] < self.threshold:
+                self.misses += 1
+                return None
+
+            answer, sources = self._entries[row]
+            self._entries.move_to_end(row)
+            self.hits += 1
+            return answer, sources
+
+    #Stores the answer and the sources of a question. With a size of 0, nothing is stored, like the other caches.
+    def store(self, embedding, answer: str, sources: list[str], version):
+        if self.max_entries <= 0:
+            return
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._check_version(version)
+            self._expire()
+            if self._matrix is None:
+                self._matrix = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            if not self._free_rows:
+                oldest_row = next(iter(self._entries))
+                self._remove(oldest_row)
+                self.evictions += 1
+
+            row = self._free_rows.pop()
+            self._matrix[row] = vector
+            self._valid[row] = True
+            self._stored_at[row] = time.monotonic()
+            self._entries[row] = (answer, sources)
+
+    #Returns the hit/miss counters of the cache
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": SEMANTIC_CACHE_ENABLED,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+#The cache shared by the whole backend process
+semantic_cache = SemanticCache()
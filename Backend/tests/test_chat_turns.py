@@ -0,0 +1,115 @@
+import os
+import sys
+import asyncio
+import tempfile
+import pytest
+import httpx
+
+#The tests use a database of their own, so the settings are set before the modules of the Backend are imported
+DATA_DIR = tempfile.mkdtemp(prefix="chatbot-test-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(DATA_DIR, 'test.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from database import SessionLocal, async_engine, User, Conversation, Message
+from llm_client import LLMError
+
+
+#Creates a user with one conversation and returns the id of the conversation
+@pytest.fixture
+def conversation_id():
+    with SessionLocal() as db:
+        db.query(Message).delete()
+        db.query(Conversation).delete()
+        db.query(User).delete()
+        db.add(User(first_name="Test", last_name="User", email="test@example.com", password="x"))
+        conversation = Conversation(user_id="test@example.com", title="Test")
+        db.add(conversation)
+        db.commit()
+        return conversation.id
+
+
+#Returns the (sender, message) rows stored for a conversation
+def stored_messages(conversation_id: int) -> list[tuple[str, str]]:
+    with SessionLocal() as db:
+        return [tuple(row) for row in db.query(Message.sender, Message.message).filter(Message.conversation_id == conversation_id).all()]
+
+
+#Sends one message to a route of the app without starting its lifespan, so no model is loaded
+def send(path: str, conversation_id: int) -> httpx.Response:
+    async def run():
+        transport = httpx.ASGITransport(app=main.app, raise_app_exceptions=False)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await client.post(path, json={"conversation_id": conversation_id, "sender": "user", "message": "q1"})
+        finally:
+            await async_engine.dispose()
+
+    return asyncio.run(run())
+
+
+#Stand-ins for the RAG pipeline and Ollama: the answer is generated, or the LLM call fails
+async def prepare(user_msg):
+    return {"messages": []}
+
+
+async def answer(current_user_message):
+    return "a1"
+
+
+async def stream_answer(llama_request):
+    yield "a"
+    yield "1"
+
+
+async def failing_answer(current_user_message):
+    raise LLMError("Ollama is not available")
+
+
+async def failing_stream(llama_request):
+    yield "a"
+    raise LLMError("Ollama is not available")
+
+
+async def failing_save(conversation_id, reply):
+    raise RuntimeError("disk I/O error")
+
+
+@pytest.fixture(autouse=True)
+def pipeline(monkeypatch):
+    monkeypatch.setattr(main, "prepare_conversation_request", prepare)
+    monkeypatch.setattr(main, "get_llama_response", answer)
+    monkeypatch.setattr(main, "stream_llama_response", stream_answer)
+    monkeypatch.setattr(main.conversation_memory, "schedule_refresh", lambda conversation_id: None)
+
+
+def test_send_stores_both_messages(conversation_id):
+    response = send("/messages/send", conversation_id)
+    assert response.status_code == 200
+    assert stored_messages(conversation_id) == [("user", "q1"), ("bot", "a1")]
+
+
+def test_send_stream_stores_both_messages(conversation_id):
+    response = send("/messages/send-stream", conversation_id)
+    assert response.status_code == 200
+    assert '"type": "bot_message"' in response.text
+    assert stored_messages(conversation_id) == [("user", "q1"), ("bot", "a1")]
+
+
+@pytest.mark.parametrize("path", ["/messages/send", "/messages/send-stream"])
+def test_failed_llm_call_leaves_no_user_message(monkeypatch, conversation_id, path):
+    monkeypatch.setattr(main, "get_llama_response", failing_answer)
+    monkeypatch.setattr(main, "stream_llama_response", failing_stream)
+    send(path, conversation_id)
+    assert stored_messages(conversation_id) == []
+
+
+@pytest.mark.parametrize("path", ["/messages/send", "/messages/send-stream"])
+def test_failed_reply_write_leaves_no_user_message(monkeypatch, conversation_id, path):
+    monkeypatch.setattr(main.chat_persistence, "save_bot_reply", failing_save)
+    response = send(path, conversation_id)
+    if path == "/messages/send":
+        assert response.status_code == 500
+    else:
+        assert '"type": "error"' in response.text
+    assert stored_messages(conversation_id) == []
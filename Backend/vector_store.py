@@ -0,0 +1,109 @@
+import os
+import threading
+import chromadb
+from bm25_index import BM25Index
+
+#Name of the collection that stores the embedded documents
+COLLECTION_NAME = "document_qa"
+
+#Layout of the versioned vector store:
+# <root>/versions/<version>/  one complete Chroma DB folder per ingestion, with its BM25 index and ingestion manifest
+# <root>/CURRENT              the name of the version the Backend serves
+#The ingestion command builds a new version next to the one being served and only switches CURRENT once the new version is validated.
+VERSIONS_DIR = "versions"
+CURRENT_FILE = "CURRENT"
+
+#Name used for the Chroma DB folder of the Backend before the store was versioned
+LEGACY_VERSION = "legacy"
+
+
+#This function returns the folder of a version of the vector store
+def version_path(root: str, version: str) -> str:
+    return os.path.join(root, VERSIONS_DIR, version)
+
+
+#This function returns the names of all the versions of the vector store, oldest first
+def list_versions(root: str) -> list[str]:
+    path = os.path.join(root, VERSIONS_DIR)
+    if not os.path.isdir(path):
+        return []
+    return sorted(name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name)))
+
+
+#This function returns the name of the version the Backend serves, or None if no version has been published yet
+def read_current_version(root: str) -> str | None:
+    try:
+        with open(os.path.join(root, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+#This function publishes a version. The pointer is written to a temporary file and renamed,
+#so that a reader sees either the old or the new version and never a half-written pointer.
+def set_current_version(root: str, version: str):
+    path = os.path.join(root, CURRENT_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+#This function returns the name and the folder of the version to serve.
+#If no version has been published yet, the Chroma DB folder the Backend used before the store was versioned is served.
+def resolve_active_store(root: str, legacy_path: str) -> tuple[str, str]:
+    version = read_current_version(root)
+    if version is not None and os.path.isdir(version_path(root, version)):
+        return version, version_path(root, version)
+    return LEGACY_VERSION, legacy_path
+
+
+#This function opens the collection stored in a Chroma DB folder
+#For similarity search, we use the "cosine" distance metric
+def open_collection(path: str, embedding_function=None) -> chromadb.Collection:
+    chroma_client = chromadb.PersistentClient(path=path)
+    return chroma_client.get_or_create_collection(
+        name=COLLECTION_NAME,
+        embedding_function=embedding_function,
+        metadata={"hnsw:space": "cosine"},
+    )
+
+
+#Class for one version of the vector store: the Chroma collection and the BM25 index stored in one folder.
+#A request takes the current store once and uses it for all of its lookups, so it never mixes the results of two versions.
+class VectorStore:
+    def __init__(self, name: str, path: str, embedding_function=None):
+        self.name = name
+        self.path = path
+        self.collection = open_collection(path, embedding_function)
+        self._sparse_index = None
+        self._sparse_index_version = None
+        self._sparse_index_lock = threading.Lock()
+
+    #Returns a stamp that changes whenever the documents served change.
+    #It contains the name of the version, and the modification times of the SQLite files of Chroma, which change on every upsert and delete.
+    def version(self) -> str:
+        modified = 0
+        for file_name in ("chroma.sqlite3", "chroma.sqlite3-wal"):
+            try:
+                modified = max(modified, os.stat(os.path.join(self.path, file_name)).st_mtime_ns)
+            except FileNotFoundError:
+                pass
+        return f"{self.name}:{self.collection.id}:{modified}"
+
+    #Returns the BM25 index of the collection.
+    #The index saved next to the collection at ingestion time is loaded. If it is missing or does not match the collection, it is rebuilt and saved.
+    #The index is reloaded whenever the version of the collection changes.
+    def get_sparse_index(self) -> BM25Index:
+        version = self.version()
+        if version != self._sparse_index_version:
+            with self._sparse_index_lock:
+                if version != self._sparse_index_version:
+                    index = BM25Index.load(self.path)
+                    if index is None or len(index) != self.collection.count():
+                        index = BM25Index.build_from_collection(self.collection)
+                        index.save(self.path)
+                    self._sparse_index = index
+                    self._sparse_index_version = version
+        return self._sparse_index
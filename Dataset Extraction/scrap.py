@@ -1,8 +1,20 @@
-import requests
+import httpx
 from bs4 import BeautifulSoup
+from datetime import datetime, UTC
+from urllib.parse import urlsplit
+import argparse
+import asyncio
+import hashlib
 import json
 import os
 
+# lxml parses pages several times faster than Python's html.parser. It is used when it is installed.
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
 # List of URLs to scrape (Keys before colon will be used as filenames)
 urls = {
     "Admission": "https://www.ualberta.ca/en/computing-science/graduate-studies/programs-and-admissions/applications-and-admissions/index.html",
@@ -15,18 +27,27 @@ urls = {
     "Multimedia": "https://www.ualberta.ca/en/computing-science/graduate-studies/programs-and-admissions/multimedia.html"
 }
 
-# Create output directory
+# Output directory
 output_dir = "scraped_pages"
-os.makedirs(output_dir, exist_ok=True)
 
-# Function to fetch webpage content
-def fetch_webpage(url):
-    response = requests.get(url)
-    if response.status_code == 200:
-        return BeautifulSoup(response.text, "html.parser")
-    else:
-        print(f"Failed to fetch {url}")
-        return None
+# The fetch cache remembers the ETag, the Last-Modified date and the hash of every page, so that the next run only downloads and processes the pages that changed.
+# The raw HTML of every page is kept in the html folder, so that the text and JSON files can be written again without downloading the page.
+FETCH_CACHE_FILE = "fetch_cache.json"
+HTML_DIR = "html"
+# The change manifest lists what the last run found for every page. The ingestion reads it to only process the pages that changed.
+CHANGE_MANIFEST_FILE = "changes.json"
+
+# Default settings of the crawler
+PER_HOST_CONCURRENCY = 4  # requests sent to the same host at the same time
+MAX_CONNECTIONS = 20  # connections of the shared pool, for all the hosts together
+REQUEST_TIMEOUT = 30  # seconds
+MAX_RETRIES = 2
+USER_AGENT = "UofA-Graduate-Application-Assistant-Crawler/1.0"
+
+
+# Function to parse webpage content
+def parse_webpage(html):
+    return BeautifulSoup(html, HTML_PARSER)
 
 # Extract **ALL** text from page (headings, paragraphs, tables, links)
 def extract_content(soup):
@@ -41,7 +62,7 @@ def extract_content(soup):
 
     sections["Text Content"] = "\n".join(content)
 
-    # Extract tables 
+    # Extract tables
     tables = soup.find_all("table")
     table_data = []
     for table in tables:
@@ -73,30 +94,181 @@ def extract_content(soup):
 
     return sections
 
+# Write a file through a temporary file, so that an interrupted run never leaves a half-written file
+def write_file(filename, content):
+    with open(filename + ".tmp", "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(filename + ".tmp", filename)
+
 # Save extracted content to a text file
 def save_to_text_file(sections, filename):
-    with open(filename, "w", encoding="utf-8") as f:
-        for title, content in sections.items():
-            f.write(f"{title}:\n{content}\n\n")
+    write_file(filename, "".join(f"{title}:\n{content}\n\n" for title, content in sections.items()))
     print(f"Saved text file: {filename}")
 
-# Run the scraper for multiple URLs
-for filename_prefix, url in urls.items():
-    soup = fetch_webpage(url)
-    if soup:
-        structured_data = extract_content(soup)
+# Load a JSON file, or return the default if it does not exist
+def load_json(filename, default):
+    if not os.path.exists(filename):
+        return default
+    with open(filename, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+# Paths of the files written for a page
+def page_files(directory, name):
+    return {
+        "html_file": os.path.join(directory, HTML_DIR, f"{name}.html"),
+        "text_file": os.path.join(directory, f"{name}.txt"),
+        "json_file": os.path.join(directory, f"{name}.json"),
+    }
+
+# Parse a page and save its text and JSON files. It runs in a thread, so the downloads go on while pages are parsed.
+def process_page(html, files):
+    structured_data = extract_content(parse_webpage(html))
+
+    # Save text file
+    save_to_text_file(structured_data, files["text_file"])
+
+    # Save JSON file
+    write_file(files["json_file"], json.dumps(structured_data, indent=4))
+    print(f"Saved JSON file: {files['json_file']}")
+
+
+# Class for the crawler. It downloads the pages concurrently over one pool of connections, with at most per_host requests to the same host at the same time.
+# A page that was downloaded before is requested with If-None-Match / If-Modified-Since, so that the server can answer 304 Not Modified without the page.
+# A page is only parsed and saved again if its content changed.
+class Crawler:
+    def __init__(self, directory=output_dir, per_host=PER_HOST_CONCURRENCY, max_connections=MAX_CONNECTIONS,
+                 timeout=REQUEST_TIMEOUT, max_retries=MAX_RETRIES, force=False):
+        self.directory = directory
+        self.per_host = per_host
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.force = force
+        self.semaphores = {}  # host -> semaphore limiting the requests sent to the host
+        self.cache = load_json(os.path.join(directory, FETCH_CACHE_FILE), {})
+
+    # Semaphore of the host of a URL. It is created the first time the host is seen.
+    def host_semaphore(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.per_host)
+        return self.semaphores[host]
 
-        # Generate filenames using the key before the colon
-        text_filename = os.path.join(output_dir, f"{filename_prefix}.txt")
-        json_filename = os.path.join(output_dir, f"{filename_prefix}.json")
+    # Download a page. Returns the response, or None if the page could not be downloaded.
+    # Connection errors and server errors are retried with a backoff.
+    async def download(self, client, url, headers):
+        async with self.host_semaphore(url):
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await client.get(url, headers=headers)
+                    if response.status_code < 500 or attempt == self.max_retries:
+                        return response
+                except httpx.HTTPError as e:
+                    if attempt == self.max_retries:
+                        print(f"Failed to fetch {url}: {e}")
+                        return None
+                await asyncio.sleep(2 ** attempt)
+
+    # Fetch one page and save it if it changed. Returns the entry of the page in the change manifest.
+    # The status is "new", "changed", "unchanged" or "failed". The files of a page that failed are kept from the previous run.
+    # An error while parsing or saving a page only fails that page, so the other pages and the manifest are still written.
+    async def crawl_page(self, client, name, url):
+        try:
+            return await self.fetch_page(client, name, url)
+        except Exception as e:
+            print(f"Failed to process {url}: {e}")
+            cached = self.cache.get(name) if self.cache.get(name, {}).get("url") == url else None
+            return {"url": url, **page_files(self.directory, name), "status": "failed", "content_hash": cached.get("content_hash") if cached else None}
+
+    # Body of crawl_page. The entry of the page in the fetch cache is only updated once the page is saved,
+    # so a page whose processing failed is downloaded and processed again on the next run.
+    async def fetch_page(self, client, name, url):
+        files = page_files(self.directory, name)
+        cached = self.cache.get(name) if self.cache.get(name, {}).get("url") == url else None
+        outputs_exist = all(os.path.exists(path) for path in files.values())
+
+        # Ask the server to send the page only if it changed since the last run
+        headers = {}
+        if cached and outputs_exist and not self.force:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        response = await self.download(client, url, headers)
+        entry = {"url": url, **files}
+        if response is None or (response.status_code != 304 and response.status_code != 200):
+            if response is not None:
+                print(f"Failed to fetch {url}: HTTP {response.status_code}")
+            return {**entry, "status": "failed", "content_hash": cached.get("content_hash") if cached else None}
+
+        if response.status_code == 304:
+            return {**entry, "status": "unchanged", "content_hash": cached["content_hash"]}
+
+        # Servers that do not send validators always answer 200, so the content is compared with the last run as well
+        content_hash = hashlib.sha256(response.content).hexdigest()
+        cache_entry = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content_hash": content_hash,
+            "fetched_at": datetime.now(UTC).isoformat(),
+        }
+        if cached and outputs_exist and not self.force and cached.get("content_hash") == content_hash:
+            self.cache[name] = cache_entry
+            return {**entry, "status": "unchanged", "content_hash": content_hash}
+
+        write_file(files["html_file"], response.text)
+        await asyncio.to_thread(process_page, response.text, files)
+        self.cache[name] = cache_entry
+        return {**entry, "status": "changed" if cached else "new", "content_hash": content_hash}
+
+    # Crawl all the pages and write the fetch cache and the change manifest.
+    # Pages that were in the fetch cache but are not in pages any more are listed as "removed" and their files are deleted.
+    async def crawl(self, pages):
+        os.makedirs(os.path.join(self.directory, HTML_DIR), exist_ok=True)
+        limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+        async with httpx.AsyncClient(limits=limits, timeout=self.timeout, follow_redirects=True, headers={"User-Agent": USER_AGENT}) as client:
+            results = await asyncio.gather(*(self.crawl_page(client, name, url) for name, url in pages.items()))
+        manifest_pages = dict(zip(pages, results))
+
+        for name in [name for name in self.cache if name not in pages]:
+            files = page_files(self.directory, name)
+            for path in files.values():
+                if os.path.exists(path):
+                    os.remove(path)
+            manifest_pages[name] = {"url": self.cache.pop(name)["url"], **files, "status": "removed", "content_hash": None}
+
+        write_file(os.path.join(self.directory, FETCH_CACHE_FILE), json.dumps(self.cache, indent=4))
+        manifest = {
+            "generated_at": datetime.now(UTC).isoformat(),
+            "parser": HTML_PARSER,
+            "pages": manifest_pages,
+        }
+        write_file(os.path.join(self.directory, CHANGE_MANIFEST_FILE), json.dumps(manifest, indent=4))
+        return manifest
+
+
+# Run the scraper for multiple URLs
+# The URLs can also be read from a JSON file mapping the file names to the URLs, for example to scrape the whole faculty directory
+def main():
+    parser = argparse.ArgumentParser(description="Scrape the web pages used by the chatbot, and only process the pages that changed since the last run.")
+    parser.add_argument("--urls-file", help="JSON file mapping the file names to the URLs. The URLs above are used by default.")
+    parser.add_argument("--output-dir", default=output_dir)
+    parser.add_argument("--per-host", type=int, default=PER_HOST_CONCURRENCY, help="requests sent to the same host at the same time")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS)
+    parser.add_argument("--force", action="store_true", help="download and process every page, even if it did not change")
+    args = parser.parse_args()
 
-        # Save text file
-        save_to_text_file(structured_data, text_filename)
+    pages = load_json(args.urls_file, {}) if args.urls_file else urls
+    crawler = Crawler(args.output_dir, per_host=args.per_host, max_connections=args.max_connections, force=args.force)
+    manifest = asyncio.run(crawler.crawl(pages))
 
-        # Save JSON file
-        with open(json_filename, "w", encoding="utf-8") as f:
-            json.dump(structured_data, f, indent=4)
+    counts = {}
+    for entry in manifest["pages"].values():
+        counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+    print(f" Scraped {len(pages)} webpages with {HTML_PARSER}: " + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
 
-        print(f"Saved JSON file: {json_filename}")
 
-print(" All webpages scraped and saved successfully!")
+if __name__ == "__main__":
+    main()
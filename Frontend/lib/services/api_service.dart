@@ -3,7 +3,7 @@ import 'package:http/http.dart' as http;
 import '../models/message.dart';
 import '../models/conversation.dart';
 import 'package:flutter/foundation.dart' show kIsWeb;
-import 'dart:io' show Platform;
+import 'dart:io' show File, Platform;
 
 
 class ApiService {
@@ -252,6 +252,28 @@ class ApiService {
     }
   }
 
+  /*
+  This is the method that is called to download the export of a conversation to a file.
+  It calls the backend API with the conversation id and the format of the export (txt, jsonl or md).
+  The export is streamed by the backend, so it is written to the file as it arrives instead of being held in memory.
+  If the export is not available, the error message is thrown.
+  */
+  static Future<void> downloadConversationExport(int conversationId, File file, {String format = 'txt'}) async {
+    final client = http.Client();
+    try {
+      final request = http.Request('GET', Uri.parse('$baseUrl/conversations/$conversationId/messages?format=$format'));
+      final response = await client.send(request);
+
+      if (response.statusCode == 200) {
+        await response.stream.pipe(file.openWrite());
+      } else {
+        throw Exception('Failed to fetch conversation messages');
+      }
+    } finally {
+      client.close();
+    }
+  }
+
   /*
   This is the method that is called to submit the feedback.
   It calls the backend API with the user's id and the feedback values.
@@ -25,8 +25,8 @@ class DownloadUtils {
 
   /*
   This is the method that is called to download the conversation as a text file.
-  It calls the API service to get the conversation text.
-  It then saves the conversation text to the external storage.
+  It calls the API service to stream the conversation export into a file in the external storage.
+  The export is written as it arrives, so a long conversation is never held in memory.
   */
   static Future<void> downloadConversation({
     required BuildContext context,
@@ -36,13 +36,11 @@ class DownloadUtils {
     try {
       await requestPermission(); // Request permission to manage external storage
 
-      final text = await ApiService.getConversationText(conversationId); // Get the conversation text
-
       // Use raw Android Download directory
       final downloadsPath = "/storage/emulated/0/Download";
       final file = File('$downloadsPath/$title.txt');
 
-      await file.writeAsString(text);
+      await ApiService.downloadConversationExport(conversationId, file); // Stream the conversation export into the file
 
       ScaffoldMessenger.of(context).showSnackBar(
         SnackBar(content: Text("Saved to Downloads: $downloadsPath/$title.txt")),
@@ -1,12 +1,14 @@
 from pathlib import Path
-import requests
-import json
+import sys
 import chromadb
 from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
-from langchain_community.document_loaders import PyMuPDFLoader
-from langchain_core.documents import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from sentence_transformers import CrossEncoder
+from ingestion import ingest_directory
+
+#The LLM client and the BM25 index are shared with the Backend, so we add the Backend folder to the import path
+sys.path.append(str(Path(__file__).resolve().parent.parent / "Backend"))
+from llm_client import chat_sync
+from bm25_index import BM25Index
 
 #This system prompt is sent to Llama 3.2 to answer the user's question only based on the context provided.
 system_prompt = """
@@ -26,6 +28,9 @@ Important:
 Your entire response must be grounded only in the provided context and the question. Avoid assumptions or filler statements.
 """
 
+#The embedding model used for the vector collection
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+
 #This dictionary maps the PDF file names to the URLs of the pages in the University of Alberta website.
 #We use this dictionary to add the URL to the metadata source of the Document object.
 pdf_to_url = {
@@ -46,53 +51,18 @@ pdf_to_url = {
 # 3. Create embeddings for the text chunks
 # 4. Store the embedded chunks in the vectorDB.
 #We call this function to create the vector database with the documents in the data directory. We use this DB in our Mobile app.
+#The ingestion is incremental: files that have not changed since the last run are skipped, and the chunks of removed files are deleted.
+#The PDF files are loaded and chunked in parallel worker processes and the chunks are embedded and upserted in large batches.
 def process_and_store_pdfs_in_directory(directory_path: str):
+    collection = get_vector_collection()
+    embedding_function = SentenceTransformerEmbeddingFunction(model_name=EMBEDDING_MODEL_NAME)
+    changed = ingest_directory(directory_path, collection, embedding_function, EMBEDDING_MODEL_NAME, "./chroma_db", pdf_to_url)
 
-    # Get all PDF files in the provided directory
-    pdf_files = Path(directory_path).rglob("*.pdf")
-    
-    # Process each PDF file in the directory
-    for pdf_file in pdf_files:
-        try:
-            # Process the PDF file and get the document splits
-            with open(pdf_file, "rb") as file:
-                all_splits = process_document(file)
-                
-            # Add the processed document splits to the vector collection
-            add_to_vector_collection(all_splits, pdf_file.stem)
-            
-            # Display success message using print
-            print(f"Successfully processed and added '{pdf_file.stem}' to the vector store.")
-        
-        except Exception as e:
-            # If there is an error, display it
-            print(f"Error processing file '{pdf_file.stem}': {e}")
-
-
-#This function is used to process the PDF files as follows:
-# 1. Convert the PDF file to a temporary file
-# 2. Load the temporary file using PyMuPDFLoader
-# 3. Split the document into smaller chunks
-# 4. Return the list of Document objects containing the chunked text
-def process_document(pdf_file) -> list:
-    try:
-        # Load the document from the temporary file
-        loader = PyMuPDFLoader(pdf_file.name)
-        docs = loader.load()
-        docs[0].metadata["source"] = pdf_to_url[pdf_file.name.split("\\")[-1]] #Change the source of the document from PDF file to the URL of the page in the University of Alberta website
-
-        # Split documents into smaller chunks with a chunk size of 600 and a chunk overlap of 100
-        # The separators are used to split the document into smaller chunks
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=600,
-            chunk_overlap=100,
-            separators=["\n\n", "\n", ".", "?", "!", " ", ""]
-        )
-        return text_splitter.split_documents(docs)
-
-    except Exception as e:
-        # Handle errors with file reading or processing
-        raise IOError(f"Error processing PDF file: {e}")
+    #Build the BM25 index over all the chunks of the collection and save it next to the collection.
+    #The Backend uses it together with the vector search for the hybrid search.
+    if changed:
+        BM25Index.build_from_collection(collection).save("./chroma_db")
+        print("Data added to the vector store!")
 
 
 #This function is used to get the vector collection- Chroma DB. This function is called when the user sends a query to the RAG pipeline.
@@ -100,7 +70,7 @@ def process_document(pdf_file) -> list:
 #The collection name is "document_qa" that stores the embedded documents
 #For similarity search, we use the "cosine" distance metric
 def get_vector_collection() -> chromadb.Collection:
-    embedding_function = SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
+    embedding_function = SentenceTransformerEmbeddingFunction(model_name=EMBEDDING_MODEL_NAME)
     chroma_client = chromadb.PersistentClient(path="./chroma_db")
     return chroma_client.get_or_create_collection(
         name="document_qa",
@@ -109,26 +79,6 @@ def get_vector_collection() -> chromadb.Collection:
     )
 
 
-#This function is used to add the processed document splits to the vector collection
-# 1. Get the vector collection
-# 2. Create a list of documents, metadatas, and ids
-# 3. Upsert the documents, metadatas, and ids into the vector collection
-def add_to_vector_collection(all_splits: list[Document], file_name: str):
-    collection = get_vector_collection()
-    documents, metadatas, ids = [], [], []
-
-    for idx, split in enumerate(all_splits):
-        documents.append(split.page_content) #Add the page content to the list of documents
-        metadatas.append({"source": split.metadata["source"]}) #Add the source to the list of metadatas
-        ids.append(f"{file_name}_{idx}") #Add the id to the list of ids
-
-    collection.upsert(
-        documents=documents,
-        metadatas=metadatas,
-        ids=ids,
-    )
-    print("Data added to the vector store!")
-
 #This function receives a query from the user and returns the top 10 most relevant chunks from the vector collection
 def query_collection(prompt: str, n_results: int = 10):
     collection = get_vector_collection()
@@ -138,8 +88,6 @@ def query_collection(prompt: str, n_results: int = 10):
 #This function is used to call the LLM to answer the user's query.
 #We use this function to test the RAG pipeline before integrating it in the Mobile app.
 def call_llm(context: str, prompt: str) -> str:
-    url = "http://localhost:11434/api/chat"
-    
     #The payload is the prompt that is sent to Llama 3.2. The system prompt is the instructions for the model. The user prompt is the user's message and the relevant chunks.
     payload = {
         "model": "llama3.2",
@@ -155,17 +103,10 @@ def call_llm(context: str, prompt: str) -> str:
         ]
     }
 
-    response = requests.post(url, json=payload, stream=True)
-
-    #We send the full response from Llama 3.2 to the user at once, not streaming it.
-    full_response = ""
-    for line in response.iter_lines():
-        if line:
-            data = json.loads(line.decode("utf-8"))
-            if "message" in data and "content" in data["message"]:
-                full_response += data["message"]["content"]
-
-    return full_response
+    #We receive the full response from Llama 3.2 at once, not streaming it.
+    #The request goes through the same pooled client with timeouts and retries that the Backend uses.
+    response = chat_sync(payload)
+    return response.get("message", {}).get("content", "")
 
 #This function re-ranks the top 10 most relevant chunks from the vector collection using the cross-encoder model and returns the top 5 most relevant chunks to Llama 3.2
 #It also adds the source of the document to the relevant chunks
@@ -183,14 +124,15 @@ def re_rank_cross_encoders(documents: list[str], metadata: list[dict], prompt: s
 
 
 
-#Call this function to process the PDF files and store them in the vector collection
-#process_and_store_pdfs_in_directory("./data")
-
-#Test the RAG pipeline with different prompts
-# prompt = "What is the minimum IELTS score required for MSc application?"
-# top_10_context, corresponding_metadata = query_collection(prompt)
-# top_3_documents = re_rank_cross_encoders(top_10_context, corresponding_metadata, prompt)
-
-# print(call_llm(top_3_documents, prompt))
+#The PDF files are chunked in worker processes, which import this file again, so the calls below only run when the file is run directly
+if __name__ == "__main__":
+    #Call this function to process the PDF files and store them in the vector collection
+    #process_and_store_pdfs_in_directory("./data")
 
+    #Test the RAG pipeline with different prompts
+    # prompt = "What is the minimum IELTS score required for MSc application?"
+    # top_10_context, corresponding_metadata = query_collection(prompt)
+    # top_3_documents = re_rank_cross_encoders(top_10_context, corresponding_metadata, prompt)
 
+    # print(call_llm(top_3_documents, prompt))
+    pass
@@ -0,0 +1,263 @@
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+from pathlib import Path
+import chromadb
+from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
+from sentence_transformers import CrossEncoder
+from ingestion import CHUNK_SIZE, CHUNK_OVERLAP, chunk_pdf
+
+#The retrieval of the Backend and the helpers of its benchmarks are reused, so we add the Backend folder and its benchmarks folder to the import path
+BACKEND_PATH = Path(__file__).resolve().parent.parent / "Backend"
+sys.path += [str(BACKEND_PATH), str(BACKEND_PATH / "benchmarks")]
+from bm25_index import BM25Index
+from data_retrieval_from_RAG import EMBEDDING_MODEL_NAME, CROSS_ENCODER_MODEL_NAME, HYBRID_CANDIDATES, reciprocal_rank_fusion
+from bench_results import percentile, git_commit
+
+#Labelled questions: every question comes with the PDF file that answers it and a short phrase of the answer.
+#A chunk is relevant if it comes from that file and contains the phrase, so the labels do not depend on how the files are chunked.
+QUESTIONS_FILE = "eval_questions.json"
+
+#Value of --cross-encoders that keeps the candidates in the order of the search, without re-ranking
+NO_RERANK = "none"
+
+
+#This function collapses the whitespace and the case of a text, so that a phrase split over two lines of a PDF still matches
+def normalize(text: str) -> str:
+    return " ".join(text.split()).lower()
+
+
+#This function returns the memory used by the process in MB: the current resident set on Linux, the peak on macOS and the other Unix systems.
+#The resource module only exists on Unix, so it is imported here. On Windows the memory is not measured and 0 is returned.
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except OSError:
+        try:
+            import resource
+        except ImportError:
+            return 0.0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+#Class that loads every model once and remembers how much memory it took.
+#The memory of a model is the growth of the process when it was loaded, so it is an estimate, but it is measured the same way for every model.
+class ModelCache:
+    def __init__(self):
+        self.models = {}
+        self.memory_mb = {}
+
+    def get(self, name: str, loader):
+        if name not in self.models:
+            before = rss_mb()
+            self.models[name] = loader(name)
+            self.memory_mb[name] = rss_mb() - before
+            print(f"Loaded {name} ({self.memory_mb[name]:.0f} MB).")
+        return self.models[name]
+
+
+#Class for the index of one chunking of the PDF files with one embedding model: an in-memory Chroma collection and its BM25 index
+class EvalIndex:
+    def __init__(self, client, data_path: str, embedding_function, chunk_size: int, chunk_overlap: int):
+        self.ids, self.documents, self.files = [], [], []
+        for pdf_path in sorted(Path(data_path).glob("*.pdf")):
+            file_name, chunks = chunk_pdf(str(pdf_path), chunk_size, chunk_overlap)
+            for idx, chunk in enumerate(chunks):
+                self.ids.append(f"{pdf_path.stem}_{idx}")
+                self.documents.append(chunk)
+                self.files.append(file_name)
+        self.chunks = {chunk_id: (document, file_name) for chunk_id, document, file_name in zip(self.ids, self.documents, self.files)}
+
+        started = time.perf_counter()
+        embeddings = embedding_function(self.documents)
+        self.collection = client.create_collection(name=f"eval_{len(client.list_collections())}", metadata={"hnsw:space": "cosine"})
+        self.collection.add(ids=self.ids, documents=self.documents, embeddings=embeddings)
+        self.sparse_index = BM25Index.build(self.ids, self.documents)
+        self.build_seconds = time.perf_counter() - started
+        #The vectors are stored as 32-bit floats
+        self.memory_mb = len(embeddings) * len(embeddings[0]) * 4 / 1024 ** 2 if embeddings else 0.0
+
+    #Returns True if a chunk answers the question
+    def is_relevant(self, chunk_id: str, question: dict) -> bool:
+        document, file_name = self.chunks[chunk_id]
+        return file_name == question["source"] and normalize(question["answer"]) in normalize(document)
+
+    #Returns the text and the file of a chunk
+    def __getitem__(self, chunk_id: str) -> tuple[str, str]:
+        return self.chunks[chunk_id]
+
+
+#This function finds the candidates of a question the way query_collection does in the Backend: the dense ranking, fused with the BM25 ranking in hybrid mode.
+#Returns the ids of the candidates, best first.
+def search_candidates(index: EvalIndex, embedding_function, question: str, n_candidates: int, mode: str) -> list[str]:
+    hybrid = mode == "hybrid"
+    query_embedding = embedding_function([question])
+    results = index.collection.query(query_embeddings=query_embedding, n_results=max(n_candidates, HYBRID_CANDIDATES) if hybrid else n_candidates)
+    ids = results.get("ids")[0]
+    if hybrid:
+        ids = reciprocal_rank_fusion([ids, index.sparse_index.search(question, HYBRID_CANDIDATES)])
+    return ids[:n_candidates]
+
+
+#This function re-ranks the candidates with the cross-encoder, as re_rank_cross_encoders does in the Backend. Without a cross-encoder, the order of the search is kept.
+def re_rank(index: EvalIndex, cross_encoder, question: str, candidates: list[str]) -> list[str]:
+    if cross_encoder is None or not candidates:
+        return candidates
+    scores = cross_encoder.predict([(question, index[chunk_id][0]) for chunk_id in candidates]).tolist()
+    return [chunk_id for _, chunk_id in sorted(zip(scores, candidates), key=lambda pair: pair[0], reverse=True)]
+
+
+#This function evaluates one configuration of the search and the re-ranking on every question, for every top_k at once:
+# - recall@k: share of the questions with a relevant chunk among the top_k chunks sent to the LLM
+# - source_recall@k: share of the questions whose file is the source of one of the top_k chunks
+# - candidate_recall: share of the questions with a relevant chunk among the candidates, the most the re-ranking can reach
+# - mrr: mean reciprocal rank of the first relevant chunk in the re-ranked candidates
+# - the latency of the whole retrieval (embedding, search and re-ranking) and of the re-ranking alone, over `repeat` runs of every question
+def evaluate(index: EvalIndex, embedding_function, cross_encoder, questions: list[dict], n_candidates: int, mode: str, top_ks: list[int], repeat: int) -> dict:
+    latencies, rerank_latencies = [], []
+    hits = {k: 0 for k in top_ks}
+    source_hits = {k: 0 for k in top_ks}
+    candidate_hits = 0
+    reciprocal_ranks = 0.0
+
+    for question in questions:
+        for _ in range(max(repeat, 1)):
+            started = time.perf_counter()
+            candidates = search_candidates(index, embedding_function, question["question"], n_candidates, mode)
+            rerank_started = time.perf_counter()
+            ranking = re_rank(index, cross_encoder, question["question"], candidates)
+            finished = time.perf_counter()
+            latencies.append(finished - started)
+            rerank_latencies.append(finished - rerank_started)
+
+        relevant = [index.is_relevant(chunk_id, question) for chunk_id in ranking]
+        candidate_hits += any(relevant)
+        reciprocal_ranks += next((1 / (rank + 1) for rank, is_relevant in enumerate(relevant) if is_relevant), 0.0)
+        for k in top_ks:
+            hits[k] += any(relevant[:k])
+            source_hits[k] += any(index[chunk_id][1] == question["source"] for chunk_id in ranking[:k])
+
+    latencies.sort()
+    rerank_latencies.sort()
+    return {
+        "recall": {k: hits[k] / len(questions) for k in top_ks},
+        "source_recall": {k: source_hits[k] / len(questions) for k in top_ks},
+        "candidate_recall": candidate_hits / len(questions),
+        "mrr": reciprocal_ranks / len(questions),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "rerank_mean_ms": sum(rerank_latencies) / len(rerank_latencies) * 1000,
+    }
+
+
+#This function prints a warning for every question whose answer phrase is in no chunk of its file, which is a mistake in the labels, not in the retrieval
+def check_labels(index: EvalIndex, questions: list[dict]):
+    for question in questions:
+        if not any(index.is_relevant(chunk_id, question) for chunk_id in index.ids):
+            print(f"Warning: no chunk of '{question['source']}' contains '{question['answer']}' (question: {question['question']})")
+
+
+#This function returns the cheapest configuration whose recall@k is at most max_drop below the best recall@k: the one with the lowest p95 latency, then the least memory
+def cheapest_configuration(results: list[dict], max_drop: float) -> dict:
+    best_recall = max(result["recall"] for result in results)
+    eligible = [result for result in results if result["recall"] >= best_recall - max_drop]
+    return min(eligible, key=lambda result: (result["p95_ms"], result["memory_mb"]))
+
+
+#This script evaluates the retrieval offline on the labelled questions of eval_questions.json and the PDF files of the data folder, on CPU.
+#It sweeps the chunking, the embedding model, the search mode, the number of candidates, the cross-encoder and the number of chunks sent to the LLM,
+#and reports for every configuration the recall@k, the MRR, the retrieval latency, the cost of the re-ranking and the memory of the models and the index.
+#Every PDF file is chunked and embedded once per chunking and embedding model, and every model is loaded once.
+#The configuration of the Backend (chunk size 600, overlap 100, 10 candidates, top 5, MiniLM models) is marked with *,
+#and the cheapest configuration that keeps the recall of the best one is printed at the end.
+#Example: python evaluate_retrieval.py --chunk-sizes 400 600 1000 --candidates 5 10 20 --output eval.json
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the quality and the cost of retrieval configurations on labelled questions.")
+    parser.add_argument("--data", default="./data", help="folder with the PDF files")
+    parser.add_argument("--questions", default=QUESTIONS_FILE, help="JSON file of labelled questions")
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[400, CHUNK_SIZE, 1000])
+    parser.add_argument("--chunk-overlaps", type=int, nargs="+", default=[CHUNK_OVERLAP])
+    parser.add_argument("--embedding-models", nargs="+", default=[EMBEDDING_MODEL_NAME, "paraphrase-MiniLM-L3-v2"])
+    parser.add_argument("--cross-encoders", nargs="+", default=[CROSS_ENCODER_MODEL_NAME, "cross-encoder/ms-marco-TinyBERT-L-2-v2", NO_RERANK],
+                        help=f"cross-encoder models, or '{NO_RERANK}' to keep the order of the search")
+    parser.add_argument("--candidates", type=int, nargs="+", default=[5, 10, 20], help="numbers of chunks found by the search and passed to the cross-encoder")
+    parser.add_argument("--top-k", type=int, nargs="+", default=[3, 5], help="numbers of chunks sent to the LLM")
+    parser.add_argument("--modes", nargs="+", choices=["hybrid", "dense"], default=["hybrid", "dense"])
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every question for the latency")
+    parser.add_argument("--max-recall-drop", type=float, default=0.0, help="recall@k the cheapest configuration may lose compared to the best one")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    with open(args.questions, "r", encoding="utf-8") as f:
+        questions = json.load(f)
+    print(f"{len(questions)} labelled questions.")
+
+    client = chromadb.EphemeralClient()
+    embedding_models = ModelCache()
+    cross_encoders = ModelCache()
+    results = []
+
+    for embedding_model, chunk_size, chunk_overlap in itertools.product(args.embedding_models, args.chunk_sizes, args.chunk_overlaps):
+        if chunk_overlap >= chunk_size:
+            continue
+        embedding_function = embedding_models.get(embedding_model, lambda name: SentenceTransformerEmbeddingFunction(model_name=name))
+        index = EvalIndex(client, args.data, embedding_function, chunk_size, chunk_overlap)
+        print(f"Indexed {len(index.ids)} chunks of {chunk_size} characters (overlap {chunk_overlap}) with {embedding_model} in {index.build_seconds:.1f}s.")
+        check_labels(index, questions)
+
+        for cross_encoder_name, mode, n_candidates in itertools.product(args.cross_encoders, args.modes, args.candidates):
+            cross_encoder = None if cross_encoder_name == NO_RERANK else cross_encoders.get(cross_encoder_name, CrossEncoder)
+            evaluation = evaluate(index, embedding_function, cross_encoder, questions, n_candidates, mode, args.top_k, args.repeat)
+            memory_mb = embedding_models.memory_mb[embedding_model] + cross_encoders.memory_mb.get(cross_encoder_name, 0.0) + index.memory_mb
+            for top_k in args.top_k:
+                results.append({
+                    "embedding_model": embedding_model,
+                    "chunk_size": chunk_size,
+                    "chunk_overlap": chunk_overlap,
+                    "chunks": len(index.ids),
+                    "mode": mode,
+                    "candidates": n_candidates,
+                    "cross_encoder": cross_encoder_name,
+                    "top_k": top_k,
+                    "recall": evaluation["recall"][top_k],
+                    "source_recall": evaluation["source_recall"][top_k],
+                    "candidate_recall": evaluation["candidate_recall"],
+                    "mrr": evaluation["mrr"],
+                    "p50_ms": evaluation["p50_ms"],
+                    "p95_ms": evaluation["p95_ms"],
+                    "rerank_mean_ms": evaluation["rerank_mean_ms"],
+                    "memory_mb": memory_mb,
+                    "index_build_s": index.build_seconds,
+                })
+        client.delete_collection(index.collection.name)
+
+    def is_backend_configuration(result):
+        return (result["embedding_model"], result["chunk_size"], result["chunk_overlap"], result["mode"], result["candidates"], result["cross_encoder"], result["top_k"]) == \
+               (EMBEDDING_MODEL_NAME, CHUNK_SIZE, CHUNK_OVERLAP, "hybrid", 10, CROSS_ENCODER_MODEL_NAME, 5)
+
+    print(f"\n  {'embedding model':<24} {'chunk':>9} {'mode':<6} {'cand':>4} {'cross-encoder':<38} {'k':>2} {'recall':>6} {'src':>5} {'cand_r':>6} "
+          f"{'mrr':>5} {'p50 ms':>7} {'p95 ms':>7} {'rerank':>7} {'MB':>6}")
+    for result in sorted(results, key=lambda result: (-result["recall"], -result["mrr"], result["p95_ms"])):
+        marker = "*" if is_backend_configuration(result) else " "
+        print(f"{marker} {result['embedding_model']:<24} {result['chunk_size']:>5}/{result['chunk_overlap']:<3} {result['mode']:<6} {result['candidates']:>4} "
+              f"{result['cross_encoder']:<38} {result['top_k']:>2} {result['recall']:>6.2f} {result['source_recall']:>5.2f} {result['candidate_recall']:>6.2f} "
+              f"{result['mrr']:>5.2f} {result['p50_ms']:>7.1f} {result['p95_ms']:>7.1f} {result['rerank_mean_ms']:>7.1f} {result['memory_mb']:>6.0f}")
+
+    cheapest = cheapest_configuration(results, args.max_recall_drop)
+    print(f"\nCheapest configuration within {args.max_recall_drop:.2f} of the best recall@k: {cheapest['embedding_model']}, chunks of {cheapest['chunk_size']} "
+          f"(overlap {cheapest['chunk_overlap']}), {cheapest['mode']} search, {cheapest['candidates']} candidates, cross-encoder {cheapest['cross_encoder']}, "
+          f"top {cheapest['top_k']}: recall@k {cheapest['recall']:.2f}, MRR {cheapest['mrr']:.2f}, p95 {cheapest['p95_ms']:.1f}ms, {cheapest['memory_mb']:.0f} MB.")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"commit": git_commit(), "questions": len(questions), "settings": vars(args), "results": results, "cheapest": cheapest}, f, indent=4)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
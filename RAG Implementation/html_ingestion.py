@@ -0,0 +1,165 @@
+import os
+import json
+from pathlib import Path
+from itertools import islice
+from ingestion import CHUNK_SIZE, CHUNK_OVERLAP, EMBED_BATCH_SIZE, file_hash, load_manifest, save_manifest, stored_chunk_ids, embed_and_upsert
+
+#File in the folder of the Chroma DB that remembers which version of each scraped page is stored in the collection.
+#It is separate from the manifest of the PDF files, and the ids of the chunks of the pages start with HTML_ID_PREFIX,
+#so that the two ingestions do not overwrite or delete each other's chunks, even when a page and a PDF file have the same name.
+HTML_MANIFEST_FILE = "html_ingest_manifest.json"
+HTML_ID_PREFIX = "html:"
+
+#Change manifest written by "Dataset Extraction/scrap.py" in its output folder
+CHANGE_MANIFEST_FILE = "changes.json"
+
+#A table is kept in one chunk up to this many characters. A longer table is split between rows, and every part starts with the header row.
+TABLE_CHUNK_SIZE = 2000
+
+#Sections written by extract_content in scrap.py. The tables are separated by an empty line, the other sections have one item per line.
+TABLE_SECTION = "Tables"
+
+
+#This function groups the items of an iterable into lists of at most size items, without reading the whole iterable
+def batched(iterable, size: int):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+#This function packs lines into chunks of at most chunk_size characters, without splitting a line unless it is longer than a chunk.
+#Consecutive chunks share their last lines, up to chunk_overlap characters, so that a sentence at the border is in both.
+def split_lines(lines: list[str], chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP):
+    current, size = [], 0
+    for line in lines:
+        if len(line) > chunk_size:
+            if current:
+                yield "\n".join(current)
+                current, size = [], 0
+            step = max(chunk_size - chunk_overlap, 1)
+            for start in range(0, len(line), step):
+                yield line[start:start + chunk_size]
+            continue
+
+        if current and size + len(line) + 1 > chunk_size:
+            yield "\n".join(current)
+            #Keep the last lines of the chunk at the start of the next one
+            overlap, overlap_size = [], 0
+            for previous in reversed(current):
+                if overlap_size + len(previous) + 1 > chunk_overlap:
+                    break
+                overlap.insert(0, previous)
+                overlap_size += len(previous) + 1
+            current, size = overlap, overlap_size
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        yield "\n".join(current)
+
+
+#This function yields a table as one chunk, or, if it is longer than table_size, as parts made of whole rows that all start with the header row
+def split_table(table: str, table_size: int = TABLE_CHUNK_SIZE):
+    if len(table) <= table_size:
+        yield table
+        return
+    header, *rows = table.split("\n")
+    for part in split_lines(rows, max(table_size - len(header) - 1, 1), 0):
+        yield f"{header}\n{part}"
+
+
+#This function splits the sections of a page into chunks. Every chunk starts with the title of the page and the name of its section.
+#Yields the section name and the text of every chunk.
+def chunk_sections(title: str, sections: dict, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP):
+    for section, content in sections.items():
+        if not content.strip():
+            continue
+        if section == TABLE_SECTION:
+            parts = (part for table in content.split("\n\n") if table.strip() for part in split_table(table))
+        else:
+            parts = split_lines([line for line in content.split("\n") if line.strip()], chunk_size, chunk_overlap)
+        for part in parts:
+            yield section, f"{title} - {section}:\n{part}"
+
+
+#This function loads the change manifest written by scrap.py. Only the pages whose JSON file exists can be ingested.
+#The paths in the manifest are relative to the folder scrap.py ran in, so the JSON files are looked up in pages_path instead.
+def load_scraped_pages(pages_path: str) -> dict:
+    with open(os.path.join(pages_path, CHANGE_MANIFEST_FILE), "r", encoding="utf-8") as f:
+        pages = json.load(f)["pages"]
+    pages = {
+        name: {**page, "json_file": os.path.join(pages_path, os.path.basename(page["json_file"]))}
+        for name, page in pages.items() if page["status"] != "removed"
+    }
+    return {name: page for name, page in pages.items() if os.path.exists(page["json_file"])}
+
+
+#This function yields the ids, texts and metadata of the chunks of the pages, reading the JSON file of one page at a time.
+#The number of chunks of every page is written in chunk_counts once the page is read.
+#A page that cannot be read or chunked is skipped and left out of chunk_counts, so that the chunks of its previous version are kept.
+def iter_page_chunks(pages: dict, chunk_counts: dict, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP):
+    for name, page in pages.items():
+        try:
+            with open(page["json_file"], "r", encoding="utf-8") as f:
+                sections = json.load(f)
+            metadata = {"source": page["url"], "file": Path(page["json_file"]).name}
+            chunks = [
+                (f"{HTML_ID_PREFIX}{name}_{count}", text, {**metadata, "section": section})
+                for count, (section, text) in enumerate(chunk_sections(name.replace("_", " "), sections, chunk_size, chunk_overlap))
+            ]
+        except Exception as e:
+            # If there is an error, display it and keep the chunks of the previous version of the page
+            print(f"Error processing page '{name}': {e}")
+            continue
+        yield from chunks
+        chunk_counts[name] = len(chunks)
+        print(f"Successfully processed '{name}' into {len(chunks)} chunks.")
+
+
+#This function ingests the pages scraped by "Dataset Extraction/scrap.py" into the collection, straight from the sections extract_content wrote in their JSON files:
+# 1. Hash the JSON file of every page and compare it with the manifest of the last run. Unchanged pages are skipped.
+# 2. Split the sections of the new and changed pages into chunks. The tables are kept whole, and the URL of the page is the source of its chunks.
+# 3. Embed and upsert the chunks in batches of batch_size as they are produced, so the memory used does not grow with the number of pages.
+# 4. Delete the chunks of removed pages, and the trailing chunks of pages that got shorter.
+# 5. Save the new manifest.
+#If the chunking settings or the embedding model change, every page is ingested again.
+#Returns True if the collection changed.
+def ingest_scraped_pages(pages_path: str, collection, embedding_function, embedding_model: str, chroma_path: str,
+                         chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP, batch_size: int = EMBED_BATCH_SIZE) -> bool:
+    manifest = load_manifest(chroma_path, HTML_MANIFEST_FILE)
+    settings = {"chunk_size": chunk_size, "chunk_overlap": chunk_overlap, "table_chunk_size": TABLE_CHUNK_SIZE, "embedding_model": embedding_model, "id_prefix": HTML_ID_PREFIX}
+    old_files = manifest["files"] if manifest["settings"] == settings else {}
+
+    pages = load_scraped_pages(pages_path)
+    hashes = {name: file_hash(Path(page["json_file"])) for name, page in pages.items()}
+    changed = {name: page for name, page in pages.items() if old_files.get(name, {}).get("hash") != hashes[name]}
+    removed = [name for name in manifest["files"] if name not in pages]
+    print(f"{len(pages)} pages: {len(changed)} new or changed, {len(removed)} removed, {len(pages) - len(changed)} unchanged.")
+    if not changed and not removed:
+        return False
+
+    chunk_counts = {}
+    upserted = 0
+    for batch in batched(iter_page_chunks(changed, chunk_counts, chunk_size, chunk_overlap), batch_size):
+        ids, documents, metadatas = (list(column) for column in zip(*batch))
+        embed_and_upsert(collection, embedding_function, ids, documents, metadatas)
+        upserted += len(batch)
+
+    #Chunks beyond the new length belong to the previous version of the page.
+    #Manifests written before the ids had a prefix list chunks stored without it, and all of those chunks are replaced.
+    previous_prefix = (manifest["settings"] or {}).get("id_prefix", "")
+    stale_ids = []
+    for name in changed:
+        if name in chunk_counts:
+            previous = stored_chunk_ids(f"{previous_prefix}{name}", manifest["files"].get(name), [])
+            stale_ids.extend(chunk_id for chunk_id in previous if previous_prefix != HTML_ID_PREFIX or int(chunk_id.rsplit("_", 1)[1]) >= chunk_counts[name])
+    for name in removed:
+        stale_ids.extend(stored_chunk_ids(f"{previous_prefix}{name}", manifest["files"][name], []))
+    for batch in batched(stale_ids, batch_size):
+        collection.delete(ids=batch)
+    print(f"Upserted {upserted} chunks and deleted {len(stale_ids)} stale chunks.")
+
+    #The pages that failed keep the entry of their previous version
+    new_files = {name: entry for name, entry in manifest["files"].items() if name in pages and name not in chunk_counts}
+    new_files.update({name: {"hash": hashes[name], "chunks": chunk_counts[name]} for name in changed if name in chunk_counts})
+    save_manifest(chroma_path, {"settings": settings, "files": new_files}, HTML_MANIFEST_FILE)
+    return True
@@ -0,0 +1,129 @@
+import os
+import sys
+import shutil
+import argparse
+from pathlib import Path
+from datetime import datetime
+from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
+from ingestion import ingest_directory
+from html_ingestion import ingest_scraped_pages
+from app import pdf_to_url, EMBEDDING_MODEL_NAME
+
+#The vector store and the BM25 index are shared with the Backend, so we add the Backend folder to the import path
+BACKEND_PATH = Path(__file__).resolve().parent.parent / "Backend"
+sys.path.append(str(BACKEND_PATH))
+from bm25_index import BM25Index
+from vector_store import (
+    LEGACY_VERSION,
+    list_versions,
+    open_collection,
+    resolve_active_store,
+    set_current_version,
+    version_path,
+)
+
+#Questions that every new version of the vector store must be able to answer before it is published
+VALIDATION_QUERIES = [
+    "What is the minimum IELTS score required for MSc application?",
+    "What are the tuition fees for international students?",
+]
+
+
+#This function checks that a newly built version of the vector store can be served:
+# 1. It is not empty, and it did not shrink below min_ratio of the version being served.
+# 2. Every validation query returns chunks.
+# 3. Its BM25 index covers all of its chunks.
+#Raises a ValueError describing the first problem found.
+def validate_version(path: str, embedding_function, previous_count: int, min_ratio: float):
+    collection = open_collection(path, embedding_function)
+    count = collection.count()
+    if count == 0:
+        raise ValueError("the collection is empty")
+    if previous_count and count < previous_count * min_ratio:
+        raise ValueError(f"the collection has {count} chunks, less than {min_ratio:.0%} of the {previous_count} chunks served now")
+
+    for query in VALIDATION_QUERIES:
+        results = collection.query(query_texts=[query], n_results=3)
+        if not results.get("documents")[0]:
+            raise ValueError(f"no chunks found for the query '{query}'")
+
+    index = BM25Index.load(path)
+    if index is None or len(index) != count:
+        raise ValueError("the BM25 index does not match the collection")
+    return count
+
+
+#This function deletes the oldest versions of the vector store and keeps the `keep` most recent ones, the one being served and the one served before it.
+#A running Backend keeps serving the previous version until it has loaded the new one, so that version is never deleted, even with a small `keep`.
+def prune_versions(root: str, keep: int, current: str, previous: str | None = None):
+    versions = list_versions(root)
+    for version in versions[:max(len(versions) - keep, 0)]:
+        if version not in (current, previous):
+            shutil.rmtree(version_path(root, version), ignore_errors=True)
+            print(f"Deleted old version '{version}'.")
+
+
+#This function returns the name of a new version: the date and time of the ingestion down to the microsecond, so that the names sort in the order
+#the versions were built, and two runs started in the same second (a retry, for example) do not get the same folder.
+def new_version_name(root: str) -> str:
+    while True:
+        version = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        if not os.path.exists(version_path(root, version)):
+            return version
+
+
+#This function builds a new version of the vector store next to the one being served, validates it and publishes it:
+# 1. Copy the version being served into a new folder, so that the incremental ingestion only processes the changed PDF files or pages.
+# 2. Ingest the PDF files, or the pages scraped by "Dataset Extraction/scrap.py", into the new folder and build its BM25 index.
+# 3. Validate the new folder. If it is not valid, delete it and keep serving the current version.
+# 4. Switch the CURRENT pointer to the new version. Running Backends pick it up without a restart.
+# 5. Delete the oldest versions, except the one that was served until now.
+def main():
+    parser = argparse.ArgumentParser(description="Ingest the PDF files or the scraped pages into a new version of the vector store and publish it to the Backend.")
+    parser.add_argument("--source", choices=["pdf", "html"], default="pdf", help="ingest the PDF files of --data, or the pages scraped into --pages. Use --full when switching between them.")
+    parser.add_argument("--data", default="./data", help="folder with the PDF files")
+    parser.add_argument("--pages", default="../Dataset Extraction/scraped_pages", help="output folder of scrap.py, with its changes.json")
+    parser.add_argument("--store", default=str(BACKEND_PATH / "vector_store"), help="folder of the versioned vector store served by the Backend")
+    parser.add_argument("--legacy-chroma", default=str(BACKEND_PATH / "chroma_db"), help="Chroma DB folder served by the Backend before the first version is published")
+    parser.add_argument("--full", action="store_true", help="ingest every PDF file again instead of starting from the version being served")
+    parser.add_argument("--keep", type=int, default=3, help="number of versions to keep on disk. The version served before the new one is always kept.")
+    parser.add_argument("--min-ratio", type=float, default=0.5, help="refuse to publish a version with fewer chunks than this fraction of the version being served")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes that load and chunk the PDF files")
+    args = parser.parse_args()
+
+    current, current_path = resolve_active_store(args.store, args.legacy_chroma)
+    if current == LEGACY_VERSION and not os.path.isdir(current_path):
+        current_path = None
+
+    embedding_function = SentenceTransformerEmbeddingFunction(model_name=EMBEDDING_MODEL_NAME)
+    previous_count = open_collection(current_path, embedding_function).count() if current_path else 0
+
+    version = new_version_name(args.store)
+    path = version_path(args.store, version)
+    if current_path and not args.full:
+        shutil.copytree(current_path, path)
+        print(f"Building version '{version}' from version '{current}'.")
+    else:
+        os.makedirs(path)
+        print(f"Building version '{version}' from scratch.")
+
+    try:
+        collection = open_collection(path, embedding_function)
+        if args.source == "html":
+            ingest_scraped_pages(args.pages, collection, embedding_function, EMBEDDING_MODEL_NAME, path)
+        else:
+            ingest_directory(args.data, collection, embedding_function, EMBEDDING_MODEL_NAME, path, pdf_to_url, workers=args.workers)
+        BM25Index.build_from_collection(collection).save(path)
+        count = validate_version(path, embedding_function, previous_count, args.min_ratio)
+    except Exception as e:
+        shutil.rmtree(path, ignore_errors=True)
+        print(f"Version '{version}' was not published: {e}")
+        sys.exit(1)
+
+    set_current_version(args.store, version)
+    print(f"Published version '{version}' with {count} chunks. The previous version '{current}' had {previous_count} chunks.")
+    prune_versions(args.store, args.keep, version, current)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from langchain_community.document_loaders import PyMuPDFLoader
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+#File in the folder of the Chroma DB that remembers which version of each PDF file is stored in the collection
+MANIFEST_FILE = "ingest_manifest.json"
+
+#Default settings of the ingestion
+CHUNK_SIZE = 600
+CHUNK_OVERLAP = 100
+EMBED_BATCH_SIZE = 256  # chunks embedded in one call to the embedding model
+UPSERT_BATCH_SIZE = 1000  # chunks written to Chroma in one upsert
+
+
+#This function returns the SHA-256 hash of a file. A file whose hash has not changed since the last run is skipped.
+def file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+#This function loads a PDF file and splits it into chunks. It runs in a worker process.
+#Returns the file name and the list of chunk texts.
+def chunk_pdf(pdf_path: str, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP) -> tuple[str, list[str]]:
+    docs = PyMuPDFLoader(pdf_path).load()
+
+    # Split documents into smaller chunks
+    # The separators are used to split the document into smaller chunks
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=["\n\n", "\n", ".", "?", "!", " ", ""]
+    )
+    return Path(pdf_path).name, [split.page_content for split in text_splitter.split_documents(docs)]
+
+
+#This function loads the manifest of the last ingestion. It is empty if the collection was never ingested with this pipeline.
+def load_manifest(chroma_path: str, manifest_file: str = MANIFEST_FILE) -> dict:
+    path = os.path.join(chroma_path, manifest_file)
+    if not os.path.exists(path):
+        return {"settings": None, "files": {}}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+#This function saves the manifest. It is written to a temporary file first so that a crash never leaves a half-written manifest.
+def save_manifest(chroma_path: str, manifest: dict, manifest_file: str = MANIFEST_FILE):
+    path = os.path.join(chroma_path, manifest_file)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+#This function returns the ids of the chunks of a file that are stored in the collection.
+#Files ingested before the manifest existed have no chunk count, so their ids are looked up in the collection.
+def stored_chunk_ids(file_stem: str, manifest_entry: dict | None, all_ids: list[str] | None) -> list[str]:
+    if manifest_entry is not None:
+        return [f"{file_stem}_{idx}" for idx in range(manifest_entry["chunks"])]
+    prefix = f"{file_stem}_"
+    return [chunk_id for chunk_id in all_ids if chunk_id.startswith(prefix) and chunk_id[len(prefix):].isdigit()]
+
+
+#This function embeds the chunks in large batches and upserts them into the collection in chunks of UPSERT_BATCH_SIZE.
+#The embeddings are passed to Chroma so that it does not embed the documents again.
+def embed_and_upsert(collection, embedding_function, ids: list[str], documents: list[str], metadatas: list[dict],
+                     embed_batch_size: int = EMBED_BATCH_SIZE, upsert_batch_size: int = UPSERT_BATCH_SIZE):
+    embeddings = []
+    for start in range(0, len(documents), embed_batch_size):
+        embeddings.extend(embedding_function(documents[start:start + embed_batch_size]))
+
+    for start in range(0, len(documents), upsert_batch_size):
+        end = start + upsert_batch_size
+        collection.upsert(
+            ids=ids[start:end],
+            documents=documents[start:end],
+            metadatas=metadatas[start:end],
+            embeddings=embeddings[start:end],
+        )
+
+
+#This function ingests the PDF files of a directory into the collection incrementally:
+# 1. Hash every PDF file and compare it with the manifest of the last run. Unchanged files are skipped.
+# 2. Load and chunk the new and changed files in a pool of worker processes.
+# 3. Embed the chunks in large batches and upsert them in chunks.
+# 4. Delete the chunks of removed files, and the trailing chunks of files that got shorter.
+# 5. Save the new manifest.
+#If the chunking settings or the embedding model change, every file is ingested again.
+#sources maps a PDF file name to the URL stored as the source of its chunks.
+#Returns True if the collection changed.
+def ingest_directory(directory_path: str, collection, embedding_function, embedding_model: str, chroma_path: str, sources: dict,
+                     chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP, workers: int | None = None) -> bool:
+    manifest = load_manifest(chroma_path)
+    settings = {"chunk_size": chunk_size, "chunk_overlap": chunk_overlap, "embedding_model": embedding_model}
+    old_files = manifest["files"] if manifest["settings"] == settings else {}
+
+    pdf_files = {pdf_file.name: pdf_file for pdf_file in Path(directory_path).rglob("*.pdf")}
+    hashes = {name: file_hash(path) for name, path in pdf_files.items()}
+    changed = [name for name in pdf_files if old_files.get(name, {}).get("hash") != hashes[name]]
+    removed = [name for name in manifest["files"] if name not in pdf_files]
+    print(f"{len(pdf_files)} PDF files: {len(changed)} new or changed, {len(removed)} removed, {len(pdf_files) - len(changed)} unchanged.")
+    if not changed and not removed:
+        return False
+
+    #Files ingested before the manifest existed need the list of stored ids to find their chunks
+    all_ids = None
+    if any(name not in manifest["files"] for name in changed + removed):
+        all_ids = collection.get(include=[])["ids"]
+
+    new_files = {name: entry for name, entry in manifest["files"].items() if name in pdf_files and name not in changed}
+    ids, documents, metadatas, stale_ids = [], [], [], []
+
+    #Loading and chunking the PDF files is CPU bound, so it runs in a pool of processes
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {name: pool.submit(chunk_pdf, str(pdf_files[name]), chunk_size, chunk_overlap) for name in changed}
+        for name, future in futures.items():
+            try:
+                _, chunks = future.result()
+            except Exception as e:
+                # If there is an error, display it and keep the chunks of the previous version of the file
+                print(f"Error processing file '{name}': {e}")
+                if name in manifest["files"]:
+                    new_files[name] = manifest["files"][name]
+                continue
+
+            stem = pdf_files[name].stem
+            for idx, chunk in enumerate(chunks):
+                ids.append(f"{stem}_{idx}")
+                documents.append(chunk)
+                metadatas.append({"source": sources.get(name, name), "file": name})
+
+            #Chunks beyond the new length belong to the previous version of the file
+            previous = stored_chunk_ids(stem, manifest["files"].get(name), all_ids)
+            stale_ids.extend(chunk_id for chunk_id in previous if int(chunk_id.rsplit("_", 1)[1]) >= len(chunks))
+            new_files[name] = {"hash": hashes[name], "chunks": len(chunks)}
+            print(f"Successfully processed '{pdf_files[name].stem}' into {len(chunks)} chunks.")
+
+    for name in removed:
+        stale_ids.extend(stored_chunk_ids(Path(name).stem, manifest["files"].get(name), all_ids))
+
+    if documents:
+        embed_and_upsert(collection, embedding_function, ids, documents, metadatas)
+    for start in range(0, len(stale_ids), UPSERT_BATCH_SIZE):
+        collection.delete(ids=stale_ids[start:start + UPSERT_BATCH_SIZE])
+    print(f"Upserted {len(documents)} chunks and deleted {len(stale_ids)} stale chunks.")
+
+    save_manifest(chroma_path, {"settings": settings, "files": new_files})
+    return True